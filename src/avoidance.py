@@ -0,0 +1,99 @@
+'''
+Reactive collision avoidance for streamed setpoints (avoidance_enabled in config.py).
+
+Sits between the trajectories of a dynamic formation and send_position_setpoint. Once per
+waypoint step, for the whole swarm at once:
+- every streaming drone is given the velocity that takes it from its estimated position to its
+  next setpoint, the other drones keep their estimated velocity (they are obstacles)
+- the closest approach of every pair within avoidance_horizon is computed in closed form
+- pairs that would come closer than collision_threshold + avoidance_margin are pushed apart along
+  the direction of closest approach, each streaming drone taking half of the missing distance
+  (all of it against an obstacle), as in reciprocal velocity obstacles
+- the correction of each drone is capped at avoidance_max_correction and the setpoint kept inside
+  the boundaries
+
+Full ORCA solves a small linear program per drone; the reciprocal push keeps the same
+responsibility sharing with a single vectorized pass over all pairs.
+'''
+import threading
+
+import numpy as np
+
+from config import (absolute_boundaries, boundary_margins, collision_threshold, avoidance_horizon, avoidance_margin,
+                    avoidance_max_correction)
+
+
+class ReciprocalAvoidance:
+    def __init__(self, uris, trajectories, waypoint_dt, estimates, waypoint=None):
+        '''
+        Args:
+            uris (list): every drone of the swarm, streaming or not
+            trajectories (dict): {uri: [waypoints]} of the streaming drones, waypoints are [x, y, z, yaw]
+            waypoint_dt (float): time between two waypoints
+            estimates (callable): returns (positions, velocities), (n, 3) arrays in the order of uris, NaN rows if unknown
+            waypoint (callable): (uri, step) -> waypoint, when the waypoints are not simply the trajectories in a loop
+                (morphing into another formation, see morph.py)
+        '''
+        self.uris = list(uris)
+        self.index = {uri: i for i, uri in enumerate(self.uris)}
+        self.trajectories = trajectories
+        self.waypoint_dt = waypoint_dt
+        self.estimates = estimates
+        self.waypoint = waypoint or (lambda uri, step: trajectories[uri][step % len(trajectories[uri])])
+        self.radius = collision_threshold + avoidance_margin
+        self.low = np.array([absolute_boundaries[axis][0] + boundary_margins for axis in "xyz"])
+        self.high = np.array([absolute_boundaries[axis][1] - boundary_margins for axis in "xyz"])
+        self.streaming = np.array([uri in trajectories for uri in self.uris])
+        self._i, self._j = np.triu_indices(len(self.uris), k=1)
+        self._lock = threading.Lock()
+        self._step = -1
+        self._corrections = np.zeros((len(self.uris), 3))
+        self.corrected = 0  # setpoints moved so far
+
+    def setpoint(self, uri, step):
+        """Waypoint `step` of a drone, corrected. The first drone to ask for a step computes it for all."""
+        with self._lock:
+            if step > self._step:
+                self._corrections = self._compute(step)
+                self._step = step
+            correction = self._corrections[self.index[uri]].tolist()
+        waypoint = self.waypoint(uri, step)
+        return (waypoint[0] + correction[0], waypoint[1] + correction[1], waypoint[2] + correction[2], waypoint[3])
+
+    def _compute(self, step):
+        positions, velocities = self.estimates()
+        known = ~np.isnan(positions).any(axis=1)
+        p = np.where(known[:, None], positions, 0.0)
+        setpoints = p.copy()
+        for uri in self.trajectories:
+            waypoint = self.waypoint(uri, step)
+            setpoints[self.index[uri]] = waypoint[:3]
+        # Streaming drones head for their setpoint, the others keep going as estimated
+        v = np.where(self.streaming[:, None], (setpoints - p) / self.waypoint_dt, np.nan_to_num(velocities))
+
+        i, j = self._i, self._j
+        dp = p[i] - p[j]
+        dv = v[i] - v[j]
+        speed2 = np.einsum("ij,ij->i", dv, dv)
+        t = np.clip(-np.einsum("ij,ij->i", dp, dv) / np.maximum(speed2, 1e-12), 0.0, avoidance_horizon)
+        closest = dp + dv * t[:, None]
+        distance = np.sqrt(np.einsum("ij,ij->i", closest, closest))
+        conflict = (distance < self.radius) & known[i] & known[j] & (self.streaming[i] | self.streaming[j])
+
+        corrections = np.zeros_like(p)
+        if conflict.any():
+            i, j = i[conflict], j[conflict]
+            closest, distance = closest[conflict], distance[conflict]
+            # Direction that separates i from j, vertical if they would meet exactly
+            direction = np.where((distance > 1e-9)[:, None], closest / np.maximum(distance, 1e-9)[:, None], (0.0, 0.0, 1.0))
+            missing = (self.radius - distance)[:, None] * direction
+            both = (self.streaming[i] & self.streaming[j])[:, None]
+            np.add.at(corrections, i, np.where(both, 0.5, 1.0) * missing * self.streaming[i][:, None])
+            np.add.at(corrections, j, -np.where(both, 0.5, 1.0) * missing * self.streaming[j][:, None])
+            norm = np.linalg.norm(corrections, axis=1, keepdims=True)
+            corrections *= np.minimum(1.0, avoidance_max_correction / np.maximum(norm, 1e-12))
+            self.corrected += int((norm[:, 0] > 0).sum())
+            # Keep the corrected setpoints inside the arena
+            moved = norm[:, 0] > 0
+            corrections[moved] = np.clip(setpoints[moved] + corrections[moved], self.low, self.high) - setpoints[moved]
+        return corrections
@@ -0,0 +1,196 @@
+'''
+Battery discharge model and rotation scheduler for long shows (battery_rotation_enabled in config.py).
+
+DischargeModel fits a straight line to the voltage of one drone over the last
+battery_model_window seconds, with running sums so every sample costs O(1). The voltage sags
+under load, so the fit only uses samples of the current flight state and starts over when the
+drone takes off or lands. From the fitted line it predicts the time left before the voltage
+reaches low_battery_in_flight.
+
+RotationScheduler turns the prediction into a deadline on the swarm's watchdog: the time a drone
+has to leave the formation, landing_duration + takeoff_duration + battery_rotation_margin before
+it would reach the threshold. When it comes, a spare drone on the ground takes the place of the
+tired one (see _rotate), so the formation keeps its size. Rotations go one at a time; a drone with no spare, or whose turn would come too late, simply lands early. The fixed
+low_battery_in_flight landing stays behind it as the last resort.
+'''
+import math
+from collections import deque
+
+from config import (low_battery_in_flight, low_battery_on_ground, landing_duration, takeoff_height, takeoff_duration, low_frequency_update_interval,
+                    battery_model_window, battery_model_min_samples, battery_rotation_enabled, battery_rotation_margin)
+
+
+class DischargeModel:
+    def __init__(self, window=battery_model_window, min_samples=battery_model_min_samples):
+        self.window = window
+        self.min_samples = min_samples
+        self.flying = None
+        self._samples = deque()  # (t - t0, voltage)
+        self._t0 = 0.0  # time origin of the fit, keeps the sums small
+        self._sums = [0.0, 0.0, 0.0, 0.0]  # sum t, sum v, sum t^2, sum t*v
+
+    def _add(self, t, v, sign):
+        sums = self._sums
+        sums[0] += sign * t
+        sums[1] += sign * v
+        sums[2] += sign * t * t
+        sums[3] += sign * t * v
+
+    def update(self, now, voltage, flying):
+        if flying != self.flying:
+            # Different load, different line: start over
+            self.flying = flying
+            self._samples.clear()
+            self._sums = [0.0, 0.0, 0.0, 0.0]
+            self._t0 = now
+        t = now - self._t0
+        self._samples.append((t, voltage))
+        self._add(t, voltage, 1.0)
+        while self._samples and t - self._samples[0][0] > self.window:
+            self._add(*self._samples.popleft(), -1.0)
+
+    def fit(self):
+        """(voltage at t0, volts per second), None without enough samples."""
+        n = len(self._samples)
+        if n < self.min_samples:
+            return None
+        st, sv, stt, stv = self._sums
+        denominator = n * stt - st * st
+        if denominator <= 1e-9:
+            return None
+        slope = (n * stv - st * sv) / denominator
+        return (sv - slope * st) / n, slope
+
+    def voltage(self, now):
+        """Fitted voltage at now, None without enough samples."""
+        fit = self.fit()
+        return None if fit is None else fit[0] + fit[1] * (now - self._t0)
+
+    def time_to(self, threshold, now):
+        """Seconds from now until the fitted voltage reaches threshold: 0 if it is already below,
+        inf if it is not dropping, None without enough samples."""
+        fit = self.fit()
+        if fit is None:
+            return None
+        voltage = fit[0] + fit[1] * (now - self._t0)
+        if voltage <= threshold:
+            return 0.0
+        return (voltage - threshold) / -fit[1] if fit[1] < 0 else math.inf
+
+    def remaining_flight_time(self, now):
+        """Predicted flight time left before low_battery_in_flight, None if unknown (on the ground or too few samples)."""
+        return self.time_to(low_battery_in_flight, now) if self.flying else None
+
+
+class RotationScheduler:
+    def __init__(self, swarm, enabled=battery_rotation_enabled, margin=battery_rotation_margin):
+        '''
+        Args:
+            swarm (CrazyflieSwarm): the models are fed by its battery log callback, the deadlines run on its watchdog
+            enabled (bool): schedule rotations, otherwise only the models are kept (remaining flight time)
+            margin (float): seconds of flight left when a swap is done
+        '''
+        self.swarm = swarm
+        self.enabled = enabled
+        self.lead = landing_duration + takeoff_duration + margin  # time a swap needs before the threshold
+        self.models = {uri: DischargeModel() for uri in swarm.uris}
+        self._rotating = None  # (tired, spare) of the rotation in progress
+        self._leaving = set()  # drones swapped out or landing early, until they are on the ground
+        self.rotations = 0
+        self.early_landings = 0
+
+    def update(self, uri, now, voltage, flying):
+        """Called by the battery log callback."""
+        model = self.models[uri]
+        model.update(now, voltage, flying)
+        if not flying:
+            self._leaving.discard(uri)
+        if not self.enabled or not flying or uri in self._leaving:
+            return
+        # Later predictions are picked up when the armed deadline comes, earlier ones re-arm it
+        key = ("battery", uri)
+        armed = self.swarm.watchdog.deadline(key)
+        deadline = self._deadline(uri, now)
+        if deadline is not None and (armed is None or deadline < armed - battery_model_window / 10):
+            self.swarm.watchdog.arm(key, deadline, self._due)
+
+    def _deadline(self, uri, now):
+        """Time the drone has to leave the formation, None if it cannot be predicted yet."""
+        left = self.models[uri].remaining_flight_time(now)
+        if left is None:
+            return None
+        return now + max(left - self.lead, 0.0)
+
+    def _spare(self):
+        """Connected drone on the ground with the fullest battery that can take off, None if there is none."""
+        swarm = self.swarm
+        best, best_voltage = None, low_battery_on_ground
+        for uri, drone in swarm.telemetry.snapshot().items():
+            if (swarm.scfs.get(uri) is None or drone.state in ("flying", "disconnected") or uri in swarm._killed
+                    or swarm.formations.connected_to_formation[uri] or not swarm.position_has_converged(uri)):
+                continue
+            if drone.battery >= best_voltage and (self._rotating is None or uri != self._rotating[1]):
+                best, best_voltage = uri, drone.battery
+        return best
+
+    def _due(self, key, now):
+        """Watchdog callback: the drone has to leave the formation. Returns a later deadline while it can wait."""
+        uri = key[1]
+        swarm = self.swarm
+        if (swarm.get_drone_state(uri) != "flying" or not swarm.formations.connected_to_formation[uri]
+                or uri in self._leaving):
+            return None  # landed or left the formation meanwhile, armed again at its next flight
+        if not swarm.recalculate_formations:
+            return None  # compiled show: its own variants handle a drone leaving, the threshold landing stays
+        deadline = self._deadline(uri, now)
+        if deadline is None:
+            return None  # took off again, the next battery packet arms it
+        if deadline > now:
+            return deadline  # discharging slower than predicted
+        left = self.models[uri].remaining_flight_time(now)
+        if self._rotating is not None:
+            # One rotation at a time, unless this drone cannot wait for it
+            if left > landing_duration + battery_rotation_margin:
+                return now + takeoff_duration
+            self._land_early(uri, f"cannot wait for a spare ({left:.0f}s of flight left)")
+            return None
+        spare = self._spare()
+        if spare is None:
+            self._land_early(uri, f"has {left:.0f}s of flight left and no spare")
+            return None
+        self._rotating = (uri, spare)
+        self._leaving.add(uri)
+        print(f"[BATTERY] {uri} has {left:.0f}s of flight left, swapping with {spare}")
+        swarm.clock.start_thread(self._rotate, (uri, spare), daemon=True)
+        return None
+
+    def _land_early(self, uri, reason):
+        swarm = self.swarm
+        self._leaving.add(uri)
+        self.early_landings += 1
+        swarm.metrics.counter("battery_rotations_total", "Drones taken out of the formation by the battery scheduler",
+                              outcome="landed").inc()
+        print(f"[BATTERY] {uri} {reason}, landing")
+        swarm.clock.start_thread(swarm.land_one, (uri, swarm.scfs.get(uri), landing_duration))
+
+    def _rotate(self, tired, spare):
+        """In a static formation the spare takes off and joins first, then the tired drone lands. A
+        dynamic formation is replanned around every flying drone, so there the tired drone lands
+        first and the spare joins once it is on the ground."""
+        swarm = self.swarm
+        try:
+            if any(swarm._dynamic_formation_running.values()):
+                swarm.land_one(tired, swarm.scfs.get(tired), landing_duration)
+                deadline = swarm.clock.time() + landing_duration + takeoff_duration
+                while swarm.get_drone_state(tired) == "flying" and swarm.clock.time() < deadline:
+                    swarm.clock.sleep(low_frequency_update_interval)
+                swarm.takeoff_one(spare, swarm.scfs.get(spare), takeoff_height, takeoff_duration)
+            else:
+                swarm.takeoff_one(spare, swarm.scfs.get(spare), takeoff_height, takeoff_duration)
+                swarm.clock.sleep(takeoff_duration)
+                swarm.land_one(tired, swarm.scfs.get(tired), landing_duration)
+            self.rotations += 1
+            swarm.metrics.counter("battery_rotations_total", "Drones taken out of the formation by the battery scheduler",
+                                  outcome="swapped").inc()
+        finally:
+            self._rotating = None
@@ -0,0 +1,219 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class SystemClock:
+    '''Wall clock used in flight. The swarm asks its clock for the time, to sleep and to run
+    threads, so the same swarm logic can also run on a virtual clock (see ReplayClock).'''
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds, first=False):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def start_thread(self, target, args=(), daemon=False):
+        thread = threading.Thread(target=target, args=args, daemon=daemon)
+        thread.start()
+        return thread
+
+    def join(self, thread, timeout=None):
+        thread.join(timeout=timeout)
+
+    def event(self):
+        return threading.Event()
+
+
+class _Waiter:
+    '''A managed thread blocked on the clock (or not started yet), released when its deadline passes,
+    the event it waits for is set or the thread it joins ends.'''
+    __slots__ = ("condition", "woken")
+
+    def __init__(self, lock):
+        self.condition = threading.Condition(lock)
+        self.woken = False
+
+
+class _ReplayEvent:
+    '''threading.Event for managed threads: wait() blocks on the clock like sleep(), its timeout is virtual time.'''
+    def __init__(self, clock):
+        self._clock = clock
+        self._flag = False
+        self._waiters = []
+
+    def is_set(self):
+        return self._flag
+
+    def set(self):
+        with self._clock._lock:
+            self._flag = True
+            for waiter in self._waiters:
+                self._clock._schedule(waiter)
+            self._waiters.clear()
+
+    def clear(self):
+        with self._clock._lock:
+            self._flag = False
+
+    def wait(self, timeout=None):
+        clock = self._clock
+        with clock._lock:
+            if not self._flag:
+                waiter = _Waiter(clock._lock)
+                self._waiters.append(waiter)
+                if timeout is not None:
+                    clock._push(clock._now + max(timeout, 0.0), waiter)
+                clock._block(waiter)
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)  # woken by the timeout
+            return self._flag
+
+
+class ReplayClock:
+    '''Deterministic virtual clock for replays and simulations.
+
+    Threads started with start_thread() are managed: virtual time only moves forward once every
+    managed thread is blocked in sleep(), join() or on an event() (the swarm is idle). advance_to() then
+    releases them one at a time, by deadline and then in the order they blocked (inputs first, see sleep()),
+    and waits for each to block again before releasing the next. A thread being started, an event being set
+    or a joined thread ending only queues the threads it concerns at the current time. Managed threads therefore
+    never run concurrently, and the same inputs give the same sequence of events every time, without waiting for them.
+    With speed set, virtual time is paced to speed x real time, with speed=None it runs as fast as possible.
+    '''
+    def __init__(self, start, speed=None, stall_timeout=5.0):
+        self._now = start
+        self.speed = speed
+        self.stall_timeout = stall_timeout  # real seconds a managed thread may run without blocking
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._running = 0  # managed threads that are not blocked on the clock
+        self._sleepers = []  # heap of (deadline, rank, seq, _Waiter), the threads to release, a _Waiter can be in it more than once
+        self._joiners = {}  # {thread: [_Waiter]}
+        self._managed = set()
+        self._seq = itertools.count()
+        self._real_start = time.perf_counter()
+        self._virtual_start = start
+
+    def time(self):
+        return self._now
+
+    # ---------------------------
+    # CALLED BY MANAGED THREADS
+    # ---------------------------
+    def _block(self, waiter):
+        self._running -= 1
+        self._idle.notify()
+        while not waiter.woken:
+            waiter.condition.wait()
+
+    def _wake(self, waiter):
+        if not waiter.woken:
+            waiter.woken = True
+            self._running += 1
+            waiter.condition.notify()
+
+    def _push(self, deadline, waiter, first=False):
+        heapq.heappush(self._sleepers, (deadline, 0 if first else 1, next(self._seq), waiter))
+
+    def _schedule(self, waiter):
+        """Release waiter at the current time, after the threads already due."""
+        self._push(self._now, waiter)
+
+    def sleep(self, seconds, first=False):
+        """first: the thread feeds the swarm its inputs (telemetry, operator actions), at a deadline it shares with
+        other threads it runs before them, as the replay delivers its recorded inputs before the swarm's own work."""
+        with self._lock:
+            waiter = _Waiter(self._lock)
+            self._push(self._now + max(seconds, 0.0), waiter, first)
+            self._block(waiter)
+
+    def join(self, thread, timeout=None):
+        with self._lock:
+            if thread not in self._managed:
+                return  # finished, or never started by this clock
+            waiter = _Waiter(self._lock)
+            self._joiners.setdefault(thread, []).append(waiter)
+            if timeout is not None:
+                self._push(self._now + timeout, waiter)
+            self._block(waiter)
+
+    def event(self):
+        return _ReplayEvent(self)
+
+    def start_thread(self, target, args=(), daemon=False):
+        start = _Waiter(self._lock)
+
+        def run():
+            with self._lock:
+                while not start.woken:
+                    start.condition.wait()
+            try:
+                target(*args)
+            finally:
+                with self._lock:
+                    self._managed.discard(thread)
+                    for waiter in self._joiners.pop(thread, []):
+                        self._schedule(waiter)
+                    self._running -= 1
+                    self._idle.notify()
+
+        thread = threading.Thread(target=run, daemon=True)
+        with self._lock:
+            driver = threading.current_thread() not in self._managed
+            self._managed.add(thread)
+            if not driver:
+                self._schedule(start)  # runs once the driver releases it, not alongside the thread starting it
+        thread.start()
+        if driver:
+            # Started by the driver: runs now, until it blocks, before the threads already due
+            with self._lock:
+                self._wait_idle()
+                self._wake(start)
+                self._wait_idle()
+        return thread
+
+    # ---------------------------
+    # CALLED BY THE DRIVER (replay engine)
+    # ---------------------------
+    def _wait_idle(self):
+        deadline = time.perf_counter() + self.stall_timeout
+        while self._running > 0:
+            if not self._idle.wait(timeout=max(deadline - time.perf_counter(), 0.0)) and self._running > 0:
+                raise RuntimeError(f"Replay stalled: {self._running} thread(s) did not block on the clock")
+
+    def _pace(self, t):
+        if self.speed:
+            delay = self._real_start + (t - self._virtual_start) / self.speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def wait_idle(self):
+        """Block until every managed thread is sleeping, joining or finished."""
+        with self._lock:
+            self._wait_idle()
+
+    def advance_to(self, t, before=False):
+        """Move virtual time to t, running every thread that falls due on the way, one at a time.
+        With before=True, the threads due at t itself are left for the next call, so that whatever the driver
+        does at t (deliver telemetry, start an operator action) happens before them."""
+        with self._lock:
+            self._wait_idle()
+            while self._sleepers and (self._sleepers[0][0] < t or (not before and self._sleepers[0][0] == t)):
+                deadline, _, _, waiter = heapq.heappop(self._sleepers)
+                if waiter.woken:
+                    continue  # already released by its event or the thread it joined
+                self._pace(deadline)
+                self._now = max(self._now, deadline)
+                self._wake(waiter)
+                self._wait_idle()
+            self._pace(t)
+            self._now = max(self._now, t)
+
+    def next_deadline(self):
+        """Earliest pending wake-up, None when nothing is sleeping."""
+        with self._lock:
+            while self._sleepers and self._sleepers[0][3].woken:
+                heapq.heappop(self._sleepers)  # joiners already woken by their thread ending
+            return self._sleepers[0][0] if self._sleepers else None
@@ -33,22 +33,114 @@ dynamic_sine_wave_amplitude = (absolute_boundaries['z'][1] - absolute_boundaries
 dynamic_sine_wave_period = 8.0  # seconds
 dynamic_waypoint_dt = 0.2  # seconds between waypoints in dynamic formation trajectories
 dynamic_minus_dt = 0.0  # seconds to subtract from waypoint dt to ensure smoothness
+dynamic_morph_duration = 3.0 # seconds a running dynamic formation takes to blend into the next one (morph.py), 0 to stop and go through a transition
+dynamic_morph_phases = 8 # phase offsets of the next dynamic formation tried when matching it to the drones
+shape_candidates_per_slot = 12 # random points of a custom shape sampled per drone (shapes.py)
+shape_relaxation_iterations = 10 # rounds that push apart the slots of a custom shape closer than the target
+shape_relaxation_target = 1.2 # target spacing of the relaxation, times the spacing farthest-point sampling ends with (never less than drone_spacing)
 
 # Communication variables
 high_frequency_update_interval = 0.25 # seconds
 low_frequency_update_interval = 1.0 # seconds
 factor_connection_lost = 3.0 # multiplier for low frequency update interval to determine connection lost
 reconnect_attempt_interval = 5.0 # seconds
-position_cache_size = int(position_convergence_time / high_frequency_update_interval) # number of recent positions to store for smoothing
+# Adaptive telemetry variables (position log rate follows the flight phase)
+position_rate_by_phase = {"ground": 2.0, "hover": 1 / high_frequency_update_interval, "takeoff": 10.0, "transition": 10.0, "dynamic": 10.0} # Hz
+radio_packet_budget = 400 # packets per second per Crazyradio, shared by all log blocks and streamed setpoints
+rate_boost_timeout = 6.0 # seconds a takeoff, go_to or land keeps the position rate up if it is never confirmed
+log_period_min_ms = 10 # firmware log period resolution
+log_period_max_ms = 2550 # the period is sent as a uint8 in 10 ms units
+compact_position_logging = False # log the position as int16 mm (stateEstimateZ) instead of three floats
+log_velocity = False # with compact_position_logging, also log the velocity (int16 mm/s) in the same block
+# State estimator variables (state_estimator.py)
+estimator_alpha = 0.6 # position correction gain of the alpha-beta filter
+estimator_beta = 0.25 # velocity correction gain
+estimator_reset_gap = 2.0 # seconds without position after which a drone's filter starts over
+estimator_offset_drift = 0.001 # seconds per second the drone to host clock offset may drift
+estimator_max_prediction = 0.5 # seconds an estimate may be extrapolated
+# Safety monitor variables (safety_monitor.py), checked every update loop iteration
+safety_monitor_enabled = True
+safety_horizon = 1.0 # seconds of look-ahead for the boundary and separation checks
+safety_guided_horizon = 0.3 # seconds of look-ahead for drones following a go_to or streamed setpoints, short enough not to flag their braking
+safety_guided_samples = 7 # instants of the guided horizon at which those drones are predicted
+safety_plan_tolerance = 0.05 # meters a streaming drone is predicted off its setpoints before it counts, the error of its estimate
+safety_freeze_duration = 0.5 # seconds of the go_to that stops a frozen drone where it is
+# Reactive avoidance variables (avoidance.py), for the setpoints streamed by dynamic formations
+avoidance_enabled = False
+avoidance_horizon = 1.0 # seconds of look-ahead
+avoidance_margin = 0.1 # meters kept on top of collision_threshold
+avoidance_max_correction = 0.3 # meters a setpoint can be moved
+# Trajectory validation variables (trajectory_validator.py), checked before a dynamic formation starts
+validation_resolution = 0.02 # meters a drone may move between two samples of the sweep
+dynamic_max_speed = 1.0 # m/s, slower trajectories are generated when a period asks for more
+# Telemetry export variables (telemetry_export.py), for external visualizers
+export_rate = 0.0 # frames per second, 0 disables the export
+export_shared_memory = "uwb_swarm_telemetry" # name of the shared-memory ring buffer, None for no ring
+export_shared_memory_frames = 64 # frames kept in the ring
+export_shared_memory_reclaim = False # take over a ring of the same name that already exists (left over by a crash). Only when no other swarm uses it
+export_udp_targets = [("127.0.0.1", 9870)] # local UDP destinations of every frame
+export_udp_max_decimation = 16 # a UDP consumer that cannot keep up gets at least one frame out of this many
+# Multi-process variables (multiprocess_swarm.py, radio_worker.py)
+multiprocess_radios = False # one radio worker process per Crazyradio, planning and GUI stay in the main process
+worker_poll_interval = 0.005 # seconds between two reads of the shared telemetry by the main process
+worker_idle_sleep = 0.001 # seconds a worker sleeps when it has no command to execute
+worker_command_capacity = 4096 # commands that can wait for a worker
+worker_connect_timeout = 10.0 # seconds
+# Radio planning variables (radio_planner.py)
+radio_channels = (100, 80, 60, 40, 20) # one channel per Crazyradio, far enough apart not to overlap at 2M
+radio_max_utilization = 0.8 # fraction of radio_packet_budget a radio may be planned to use
+position_cache_size = int(position_convergence_time * max(position_rate_by_phase.values())) # number of recent positions to store for smoothing, enough for the fastest rate
 
 # Battery variables
 default_battery_voltage = 3.0 # volts
 low_battery_in_flight = 3.1 # volts
 low_battery_on_ground = 3.6 # volts
+battery_rotation_enabled = True # swap drones running out of battery with spares on the ground before they reach low_battery_in_flight
+battery_model_window = 60.0 # seconds of voltage history fitted by the discharge model of each drone
+battery_model_min_samples = 10 # samples in the current flight state before the model predicts anything
+battery_rotation_margin = 10.0 # seconds of predicted flight left when a swap is over
+
+# Emergency variables (emergency_stop in drone_commands.py)
+emergency_retry_interval = 0.05 # seconds between two stop packets to a drone still reported flying
+emergency_confirm_timeout = 3.0 # seconds of retries before a drone is reported as not confirmed
+forced_stop_grace = 1.0 # seconds after the landing duration before forced_stop_flying() stops the motors
 
 # Closing variables
 closing_threads_timeout = 4.0 # seconds
 
+# Flight recorder variables
+record_flights = True # record telemetry, commands and state changes for post-flight debugging
+flight_recorder_dir = "flights" # one .rec file per session
+flight_recorder_flush_interval = 0.5 # seconds between writes of the background writer
+replay_time_tolerance = 0.5 # seconds, a replayed command matches a recorded one if they are closer in time
+replay_value_tolerance = 1e-3 # tolerance on the values (positions, durations) of matched commands
+
+# Instrumentation variables
+metrics_http_port = 8900 # local text endpoint http://127.0.0.1:<port>/metrics, None to disable
+metrics_dump_path = None # file rewritten with the metrics every metrics_dump_interval, None to disable
+metrics_dump_interval = 10.0 # seconds
+tracing_enabled = False # record timed spans, exported as Chrome trace JSON when the links are closed
+tracing_dir = "traces" # one .json trace per session
+tracing_max_events = 1000000 # oldest spans are dropped beyond this
+instrument_locks = False # time contended lock acquires, read them with CrazyflieSwarm.lock_stats()
+
 # Loop variables
 swarm_loop_interval = 0.1 # seconds
-dynamic_formation_polling_interval = 0.1 # seconds
\ No newline at end of file
+dynamic_formation_polling_interval = 0.1 # seconds
+
+# GUI variables
+gui_update_interval = 0.2 # seconds
+position_view_refresh_interval = 0.1 # seconds, refresh of the live position panel (10 Hz)
+position_view_size = 300 # pixels, side of each position canvas
+# Show variables (show.py)
+show_start_timeout = 30.0 # seconds to wait for the positions of the connected drones to converge before a show starts
+show_late_warning = 0.5 # seconds, cues starting later than this are reported
+plan_start_tolerance = 0.15 # meters, drones further than this from the start positions of a compiled show make it plan live
+
+# Simulation variables (simulation.py), drones simulated behind the link boundary
+simulation_step = 0.01 # seconds between two steps of the simulated drones
+simulation_position_noise = 0.002 # meters, standard deviation of the simulated position measurements
+simulation_setpoint_speed = 1.5 # m/s, fastest a simulated drone follows streamed setpoints
+simulation_battery_full = 4.15 # volts
+simulation_battery_drain_flying = 0.002 # volts per second in flight
+simulation_battery_drain_ground = 0.0001 # volts per second on the ground
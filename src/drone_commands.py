@@ -1,10 +1,28 @@
 from logging import info
 import logging
 import math
+import os
 import threading
 import time
 
+import numpy as np
+
 from formations import FormationManager
+from swarm_state import SwarmState, InstrumentedLock
+from flight_recorder import FlightRecorder, NAN, LOG_POSITION, LOG_STATUS, GO_TO, SETPOINT, TAKEOFF, LAND, STOP, OPERATOR_ACTIONS
+from clock import SystemClock
+from tracing import tracer
+from telemetry_rates import TelemetryRateController, STATUS_VARIABLES
+from position_codec import position_variables, read_sample
+from telemetry_export import TelemetryExporter
+from safety_monitor import SafetyMonitor
+from state_estimator import AlphaBetaEstimator, predict, predict_arrays
+from avoidance import ReciprocalAvoidance
+from trajectory_validator import TrajectoryValidator
+from morph import Stream, StreamTable, plan_morph
+from watchdog import DeadlineWatchdog
+from battery_model import RotationScheduler
+from metrics import MetricsRegistry, CALLBACK_BUCKETS, INTERVAL_BUCKETS, LATENCY_BUCKETS, LOOP_BUCKETS, SECONDS_BUCKETS
 from config import *
 
 from cflib.crazyflie import Crazyflie
@@ -17,47 +35,115 @@ logging.getLogger('cflib').setLevel(logging.ERROR)
 
 class CrazyflieSwarm:
     '''Handles connections and commands to a swarm of crazyflies. Reads information from logs'''
-    def __init__(self, uris):
+    def __init__(self, uris, clock=None, record=record_flights):
         self.uris = uris
+        ## Time, sleeps and threads go through the clock so the swarm can also run on a virtual clock (replays)
+        self.clock = clock if clock is not None else SystemClock()
         self.scfs = {}     # {uri: SyncCrazyflie}
         self.link_threads = {}  # {uri: Thread}
-        ## When modifying a dict, a lock is needed. It works like a mutex
-        self.lock = threading.Lock()
+        ## When modifying scfs or the formation manager, a lock is needed. It works like a mutex
+        self.lock = InstrumentedLock("swarm") if instrument_locks else threading.Lock()
         self.running = False
-        ## Drone information, polled in the update loop with certain frequency
-        self.battery_cache = {uri: default_battery_voltage for uri in uris}
-        # options are: idle, connecting, connected, disconnected, flying, hovering, landing, and error
-        self.state_cache = {uri: "disconnected" for uri in uris}
-        self._last_state_update_time = {uri: time.time() for uri in uris}
-        self.current_positions = dict() # {uri: (x, y, z)}
-        self.position_cache = {uri: [] for uri in uris}
+        ## Link timeouts and reconnections, see _link_timeout()
+        self.watchdog = DeadlineWatchdog(self.clock)
+        self._connection_timeout = factor_connection_lost * low_frequency_update_interval
+        ## Battery discharge models, and rotation of the drones running out of battery (battery_model.py)
+        self.batteries = RotationScheduler(self)
+        ## Drone information, published by the log callbacks and read without locks
+        # states are: idle, connecting, connected, disconnected, flying, hovering, landing, and error
+        self.telemetry = SwarmState(uris, instrumented=instrument_locks, now=self.clock.time())
+        self.target_positions = dict() # {uri: (x, y, z)} formation slot each drone is flying to
+        self.estimators = {uri: AlphaBetaEstimator() for uri in uris}  # filtered position and velocity, see state_estimator.py
         ## Logging
-        self._log_configs = {}
+        self._log_configs = {}  # {uri: (LogConfig_low, LogConfig_high)}
+        self.rates = TelemetryRateController(uris)  # position log period of every drone
         ## Formation parameters
         self.formations = FormationManager(uris)
         ## Dynamic formation control
         self._dynamic_formation_running = {uri: False for uri in uris}
         self._dynamic_formation_thread = None
+        self._dynamic_streams = {}  # {uri: Stream} waypoints read by the setpoint threads, swapped by a morph (morph.py)
+        self._dynamic_start_time = None  # time of step 0 of the streams
+        self._dynamic_table = None  # StreamTable of the streams for the safety monitor, rebuilt when they are swapped
         self.current_formation = None
+        self.recalculate_formations = True  # recompute the formation when drones join or leave it, off for compiled shows
+        ## Safety monitor (see safety_monitor.py), run by the update loop
+        self.safety = SafetyMonitor(len(uris))
+        self._frozen = {}  # {uri: (x, y, z)} drones held in place by the safety monitor until the next operator action
+        self._killed = {}  # {uri: time} drones whose motors were stopped by emergency_stop(), nothing moves them until they take off again
+        self.validator = TrajectoryValidator()  # checks dynamic formations before they start
+        ## Metrics (see metrics.py), served or dumped by main.py
+        self.metrics = MetricsRegistry()
+        self._ack_latency = {command: self.metrics.histogram("command_ack_seconds", SECONDS_BUCKETS,
+                                                             "Time from a command to the telemetry confirming it", command=command)
+                             for command in ("takeoff", "land", "go_to")}
+        self._pending_acks = {}  # {uri: (command, time sent, target position or None)}
+        self._guided_until = {}  # {uri: end time of the last high level trajectory (takeoff, land, go_to)}
+        self._guided_targets = {}  # {uri: (x, y, z) where the last go_to ends, None for takeoff and land}
+        self._setpoint_lateness = self.metrics.histogram("setpoint_lateness_seconds", LATENCY_BUCKETS,
+                                                         "Delay of streamed setpoints behind their shared-clock deadline")
+        self._update_loop_time = self.metrics.histogram("update_loop_seconds", LOOP_BUCKETS,
+                                                        "Duration of one update loop iteration")
+        self._kill_time = self.metrics.histogram("emergency_stop_seconds", LATENCY_BUCKETS,
+                                                 "Time from the first stop packet to the telemetry confirming the motors are off")
+        ## Telemetry export for external visualizers, None until start_export()
+        self.exporter = None
+        ## Flight recorder, None when recording is disabled
+        self.recorder = None
+        if record:
+            path = os.path.join(flight_recorder_dir, time.strftime("%Y%m%d_%H%M%S") + ".rec")
+            self.recorder = FlightRecorder(uris, path, clock=self.clock)
 
 
     # ---------------------------
     # CONNECT ALL DRONES
     # ---------------------------
-    def _setup_logging(self, uri, scf):
-        """Create Crazyflie log block."""
-        cf = scf.cf
+    def _expect_ack(self, uri, command, target=None, duration=0.0):
+        """Start timing a command until the telemetry confirms it (see _check_ack).
+        duration is the length of the high level trajectory the command starts."""
+        now = self.clock.time()
+        self._pending_acks[uri] = (command, now, target)
+        self._guided_until[uri] = now + duration
+        self._guided_targets[uri] = target  # where a go_to ends, the safety monitor does not predict the drone past it
 
-        log_low_freq = LogConfig(name=f'bat_{uri}', period_in_ms=low_frequency_update_interval*1000)
-        log_low_freq.add_variable('pm.vbat', 'float') # Voltage
-        log_low_freq.add_variable('supervisor.info', 'uint16_t') # State
+    def _check_ack(self, uri, state=None, position=None):
+        """Takeoff is confirmed by the flying state, land by leaving it, go_to by reaching the target."""
+        pending = self._pending_acks.get(uri)
+        if pending is None:
+            return
+        command, sent, target = pending
+        if command == "takeoff":
+            confirmed = state == "flying"
+        elif command == "land":
+            confirmed = state is not None and state != "flying"
+        else:
+            confirmed = position is not None and math.dist(position, target) < position_convergence_distance
+        if confirmed:
+            self._ack_latency[command].observe(self.clock.time() - sent)
+            self._pending_acks.pop(uri, None)
 
-        log_high_freq = LogConfig(name=f'pos_{uri}', period_in_ms=high_frequency_update_interval*1000)
-        log_high_freq.add_variable('kalman.stateX', 'float')  # X position
-        log_high_freq.add_variable('kalman.stateY', 'float')  # Y position
-        log_high_freq.add_variable('kalman.stateZ', 'float')  # Altitude
+    def _log_callbacks(self, uri):
+        """Build the (low frequency, high frequency) log callbacks of a drone."""
+        # Metrics are looked up once here, the callbacks only update them
+        metrics = self.metrics
+        status_packets = metrics.counter("telemetry_packets_total", "Log packets received", uri=uri, block="status")
+        position_packets = metrics.counter("telemetry_packets_total", uri=uri, block="position")
+        status_gaps = metrics.histogram("telemetry_gap_seconds", INTERVAL_BUCKETS, "Time between two log packets of a drone",
+                                        uri=uri, block="status")
+        position_gaps = metrics.histogram("telemetry_gap_seconds", INTERVAL_BUCKETS, uri=uri, block="position")
+        status_time = metrics.histogram("log_callback_seconds", CALLBACK_BUCKETS, "Execution time of the log callbacks",
+                                        block="status")
+        position_time = metrics.histogram("log_callback_seconds", CALLBACK_BUCKETS, block="position")
+        estimator = self.estimators[uri]
+        last_arrival = {"status": None, "position": None}
+
+        def _arrival(block, packets, gaps):
+            now = self.clock.time()
+            packets.inc()
+            if last_arrival[block] is not None:
+                gaps.observe(now - last_arrival[block])
+            last_arrival[block] = now
 
-        # Callbacks
         def _supervisor_cb(data):
             info = data.get('supervisor.info')  # raw uint16
             state = self.get_drone_state(uri)  # default state
@@ -65,7 +151,6 @@ class CrazyflieSwarm:
                 pass
             else:
                 # decode bits
-                self._last_state_update_time[uri] = time.time()
                 states = {
                     'can_be_armed': bool(info & (1 << 0)),
                     'is_armed': bool(info & (1 << 1)),
@@ -87,36 +172,64 @@ class CrazyflieSwarm:
                     state = "crashed"
                 else:
                     state = "connected"  # connected but not flying/can_fly/crashed
-            with self.lock:
-                self.state_cache[uri] = state
+                if self.recorder and state != self.get_drone_state(uri):
+                    self.recorder.state_change(uri, state)
+                self.telemetry.publish(uri, state=state, last_state_update=self.clock.time())
+                self._check_ack(uri, state=state)
 
         def _battery_cb(data):
             voltage = data.get('pm.vbat')
             if voltage is None:
                 return default_battery_voltage
-            with self.lock:
-                self.battery_cache[uri] = voltage
+            self.telemetry.publish(uri, battery=voltage)
+            self.batteries.update(uri, self.clock.time(), voltage, self.get_drone_state(uri) == "flying")
+            if voltage < low_battery_in_flight and self.get_drone_state(uri) == "flying" and self.formations.connected_to_formation[uri]:
+                print(f"[WARNING] Low battery detected during flight for {uri}. Initiating landing.")
+                # land_one may replan the formation, not on the link thread
+                self.clock.start_thread(self.land_one, (uri, self.scfs.get(uri), landing_duration))
 
-        def _position_cb(data):
-            x = data.get('kalman.stateX')
-            y = data.get('kalman.stateY')
-            z = data.get('kalman.stateZ')
-            if x is None or y is None or z is None:
+        def _position_cb(ts, position, velocity):
+            if position is None:
                 return
-            self.current_positions[uri] = (x, y, z)
-            # Store position in cache, keeping only last 10 positions
-            with self.lock:
-                self.position_cache[uri].append((x, y, z))
-                if len(self.position_cache[uri]) > position_cache_size:
-                    self.position_cache[uri].pop(0)
+            now = self.clock.time()
+            estimate = estimator.update(ts, position, now, velocity)
+            # Publishes the position and keeps the last position_cache_size positions
+            self.telemetry.publish_position(uri, position, estimate.velocity, now, estimate)
+            self._check_ack(uri, position=position)
 
         def _low_freq_callback(ts, data, logconf):
+            start = time.perf_counter()
+            _arrival("status", status_packets, status_gaps)
+            if self.recorder:
+                self.recorder.record(LOG_STATUS, uri, data.get('pm.vbat', NAN), data.get('supervisor.info', NAN), ts=ts)
             _supervisor_cb(data)
             _battery_cb(data)
+            status_time.observe(time.perf_counter() - start)
 
         def _high_freq_callback(ts, data, logconf):
-            _position_cb(data)     
+            start = time.perf_counter()
+            _arrival("position", position_packets, position_gaps)
+            position, velocity = read_sample(data)  # float or compact int16 block
+            if self.recorder:
+                self.recorder.record(LOG_POSITION, uri, *(position or (NAN, NAN, NAN)), ts=ts)
+            _position_cb(ts, position, velocity)
+            position_time.observe(time.perf_counter() - start)
+
+        return tracer.wrap(_low_freq_callback, "log_status", uri), tracer.wrap(_high_freq_callback, "log_position", uri)
 
+    def _setup_logging(self, uri, scf):
+        """Create Crazyflie log block."""
+        cf = scf.cf
+
+        log_low_freq = LogConfig(name=f'bat_{uri}', period_in_ms=low_frequency_update_interval*1000)
+        for name, kind in STATUS_VARIABLES:  # Voltage and state
+            log_low_freq.add_variable(name, kind)
+
+        log_high_freq = LogConfig(name=f'pos_{uri}', period_in_ms=self.rates.periods[uri])
+        for name, kind in position_variables():  # X, Y position and altitude (and velocity in compact mode)
+            log_high_freq.add_variable(name, kind)
+
+        _low_freq_callback, _high_freq_callback = self._log_callbacks(uri)
         try:
             # Low freq log
             cf.log.add_config(log_low_freq)
@@ -131,31 +244,94 @@ class CrazyflieSwarm:
         except Exception as e:
             print(f"[ERROR] Failed to start logging for {uri}: {e}")
 
+    def _set_position_period(self, uri, period_in_ms):
+        """Change the period of a running position log block."""
+        configs = self._log_configs.get(uri)
+        if configs is None:
+            return
+        log_high_freq = configs[1]
+        try:
+            # start() sends period (10 ms units), which cflib only derives from period_in_ms in the constructor
+            log_high_freq.period_in_ms = period_in_ms
+            log_high_freq.period = int(period_in_ms / 10)
+            log_high_freq.start()  # starting a block that is already running only updates its period
+        except Exception as e:
+            print(f"[ERROR] Could not change the log period of {uri}: {e}")
+
+    def _flight_phase(self, uri, drone, now):
+        """Flight phase used to choose the telemetry rate of a drone."""
+        if self._dynamic_formation_running.get(uri):
+            return "dynamic"
+        pending = self._pending_acks.get(uri)
+        if pending is not None and now - pending[1] < rate_boost_timeout:
+            return "takeoff" if pending[0] == "takeoff" else "transition"
+        return "hover" if drone.state == "flying" else "ground"
+
+    def _adapt_telemetry_rates(self, telemetry):
+        """Move every connected drone's position log rate to its flight phase, within the radio budget."""
+        now = self.clock.time()
+        phases = {uri: self._flight_phase(uri, drone, now) for uri, drone in telemetry.items() if drone.state != "disconnected"}
+        for uri, period in self.rates.update(phases).items():
+            self._set_position_period(uri, period)
+
+    def _open_link(self, uri):
+        scf = SyncCrazyflie(uri, cf=Crazyflie(rw_cache='./cache'))
+        scf.open_link()
+        return scf
+
     def connect_one(self, uri):
         try:
-            scf = SyncCrazyflie(uri, cf=Crazyflie(rw_cache='./cache'))
-            scf.open_link()
+            with tracer.span("open_link", uri):
+                scf = self._open_link(uri)
 
             with self.lock:
                 self.scfs[uri] = scf
 
             # Start telemetry
-            self._setup_logging(uri, scf)
+            with tracer.span("setup_logging", uri):
+                self._setup_logging(uri, scf)
+            self.metrics.counter("connections_total", "Successful link openings (first connection and reconnections)", uri=uri).inc()
+            # The link has to deliver a status packet before the timeout
+            self.watchdog.arm(("link", uri), self.clock.time() + self._connection_timeout, self._link_timeout)
 
             print(f"[OK] Connected to {uri}")
         except Exception as e:
             with self.lock:
                 self.scfs[uri] = None
+            self.watchdog.arm(("reconnect", uri), self.clock.time() + reconnect_attempt_interval, self._reconnect)
+
+    def _link_timeout(self, key, now):
+        """Watchdog callback: declares the link lost if no status packet came within the timeout.
+        Returns the new deadline when telemetry arrived in the meantime."""
+        uri = key[1]
+        drone = self.telemetry.get(uri)
+        deadline = drone.last_state_update + self._connection_timeout
+        if deadline > now:
+            return deadline
+        if drone.state != "disconnected":
+            self.metrics.counter("connection_lost_total", "Links declared lost by the watchdog", uri=uri).inc()
+            if self.recorder:
+                self.recorder.state_change(uri, "disconnected")
+            self.telemetry.publish(uri, state="disconnected", battery=default_battery_voltage)
+            with self.lock:
+                self.scfs[uri] = None
+                self.formations.disconnect_from_formation(uri)
+        self.watchdog.arm(("reconnect", uri), now + reconnect_attempt_interval, self._reconnect)
+
+    def _reconnect(self, key, now):
+        """Watchdog callback: retry a lost link, on its own thread (opening a link takes a while)."""
+        uri = key[1]
+        self.metrics.counter("reconnect_attempts_total", "Reconnection attempts", uri=uri).inc()
+        self.clock.start_thread(self.connect_one, (uri,), daemon=True)
 
     def connect_all(self):
         for uri in self.uris:
-            t = threading.Thread(target=self.connect_one, args=(uri,))
-            t.start()
+            t = self.clock.start_thread(self.connect_one, (uri,))
             self.link_threads[uri] = t
 
         # Wait for all connections
-        for t in self.link_threads.values():
-            t.join()
+        for t in list(self.link_threads.values()):
+            self.clock.join(t)
     def close_links(self):
         for uri, scf in self.scfs.items():
             try:
@@ -164,40 +340,193 @@ class CrazyflieSwarm:
             except Exception as e:
                 print(f"[ERROR] Could not close link to {uri}: {e}")
         print("[INFO] Links closed")
+        if self.exporter:
+            self.exporter.stop()
+        if self.recorder:
+            self.recorder.close()
+        if tracer.enabled:
+            tracer.export(os.path.join(tracing_dir, time.strftime("%Y%m%d_%H%M%S") + ".json"))
+    def start_export(self, rate=export_rate, shared_memory_name=export_shared_memory, udp_targets=export_udp_targets,
+                     reclaim=export_shared_memory_reclaim):
+        """Publish telemetry frames for external visualizers (see telemetry_export.py) until close_links()."""
+        self.exporter = TelemetryExporter(self, rate, shared_memory_name, udp_targets, reclaim)
+        self.exporter.start()
+    # ---------------------------
+    # OPERATOR COMMANDS
+    # ---------------------------
+    def operator_command(self, action, uri=None):
+        """Entry point for operator actions (GUI buttons, show scripts). The action is recorded so replays can repeat it.
+        Per drone actions (takeoff_one, land_one) need the uri. The names of the custom shapes (add_shape) are actions too."""
+        if action not in OPERATOR_ACTIONS and action not in self.formations.shapes:
+            print(f"[ERROR] Unknown operator action: {action}")
+            return
+        if self.recorder:
+            self.recorder.operator(action, uri)
+        # A new operator action releases the drones frozen by the safety monitor
+        if uri is None:
+            self._frozen.clear()
+        else:
+            self._frozen.pop(uri, None)
+        if action == "takeoff_one":
+            self.takeoff_one(uri, self.scfs.get(uri), takeoff_height, takeoff_duration)
+        elif action == "land_one":
+            self.land_one(uri, self.scfs.get(uri), landing_duration)
+        elif action in self.formations.shapes:
+            self.shape_formation(action)
+        else:
+            getattr(self, action)()
+
     # ---------------------------
     # GET DRONE STATES
     # ---------------------------
     def get_drone_state(self, uri):
-        return self.state_cache.get(uri, "disconnected")
+        drone = self.telemetry.get(uri)
+        return drone.state if drone else "disconnected"
     
+    def remaining_flight_time(self, uri):
+        """Predicted seconds of flight before low_battery_in_flight, None if unknown (see battery_model.py)."""
+        return self.batteries.models[uri].remaining_flight_time(self.clock.time())
+
     def get_drone_battery(self, uri):
-        return self.battery_cache.get(uri, default_battery_voltage)
+        drone = self.telemetry.get(uri)
+        return drone.battery if drone else default_battery_voltage
+
+    # Read-only views of the telemetry snapshot, {uri: value}
+    @property
+    def state_cache(self):
+        return {uri: drone.state for uri, drone in self.telemetry.snapshot().items()}
+
+    @property
+    def battery_cache(self):
+        return {uri: drone.battery for uri, drone in self.telemetry.snapshot().items()}
+
+    @property
+    def current_positions(self):
+        return {uri: drone.position for uri, drone in self.telemetry.snapshot().items() if drone.position is not None}
+
+    def predicted_positions(self, now=None):
+        """{uri: (x, y, z)} estimated positions extrapolated to now, fresher than current_positions."""
+        now = self.clock.time() if now is None else now
+        return {uri: predict(drone.estimate, now) for uri, drone in self.telemetry.snapshot().items() if drone.estimate is not None}
+
+    def lock_stats(self):
+        """Contention of the swarm lock and the telemetry write locks. Requires instrument_locks = True."""
+        stats = self.telemetry.lock_stats()
+        if isinstance(self.lock, InstrumentedLock):
+            stats["swarm"] = self.lock.stats()
+        return stats
 
     # ---------------------------
     # SAFETY CHECKS AND COMMANDS
     # ---------------------------
+    def _estimate_arrays(self, telemetry=None):
+        """(positions extrapolated to now, velocities) of all drones as (n, 3) arrays in the order of uris, NaN if unknown."""
+        telemetry = self.telemetry.snapshot() if telemetry is None else telemetry
+        unknown = ((NAN, NAN, NAN), (NAN, NAN, NAN), NAN)
+        estimates = [telemetry[uri].estimate or unknown for uri in self.uris]
+        velocities = np.array([estimate[1] for estimate in estimates], dtype=float)
+        positions = predict_arrays(np.array([estimate[0] for estimate in estimates], dtype=float), velocities,
+                                   np.array([estimate[2] for estimate in estimates], dtype=float), self.clock.time())
+        return positions, velocities
+
+    def _safety_check(self, telemetry):
+        """Predictive geofence and separation check of the whole swarm, acting only on the drones involved."""
+        with tracer.span("safety_check"):
+            drones = [telemetry[uri] for uri in self.uris]
+            positions, velocities = self._estimate_arrays(telemetry)
+            flying = np.array([drone.state == "flying" for drone in drones])
+            # Drones flying a takeoff, land or go_to stop at its end, inside the arena, streamed setpoints were validated:
+            # both are only predicted over safety_guided_horizon, until one full horizon after the end of the command
+            now = self.clock.time() - safety_horizon
+            guided = np.array([self._guided_until.get(uri, 0.0) > now or self._dynamic_formation_running.get(uri, False)
+                               for uri in self.uris])
+            targets = np.array([self._guided_targets.get(uri) or (NAN, NAN, NAN) for uri in self.uris], dtype=float)
+            report = self.safety.check(positions, velocities, flying, guided, self._planned_positions(), targets)
+        for i, exit_time in report.boundary:
+            uri = self.uris[i]
+            if exit_time == 0.0:
+                # Already outside the arena: bring it down
+                if self._pending_acks.get(uri, (None,))[0] != "land":
+                    print(f"[SAFETY] {uri} is outside the boundaries. Landing.")
+                    self.metrics.counter("safety_interventions_total", "Drones landed or frozen by the safety monitor", reason="outside").inc()
+                    self.land_one(uri, self.scfs.get(uri), landing_duration)
+            elif uri not in self._frozen:
+                print(f"[SAFETY] {uri} predicted to leave the boundaries in {exit_time:.2f}s. Freezing.")
+                self.metrics.counter("safety_interventions_total", reason="boundary").inc()
+                self.freeze_one(uri, self.safety.inside(positions[i], boundary_margins))
+        for i, j, closest_time, distance in report.collisions:
+            for k in (i, j):
+                uri = self.uris[k]
+                if flying[k] and uri not in self._frozen:
+                    print(f"[SAFETY] {self.uris[i]} and {self.uris[j]} predicted {distance:.2f}m apart in {closest_time:.2f}s. Freezing {uri}.")
+                    self.metrics.counter("safety_interventions_total", reason="separation").inc()
+                    self.freeze_one(uri, tuple(positions[k].tolist()))
+
+    def _planned_positions(self):
+        """(n, len(safety.sample_times), 3) positions the streamed setpoints lead each drone through over the guided
+        horizon, NaN for the drones not streaming. None when no dynamic formation runs."""
+        streams, start = self._dynamic_streams, self._dynamic_start_time
+        if start is None or not any(self._dynamic_formation_running.values()):
+            return None
+        table = self._dynamic_table
+        if table is None or table.streams is not streams:
+            table = self._dynamic_table = StreamTable(streams, self.uris)
+        # Setpoint k is sent at step k and reached about one step later, the first one is where the transition ended
+        steps = np.maximum((self.clock.time() + self.safety.sample_times - start) / dynamic_waypoint_dt - 1.0, 0.0)
+        first = np.floor(steps).astype(int)
+        waypoints = table.waypoints(np.concatenate((first, first + 1)))[:, :, :3]
+        a, b = waypoints[:, :len(steps)], waypoints[:, len(steps):]
+        planned = a + (steps - first)[None, :, None] * (b - a)
+        planned[[not self._dynamic_formation_running.get(uri) for uri in self.uris]] = np.nan
+        for uri, hold in self._frozen.items():
+            i = self.uris.index(uri)
+            if not np.isnan(planned[i]).any():
+                planned[i] = hold
+        return planned
+
+    def freeze_one(self, uri, position):
+        """Stop a drone at position. Dynamic formations hold it there and formation moves skip it
+        until the next operator action."""
+        self._frozen[uri] = position
+        self.target_positions[uri] = position
+        scf = self.scfs.get(uri)
+        if scf is None or uri in self._killed or self._dynamic_formation_running.get(uri):
+            return  # the setpoint stream sends the hold position, killed drones are not moved
+        try:
+            x, y, z = position
+            scf.cf.high_level_commander.go_to(x, y, z, 0.0, safety_freeze_duration)
+            self._expect_ack(uri, "go_to", position, safety_freeze_duration)
+            if self.recorder:
+                self.recorder.record(GO_TO, uri, x, y, z, safety_freeze_duration)
+        except Exception as e:
+            print(f"[ERROR] Freeze failed for {uri}: {e}")
+
     def position_has_converged(self, uri):
         """Check if the drone's position has converged based on recent position history."""
-        with self.lock:
-            positions = self.position_cache.get(uri, [])
-            if len(positions) < position_cache_size:
-                return False  # Not enough data to determine convergence
-            # Calculate the maximum distance between any two recorded positions
-            max_distance = 0.0
-            for i in range(len(positions)):
-                for j in range(i + 1, len(positions)):
-                    dx = positions[i][0] - positions[j][0]
-                    dy = positions[i][1] - positions[j][1]
-                    dz = positions[i][2] - positions[j][2]
-                    distance = (dx**2 + dy**2 + dz**2)**0.5
-                    if distance > position_convergence_distance:
-                        return False
-            return True
+        # The history is an immutable snapshot, so the scan runs without holding any lock
+        drone = self.telemetry.get(uri)
+        positions = drone.position_history if drone else ()
+        # The position rate changes with the flight phase, look at the last position_convergence_time seconds
+        window = max(1, int(position_convergence_time * 1000 / self.rates.periods[uri]))
+        if len(positions) < window:
+            return False  # Not enough data to determine convergence
+        positions = positions[-window:]
+        # Calculate the maximum distance between any two recorded positions
+        for i in range(len(positions)):
+            for j in range(i + 1, len(positions)):
+                dx = positions[i][0] - positions[j][0]
+                dy = positions[i][1] - positions[j][1]
+                dz = positions[i][2] - positions[j][2]
+                distance = (dx**2 + dy**2 + dz**2)**0.5
+                if distance > position_convergence_distance:
+                    return False
+        return True
     # ---------------------------
     # TAKE OFF
     # ---------------------------
     def takeoff_one(self, uri, scf, height, duration):
         try:
+            self._killed.pop(uri, None)  # taking off again is the only way back after an emergency stop
             if self.get_drone_battery(uri) < low_battery_on_ground:
                 print(f"[WARNING] Battery too low for takeoff: {uri}")
                 return
@@ -209,6 +538,9 @@ class CrazyflieSwarm:
                 return
             hlc = scf.cf.high_level_commander
             hlc.takeoff(height, duration)
+            self._expect_ack(uri, "takeoff", duration=duration)
+            if self.recorder:
+                self.recorder.record(TAKEOFF, uri, height, duration)
             print(f"[TAKEOFF] {uri}")
             self.connect_to_formation(uri)
         except Exception as e:
@@ -219,7 +551,7 @@ class CrazyflieSwarm:
         for uri, scf in self.scfs.items():
             if scf is None:
                 continue
-            threading.Thread(target=self.takeoff_one, args=(uri, scf, height, duration)).start()
+            self.clock.start_thread(self.takeoff_one, (uri, scf, height, duration))
 
     # ---------------------------
     # LAND
@@ -227,9 +559,14 @@ class CrazyflieSwarm:
     def land_one(self, uri, scf, duration):
         try:
             self._dynamic_formation_running[uri] = False
-            if self.get_drone_state(uri) == "flying":
+            self._frozen.pop(uri, None)
+            if self.get_drone_state(uri) == "flying" and uri not in self._killed:
                 hlc = scf.cf.high_level_commander
                 hlc.land(0.0, duration)
+                self._expect_ack(uri, "land", duration=duration)
+                if self.recorder:
+                    self.recorder.record(LAND, uri, duration)
+                self.target_positions.pop(uri, None)
                 self.disconnect_from_formation(uri)
                 print(f"[LAND] {uri}")
         except Exception as e:
@@ -240,24 +577,69 @@ class CrazyflieSwarm:
         for uri, scf in self.scfs.items():
             if scf is None:
                 continue
-            threading.Thread(target=self.land_one, args=(uri, scf, duration)).start()
+            self.clock.start_thread(self.land_one, (uri, scf, duration))
 
     # ---------------------------
     # EMERGENCY LAND (MOTOR KILL)
     # ---------------------------
-    def emergency_one(self, uri, scf):
-        if scf is None:
-            return
-        try:
-            print(f"[EMERGENCY] Stopping motors for {uri}")
-            scf.cf.commander.send_stop_setpoint()  # immediate motor stop
-        except Exception as e:
-            print(f"[ERROR] Emergency stop failed for {uri}: {e}")
+    def _send_emergency_stop(self, uri, scf):
+        """One stop packet (immediate motor stop). MultiProcessSwarm sends it past the command rings."""
+        scf.cf.commander.send_stop_setpoint()
+
+    def emergency_stop(self, uris=None, timeout=emergency_confirm_timeout):
+        """Stop the motors of uris (every connected drone if None) and resend the stop every
+        emergency_retry_interval until their telemetry shows they are not flying anymore.
+        Nothing waits for the dynamic formation threads: they are told to stop and their setpoints
+        are overridden by the retries. Returns {uri: time to kill in seconds, None if never confirmed}
+        for the drones that were flying."""
+        start = self.clock.time()
+        links = {uri: scf for uri, scf in list(self.scfs.items()) if scf is not None and (uris is None or uri in uris)}
+        for uri in links:
+            self._killed[uri] = start
+            self._dynamic_formation_running[uri] = False
+        flying = [uri for uri in links if self.get_drone_state(uri) == "flying"]
+        pending = set(links)
+        first_sent = {}
+        packets = dict.fromkeys(links, 0)
+        kill_times = dict.fromkeys(flying)
+        while pending:
+            now = self.clock.time()
+            for uri in list(pending):
+                drone = self.telemetry.get(uri)
+                if uri in first_sent and (uri not in kill_times or (drone.state != "flying" and drone.last_state_update > first_sent[uri])):
+                    # Drones on the ground get one stop, flying ones until a status packet sent after it confirms
+                    if uri in kill_times:
+                        kill_times[uri] = drone.last_state_update - first_sent[uri]
+                        self._kill_time.observe(kill_times[uri])
+                    pending.discard(uri)
+                    continue
+                try:
+                    self._send_emergency_stop(uri, links[uri])
+                except Exception as e:
+                    print(f"[ERROR] Emergency stop failed for {uri}: {e}")
+                packets[uri] += 1
+                if uri not in first_sent:
+                    first_sent[uri] = now
+                    if self.recorder:
+                        self.recorder.record(STOP, uri)
+            if not pending or now - start >= timeout:
+                break
+            self.clock.sleep(emergency_retry_interval)
+        self.metrics.counter("emergency_stop_packets_total", "Stop packets sent by emergency stops").inc(sum(packets.values()))
+        # The killed drones leave the formation without replanning it for the others
+        with self.lock:
+            for uri in links:
+                self.formations.disconnect_from_formation(uri)
+        for uri, seconds in kill_times.items():
+            if seconds is None:
+                print(f"[EMERGENCY] {uri} still reported flying after {timeout:.1f}s ({packets[uri]} stop packets)")
+            else:
+                print(f"[EMERGENCY] {uri} motors off, confirmed after {1000 * seconds:.0f} ms ({packets[uri]} stop packets)")
+        return kill_times
 
     def emergency_land(self):
-        self._stop_dynamic_formation()
-        for uri, scf in self.scfs.items():
-            threading.Thread(target=self.emergency_one, args=(uri, scf)).start()
+        """Operator action: emergency_stop() for every drone, without blocking the caller."""
+        self.clock.start_thread(self.emergency_stop, daemon=True)
 
     ## ---------------------------
     # SAFE SHUTDOWN
@@ -266,32 +648,35 @@ class CrazyflieSwarm:
         """Stop update loop, stop and remove any active LogConfig callbacks and join threads.
         This will stop logging callbacks from running.
         """
-        # stop main update loop
+        # stop main update loop and the watchdog
         self.running = False
+        self.watchdog.stop()
+        self.watchdog.join(timeout)
         try:
             if getattr(self, "thread", None) is not None and self.thread.is_alive():
-                self.thread.join(timeout=timeout)
+                self.clock.join(self.thread, timeout=timeout)
         except Exception:
             pass
 
         # stop and remove any LogConfig objects (stop callbacks/background logging)
         with self.lock:
-            for uri, log in list(self._log_configs.items()):
-                try:
-                    # stop the LogConfig's internal timer/worker
+            for uri, logs in list(self._log_configs.items()):
+                for log in logs:
                     try:
-                        log.stop()
-                    except Exception:
-                        pass
-                    # if we still have an open SyncCrazyflie for this uri, remove the config
-                    scf = self.scfs.get(uri)
-                    if scf and hasattr(scf, "cf") and hasattr(scf.cf, "log"):
+                        # stop the LogConfig's internal timer/worker
                         try:
-                            scf.cf.log.remove_config(log)
+                            log.stop()
                         except Exception:
                             pass
-                except Exception:
-                    pass
+                        # if we still have an open SyncCrazyflie for this uri, remove the config
+                        scf = self.scfs.get(uri)
+                        if scf and hasattr(scf, "cf") and hasattr(scf.cf, "log"):
+                            try:
+                                scf.cf.log.remove_config(log)
+                            except Exception:
+                                pass
+                    except Exception:
+                        pass
             # clear references so callbacks can be GC'd
             self._log_configs.clear()
 
@@ -299,18 +684,26 @@ class CrazyflieSwarm:
         for uri, t in list(self.link_threads.items()):
             try:
                 if t is not None and t.is_alive():
-                    t.join(timeout=closing_threads_timeout)
+                    self.clock.join(t, timeout=closing_threads_timeout)
             except Exception:
                 pass
 
         print("[INFO] Swarm background stopped and logging disabled")
     
-    def forced_stop_flying(self):
-        """Lands all drones that are currently flying, then issues emergency stop if they have not landed."""
+    def forced_stop_flying(self, timeout=landing_duration + forced_stop_grace):
+        """Lands all drones that are currently flying, then stops the motors of those that have not
+        landed within timeout. Needs the telemetry, call it before stop_background()."""
+        if "flying" not in self.state_cache.values():
+            return {}
         self.land(duration=landing_duration)
-        time.sleep(3.0)  # wait a moment before emergency stop
-        if any(self.scfs.state_cache[uri] == "flying" for uri in self.uris):
-            self.emergency_land()
+        deadline = self.clock.time() + timeout
+        while self.clock.time() < deadline and "flying" in self.state_cache.values():
+            self.clock.sleep(emergency_retry_interval)
+        flying = [uri for uri, state in self.state_cache.items() if state == "flying"]
+        if not flying:
+            return {}
+        print(f"[EMERGENCY] {len(flying)} drone(s) did not land, stopping their motors")
+        return self.emergency_stop(flying)
 
     ## ---------------------------
     # FORMATION COMMANDS
@@ -319,34 +712,53 @@ class CrazyflieSwarm:
         """Stop any running dynamic formation thread."""
         self._dynamic_formation_running = {uri: False for uri in self.uris}
         if self._dynamic_formation_thread is not None:
-            self._dynamic_formation_thread.join(timeout=2.0)
+            self.clock.join(self._dynamic_formation_thread, timeout=2.0)
     
-    def send_formation(self, target_formation, duration=formation_transition_duration):
-        """Sends position commands to all drones to move to the specified positions over the given duration."""
-        # Stop any running dynamic formation
-        self._stop_dynamic_formation()
-        
-        if self.current_positions is not None and self.state_cache == "flying":
+    def _transition_plan(self, target_formation):
+        """(current positions, [positions of every go_to step]) that take the drones into target_formation."""
+        # Fresh estimates of the drones of the formation (the others are not moved)
+        predicted = self.predicted_positions()
+        current_positions = {uri: predicted[uri] for uri in target_formation if uri in predicted}
+        if current_positions and "flying" in self.state_cache.values():
             # Check for potential collisions
-            if self.formations.positions_intersect(self.current_positions, target_formation, threshold=collision_threshold):
-                transition_positions = self.formations.get_transition_positions(self.current_positions, target_formation)
+            with tracer.span("positions_intersect"):
+                intersect = self.formations.positions_intersect(current_positions, target_formation, threshold=collision_threshold)
+            if intersect:
+                with tracer.span("transition_positions"):
+                    transition_positions = self.formations.get_transition_positions(current_positions, target_formation)
             else:
                 transition_positions = [target_formation]
         else:
             transition_positions = [target_formation]
-        for transition_step in transition_positions:
-            for uri, scf in self.scfs.items():
-                if scf is None or uri not in transition_step:
-                    continue
-                x, y, z = transition_step[uri]
-                try:
-                    hlc = scf.cf.high_level_commander
-                    hlc.go_to(x, y, z, 0.0, duration)
-                    print(f"[FORMATION] {uri} moving to ({x}, {y}, {z})")
-                except Exception as e:
-                    print(f"[ERROR] Formation command failed for {uri}: {e}")
-            # Wait for this transition to complete before moving to the next one
-            time.sleep(duration)
+        return current_positions, transition_positions
+
+    def send_formation(self, target_formation, duration=formation_transition_duration, transition_positions=None):
+        """Sends position commands to all drones to move to the specified positions over the given duration.
+        transition_positions are the go_to steps to get there, planned here if not given."""
+        # Stop any running dynamic formation
+        self._stop_dynamic_formation()
+        if transition_positions is None:
+            _, transition_positions = self._transition_plan(target_formation)
+        # Swap the whole dict so readers (GUI) never see a half updated formation
+        self.target_positions = dict(target_formation)
+        for step, transition_step in enumerate(transition_positions):
+            with tracer.span("send_formation_step", step=step, steps=len(transition_positions)):
+                for uri, scf in self.scfs.items():
+                    if scf is None or uri not in transition_step or uri in self._frozen or uri in self._killed:
+                        continue
+                    x, y, z = transition_step[uri]
+                    try:
+                        with tracer.span("go_to", uri):
+                            hlc = scf.cf.high_level_commander
+                            hlc.go_to(x, y, z, 0.0, duration)
+                        self._expect_ack(uri, "go_to", (x, y, z), duration)
+                        if self.recorder:
+                            self.recorder.record(GO_TO, uri, x, y, z, duration)
+                        print(f"[FORMATION] {uri} moving to ({x}, {y}, {z})")
+                    except Exception as e:
+                        print(f"[ERROR] Formation command failed for {uri}: {e}")
+                # Wait for this transition to complete before moving to the next one
+                self.clock.sleep(duration)
 
     def send_dynamic_formation(self, trajectories: dict[str, list], waypoint_dt): # dict of {uri: list[waypoints]}
         """Uploads and loops trajectory for each drone until interrupted. It assumes the drones are already in the starting positions.
@@ -357,41 +769,150 @@ class CrazyflieSwarm:
             waypoint_dt: time interval between waypoints in seconds
         """
         self._dynamic_formation_running = {uri: True for uri in self.uris}
-        
+        # The threads read their waypoints from the streams, so a morph can swap them without stopping anything
+        self._dynamic_streams = {uri: Stream(sequence) for uri, sequence in trajectories.items()}
+
+        # Optional reactive avoidance between the trajectories and the setpoints
+        avoidance = ReciprocalAvoidance(self.uris, trajectories, waypoint_dt, self._estimate_arrays,
+                                        waypoint=self._dynamic_setpoint) if avoidance_enabled else None
+
         # Shared clock
-        start_time = time.time()
+        start_time = self.clock.time()
+        self._dynamic_start_time = start_time
         
-        def run_sequence(uri, cf, sequence, start_time):
-            i = 0
-            while self._dynamic_formation_running[uri] and self.running:
+        def run_sequence(uri, cf, start_time):
+            step = 0  # waypoints sent so far, keeps counting when the sequence loops
+            while self._dynamic_formation_running[uri] and self.running and uri not in self._killed:
                 # Calculate target time for this waypoint based on shared clock
-                target_time = start_time + (i + 1) * waypoint_dt
+                target_time = start_time + (step + 1) * waypoint_dt
                 
-                # Send position command
-                position = sequence[i]
+                # Send position command, or hold the drone where the safety monitor froze it
+                hold = self._frozen.get(uri)
+                if hold is not None:
+                    position = hold + (0.0,)
+                elif avoidance is not None:
+                    with tracer.span("avoidance", uri):
+                        position = avoidance.setpoint(uri, step)
+                else:
+                    position = self._dynamic_setpoint(uri, step)
                 cf.commander.send_position_setpoint(position[0],
                                                     position[1],
                                                     position[2],
                                                     position[3])
-                i = (i + 1) % len(sequence)
+                self.target_positions[uri] = (position[0], position[1], position[2])
+                self._setpoint_lateness.observe(self.clock.time() - (start_time + step * waypoint_dt))
+                if self.recorder:
+                    self.recorder.record(SETPOINT, uri, *position[:4])
+                step += 1
                 
                 # Sleep until target time to maintain synchronization
-                sleep_time = target_time - time.time()
+                sleep_time = target_time - self.clock.time()
                 if sleep_time > 0:
-                    time.sleep(sleep_time)
+                    self.clock.sleep(sleep_time)
                 # If we're behind schedule (sleep_time <= 0), continue immediately
-                
+
+            if uri in self._killed:
+                return  # motors stopped by emergency_stop(), handing over to the high level commander could hold it in the air
             cf.commander.send_stop_setpoint()
+            if self.recorder:
+                self.recorder.record(STOP, uri)
             # Hand control over to the high level commander to avoid timeout and locking of the Crazyflie
             cf.commander.send_notify_setpoint_stop()
         
         for uri, scf in self.scfs.items():
             if scf is None or uri not in trajectories:
                 continue
-            sequence = trajectories[uri]
             cf = scf.cf
-            self._dynamic_formation_thread = threading.Thread(target=run_sequence, args=(uri, cf, sequence, start_time))
-            self._dynamic_formation_thread.start()
+            self._dynamic_formation_thread = self.clock.start_thread(run_sequence, (uri, cf, start_time))
+
+    def _dynamic_setpoint(self, uri, step):
+        """Waypoint `step` of a drone of the running dynamic formation."""
+        return self._dynamic_streams[uri].waypoint(step)
+
+    def _stretch_period(self, formation_type, period, peak_speed):
+        """Period of formation_type slow enough for dynamic_max_speed, on the waypoint grid, and its (start positions, trajectories)."""
+        # Same shape, slower: the clearance and boundaries of the cyclic part do not change with the period
+        period *= peak_speed / dynamic_max_speed
+        period = math.ceil(period / dynamic_waypoint_dt) * dynamic_waypoint_dt
+        print(f"[SAFETY] {formation_type} needs {peak_speed:.2f} m/s, stretching its period to {period:.1f}s")
+        return (period,) + self.formations.get_dynamic_formation_positions(formation_type, period)
+
+    def _morph_dynamic_formation(self, formation_type, period, trajectories):
+        """Blends the running dynamic formation into trajectories over dynamic_morph_duration (see morph.py), the setpoint
+        threads keep streaming. Returns False, changing nothing, when no dynamic formation of the same drones is running
+        or the blend is not safe."""
+        streaming = {uri for uri, running in self._dynamic_formation_running.items() if running}
+        if not streaming or streaming != set(trajectories) or self._frozen or self._dynamic_start_time is None:
+            return False
+        telemetry = self.telemetry.snapshot()
+        obstacles = {uri: position for uri, position in self.predicted_positions().items()
+                     if uri not in trajectories and telemetry[uri].state == "flying"}
+        with tracer.span("plan_morph", drones=len(trajectories)):
+            for attempt in range(2):
+                # Two steps ahead of the threads: the streams are swapped before any of them gets there
+                switch_step = int((self.clock.time() - self._dynamic_start_time) / dynamic_waypoint_dt) + 2
+                morph = plan_morph(self._dynamic_setpoint, trajectories, switch_step, dynamic_waypoint_dt, dynamic_morph_duration)
+                # The blend samples are the transition steps, one waypoint each
+                report = self.validator.validate(morph.trajectories, dynamic_waypoint_dt, morph.steps, dynamic_waypoint_dt, obstacles)
+                if attempt or report.peak_speed <= dynamic_max_speed:
+                    break
+                period, _, trajectories = self._stretch_period(formation_type, period, report.peak_speed)
+        if not self.validator.is_safe(report):
+            print(f"[SAFETY] morph into {formation_type} rejected: {report.pair[0]} and {report.pair[1]} {report.clearance:.2f}m apart "
+                  f"at {report.clearance_time:.1f}s, {report.boundary_uri} {report.boundary_margin:.2f}m from the boundaries, "
+                  f"going through a transition")
+            return False
+        if self.clock.time() > self._dynamic_start_time + (switch_step - 0.5) * dynamic_waypoint_dt:
+            print(f"[FORMATION] morph into {formation_type} planned too late, going through a transition")
+            return False
+        self._dynamic_streams = {uri: stream.then(switch_step, morph.prefixes[uri], morph.trajectories[uri])
+                                 for uri, stream in self._dynamic_streams.items()}
+        print(f"[FORMATION] morphing into {formation_type} over {morph.duration:.1f}s: clearance {report.clearance:.2f}m, "
+              f"boundary margin {report.boundary_margin:.2f}m")
+        return True
+
+    def start_dynamic_formation(self, formation_type, period):
+        """Validates a dynamic formation over its transition and one full period, then flies it.
+        Periods asking for more than dynamic_max_speed are stretched, unsafe formations are rejected.
+        A running dynamic formation of the same drones is morphed into the new one when the blend is safe.
+        Returns True if the formation was started."""
+        start_positions, trajectories = self.formations.get_dynamic_formation_positions(formation_type, period)
+        if dynamic_morph_duration > 0 and self._morph_dynamic_formation(formation_type, period, trajectories):
+            return True
+        with tracer.span("validate_trajectories", drones=len(trajectories)):
+            current_positions, transition = self._transition_plan(start_positions)
+            telemetry = self.telemetry.snapshot()
+            predicted = self.predicted_positions()
+            obstacles = {uri: position for uri, position in predicted.items()
+                         if uri not in trajectories and telemetry[uri].state == "flying"}
+            # Drones still on the ground are not moved by the transition
+            steps = [current_positions] + transition if "flying" in self.state_cache.values() else []
+            report = self.validator.validate(trajectories, dynamic_waypoint_dt, steps, formation_transition_duration, obstacles)
+            if report.peak_speed > dynamic_max_speed:
+                period, start_positions, trajectories = self._stretch_period(formation_type, period, report.peak_speed)
+                report = self.validator.validate(trajectories, dynamic_waypoint_dt, steps, formation_transition_duration, obstacles)
+        if not self.validator.is_safe(report):
+            phase = "transition" if report.clearance_time < report.loop_start else "trajectory"
+            print(f"[SAFETY] {formation_type} rejected: {report.pair[0]} and {report.pair[1]} {report.clearance:.2f}m apart "
+                  f"at {report.clearance_time:.1f}s ({phase}), {report.boundary_uri} {report.boundary_margin:.2f}m from the boundaries "
+                  f"at {report.boundary_time:.1f}s")
+            self.metrics.counter("safety_interventions_total", reason="trajectory_rejected").inc()
+            return False
+        print(f"[FORMATION] {formation_type} validated: clearance {report.clearance:.2f}m, boundary margin {report.boundary_margin:.2f}m")
+        self.send_formation(start_positions, transition_positions=transition)
+        self.send_dynamic_formation(trajectories, dynamic_waypoint_dt)
+        return True
+
+    def fly_planned(self, formation_type, transition_positions, trajectories=None):
+        """Fly a formation planned ahead of time (see show_compiler.py): the go_to steps of its transition, then the
+        setpoints of a dynamic formation. Nothing is computed here. Recorded as the operator action it replaces."""
+        if self.recorder:
+            self.recorder.operator(formation_type)
+        self._frozen.clear()
+        self.current_formation = formation_type
+        self.send_formation(transition_positions[-1], transition_positions=transition_positions)
+        if trajectories:
+            self.send_dynamic_formation(trajectories, dynamic_waypoint_dt)
 
     # Send specific formations
     def recalculate_current_formation(self):
@@ -399,21 +920,28 @@ class CrazyflieSwarm:
             "flat_square": self.flat_square,
             "circle": self.circle,
             "tilted_plane": self.tilted_plane,
+            "cube_lattice": self.cube_lattice,
+            "hcp_lattice": self.hcp_lattice,
+            "stacked_rings": self.stacked_rings,
+            "sphere_shell": self.sphere_shell,
             "moving_circle": self.moving_circle,
             "sin_wave": self.sin_wave
         }
         if self.current_formation in formation_methods:
             formation_methods[self.current_formation]()
+        elif self.current_formation in self.formations.shapes:
+            self.shape_formation(self.current_formation)
         else:
             print(f"[ERROR] Unknown formation name: {self.current_formation}")
 
     def connect_to_formation(self, uri):
         self.formations.connect_to_formation(uri)
-        self.recalculate_current_formation()
+        if self.recalculate_formations:
+            self.recalculate_current_formation()
 
     def disconnect_from_formation(self, uri):
         self.formations.disconnect_from_formation(uri)
-        if self.formations.n_connected_drones > 0:
+        if self.recalculate_formations and self.formations.n_connected_drones > 0:
             self.recalculate_current_formation()
 
     # ---------------------------
@@ -435,51 +963,64 @@ class CrazyflieSwarm:
         self.current_formation = "tilted_plane"
         new_formation = self.formations.get_formation_positions("tilted_plane")
         self.send_formation(new_formation)
+    # Volumetric and custom shape formations
+    def static_formation(self, formation_type):
+        print(f"[FORMATION] {formation_type} command issued")
+        try:
+            new_formation = self.formations.get_formation_positions(formation_type)
+        except ValueError as e:
+            print(f"[ERROR] {e}")
+            return
+        self.current_formation = formation_type
+        self.send_formation(new_formation)
+    def cube_lattice(self):
+        self.static_formation("cube_lattice")
+    def hcp_lattice(self):
+        self.static_formation("hcp_lattice")
+    def stacked_rings(self):
+        self.static_formation("stacked_rings")
+    def sphere_shell(self):
+        self.static_formation("sphere_shell")
+    def add_shape(self, name, shape):
+        """Make a custom shape (shapes.py) available to shape_formation(name) and as the operator action name."""
+        if name in OPERATOR_ACTIONS:
+            raise ValueError(f"{name} is already an operator action.")
+        self.formations.add_shape(name, shape)
+        if self.recorder:
+            self.recorder.add_action(name)
+    def shape_formation(self, name):
+        if name not in self.formations.shapes:
+            print(f"[ERROR] Unknown shape: {name}")
+            return
+        self.static_formation(name)
     # Dynamic formations
     def moving_circle(self):
         print("[FORMATION] Moving Circle command issued")
-        self.current_formation = "moving_circle"
-        initial_positions, trajectories = self.formations.get_dynamic_formation_positions("moving_circle", circle_rotation_period)
-        self.send_formation(initial_positions)
-        self.send_dynamic_formation(trajectories, dynamic_waypoint_dt)
+        if self.start_dynamic_formation("moving_circle", circle_rotation_period):
+            self.current_formation = "moving_circle"
     def sin_wave(self):
         print("[FORMATION] Sine Wave command issued")
-        self.current_formation = "sin_wave"
-        initial_formation, trajectories = self.formations.get_dynamic_formation_positions("sin_wave", sin_wave_period)
-        self.send_formation(initial_formation)
-        print(trajectories)
-        self.send_dynamic_formation(trajectories, dynamic_waypoint_dt)
+        if self.start_dynamic_formation("sin_wave", sin_wave_period):
+            self.current_formation = "sin_wave"
     ## ---------------------------
     # MAIN UPDATE LOOP
     ## ---------------------------
     def run(self):
-        """Starts the swarm update loop in a separate thread."""
+        """Starts the swarm update loop and the watchdog in separate threads."""
         self.running = True
-        self.thread = threading.Thread(target=self._update_loop, daemon=True)
-        self.thread.start()
+        self.watchdog.start()
+        self.thread = self.clock.start_thread(self._update_loop, daemon=True)
         print("[INFO] Swarm update loop started")
 
     def _update_loop(self):
-        # Periodic data update
-        last_connection_check = time.time()
-        connection_check_interval = reconnect_attempt_interval  # seconds
+        # Link losses, reconnections and low batteries are handled when they happen (watchdog and
+        # log callbacks), the loop only runs the checks that need the whole swarm at once
         while self.running:
-            # For all drones, perform manager checks
-            for uri in self.uris:
-                state = self.get_drone_state(uri)
-                if state != "disconnected": # If connected, monitor connection state
-                    current_time = time.time()
-                    if current_time - self._last_state_update_time[uri] > factor_connection_lost * low_frequency_update_interval:
-                        with self.lock:
-                            self.state_cache[uri] = "disconnected"
-                            self.scfs[uri] = None
-                            self.formations.disconnect_from_formation(uri)
-                            self.battery_cache[uri] = default_battery_voltage
-                    if state == "flying" and self.battery_cache[uri] < low_battery_in_flight and self.formations.connected_to_formation[uri]:
-                        print(f"[WARNING] Low battery detected during flight for {uri}. Initiating landing.")
-                        self.land_one(uri, self.scfs[uri], duration=landing_duration)
-                else: # Disconnected drone, attempt reconnection periodically
-                    if time.time() - last_connection_check > connection_check_interval:
-                        self.connect_one(uri)
-                        last_connection_check = time.time()
-            time.sleep(swarm_loop_interval)  # avoid busy-waiting
\ No newline at end of file
+            iteration_start = time.perf_counter()
+            # One snapshot per iteration, the callbacks keep publishing while we check
+            telemetry = self.telemetry.snapshot()
+            if safety_monitor_enabled:
+                self._safety_check(telemetry)
+            self._adapt_telemetry_rates(telemetry)
+            self._update_loop_time.observe(time.perf_counter() - iteration_start)
+            self.clock.sleep(swarm_loop_interval)  # avoid busy-waiting
\ No newline at end of file
@@ -0,0 +1,184 @@
+import json
+import os
+import struct
+import threading
+from collections import deque
+
+import numpy as np
+
+from clock import SystemClock
+from config import flight_recorder_flush_interval
+
+# Record kinds
+LOG_POSITION = 0  # v = (x, y, z, nan), ts = log timestamp
+LOG_STATUS = 1    # v = (vbat, supervisor.info, nan, nan), ts = log timestamp
+GO_TO = 2         # v = (x, y, z, duration)
+SETPOINT = 3      # v = (x, y, z, yaw)
+TAKEOFF = 4       # v = (height, duration, nan, nan)
+LAND = 5          # v = (duration, nan, nan, nan)
+STOP = 6          # v = (nan, nan, nan, nan)
+STATE = 7         # v = (index in STATES, nan, nan, nan)
+OPERATOR = 8      # v = (index in the operator_actions of the header, nan, nan, nan), drone = SWARM for swarm wide actions
+KINDS = ("log_position", "log_status", "go_to", "setpoint", "takeoff", "land", "stop", "state", "operator")
+COMMAND_KINDS = (GO_TO, SETPOINT, TAKEOFF, LAND, STOP)
+
+STATES = ("idle", "connecting", "connected", "disconnected", "flying", "hovering", "landing", "crashed", "charging", "error")
+OPERATOR_ACTIONS = ("takeoff", "land", "emergency_land", "flat_square", "circle", "tilted_plane", "moving_circle", "sin_wave",
+                    "takeoff_one", "land_one", "cube_lattice", "hcp_lattice", "stacked_rings", "sphere_shell")
+SWARM = 0xFFFF  # drone index of records that concern the whole swarm
+HEADER_RESERVE = 1024  # bytes left free in the header for the custom shapes added during the flight
+
+MAGIC = b"UWBREC01"
+# Fixed 32 byte record: host time, log ts, kind, padding, drone index, 4 values
+RECORD = struct.Struct("<dIBxH4f")
+RECORD_DTYPE = np.dtype([("t", "<f8"), ("ts", "<u4"), ("kind", "u1"), ("pad", "u1"), ("drone", "<u2"), ("v", "<f4", (4,))])
+NAN = float("nan")
+
+
+class FlightRecorder:
+    '''Append-only binary recorder of the telemetry, commands and state changes of a flight.
+
+    record() only appends a tuple to a deque (a few hundred nanoseconds), so it can be
+    called from the log callbacks. A background thread packs the pending records into
+    fixed 32 byte records and appends them to the session file.
+
+    File layout: MAGIC, uint32 header length, JSON header (uris, kinds, states, operator actions),
+    padding up to a multiple of the record size, then the records. The header has HEADER_RESERVE
+    bytes of trailing spaces, so that the custom shapes added during the flight (add_action) are
+    appended to its operator actions in place.
+
+    Records are stamped with the clock of the swarm, so that a simulated flight on a virtual
+    clock is recorded on the same time line as it flew, and replays like a real one.
+    '''
+    def __init__(self, uris, path, flush_interval=flight_recorder_flush_interval, clock=None):
+        self.uris = list(uris)
+        self.path = path
+        self.clock = clock if clock is not None else SystemClock()
+        self._index = {uri: i for i, uri in enumerate(self.uris)}
+        self.actions = list(OPERATOR_ACTIONS)  # operator actions of the header, custom shapes added at the end
+        self.start_time = self.clock.time()
+        self._header_length = None
+        self._file_lock = threading.Lock()
+        self._pending = deque()
+        self._stop = threading.Event()
+        self.flush_interval = flush_interval
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "wb")
+        self._write_header()
+        self._thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._thread.start()
+        print(f"[INFO] Recording flight to {path}")
+
+    def _write_header(self):
+        header = json.dumps({
+            "version": 1,
+            "start_time": self.start_time,
+            "uris": self.uris,
+            "kinds": KINDS,
+            "states": STATES,
+            "operator_actions": self.actions,
+            "record_format": RECORD.format,
+        }).encode()
+        if self._header_length is None:
+            self._header_length = len(header) + HEADER_RESERVE
+            length = len(MAGIC) + 4 + self._header_length
+            padding = -length % RECORD.size
+            self._file.write(MAGIC + struct.pack("<I", self._header_length) + header.ljust(self._header_length) + b" " * padding)
+        else:
+            # Rewritten in place, the records after it do not move
+            if len(header) > self._header_length:
+                raise ValueError(f"No room left in the header of {self.path}")
+            self._file.seek(len(MAGIC) + 4)
+            self._file.write(header.ljust(self._header_length))
+            self._file.seek(0, os.SEEK_END)
+        self._file.flush()
+
+    def add_action(self, name):
+        """Make a custom shape formation recordable as an operator action, its name is added to the header."""
+        with self._file_lock:
+            if name in self.actions or self._file.closed:
+                return
+            self.actions.append(name)
+            try:
+                self._write_header()
+            except ValueError:
+                self.actions.pop()
+                raise
+
+    # ---------------------------
+    # HOT PATH
+    # ---------------------------
+    def record(self, kind, uri, a=NAN, b=NAN, c=NAN, d=NAN, ts=0):
+        self._pending.append((self.clock.time(), ts, kind, self._index[uri], a, b, c, d))
+
+    def state_change(self, uri, state):
+        self.record(STATE, uri, STATES.index(state) if state in STATES else NAN)
+
+    def operator(self, action, uri=None):
+        drone = SWARM if uri is None else self._index[uri]
+        self._pending.append((self.clock.time(), 0, OPERATOR, drone, self.actions.index(action), NAN, NAN, NAN))
+
+    # ---------------------------
+    # BACKGROUND WRITER
+    # ---------------------------
+    def _drain(self):
+        pending = self._pending
+        chunk = []
+        pack = RECORD.pack
+        while pending:
+            chunk.append(pack(*pending.popleft()))
+        if chunk:
+            with self._file_lock:
+                self._file.write(b"".join(chunk))
+                self._file.flush()
+
+    def _writer_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self._drain()
+
+    def close(self):
+        """Stop the writer thread and write everything that is still pending."""
+        if self._file.closed:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._drain()
+        with self._file_lock:
+            self._file.close()
+        print(f"[INFO] Flight recording saved to {self.path}")
+
+
+class FlightSession:
+    '''Recorded flight loaded as a memory-mapped NumPy structured array (no copy).
+
+    records fields: t (host time), ts (log timestamp), kind, drone (index in uris), v (4 values).
+    '''
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a flight recording.")
+            (header_length,) = struct.unpack("<I", f.read(4))
+            self.header = json.loads(f.read(header_length))
+        offset = len(MAGIC) + 4 + header_length
+        offset += -offset % RECORD.size
+        # A recording cut short by a crash can end in a partial record, ignore it
+        n_records = (os.path.getsize(path) - offset) // RECORD.size
+        self.uris = self.header["uris"]
+        if n_records > 0:
+            self.records = np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=offset, shape=(n_records,))
+        else:
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+
+    def of_kind(self, kind, uri=None):
+        """Records of one kind, optionally of a single drone."""
+        mask = self.records["kind"] == kind
+        if uri is not None:
+            mask &= self.records["drone"] == self.uris.index(uri)
+        return self.records[mask]
+
+
+def load_session(path):
+    return FlightSession(path)
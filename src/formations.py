@@ -1,9 +1,12 @@
 from config import absolute_boundaries, drone_spacing
-import matplotlib.pyplot as plt
 import math
+import numpy as np
 
 from config import *
 from cflib.crazyflie.mem.trajectory_memory import Poly4D
+from shapes import fill_shape
+
+VOLUMETRIC_FORMATIONS = ("cube_lattice", "hcp_lattice", "stacked_rings", "sphere_shell")
 
 class FormationCalculator:
     def __init__(self, spacing=drone_spacing, x_boundaries=absolute_boundaries["x"], y_boundaries=absolute_boundaries["y"], z_boundaries=absolute_boundaries["z"]):
@@ -15,6 +18,7 @@ class FormationCalculator:
         }
 
     def plot_formation(self, position_sets: list[dict[str, tuple[float, float, float]]]):
+        import matplotlib.pyplot as plt  # only needed to plot, headless runs never import it
         fig = plt.figure()
         ax = fig.add_subplot(111, projection='3d')
         sets = []
@@ -186,7 +190,188 @@ class FormationCalculator:
             z = (self.boundaries["z"][1] - self.boundaries["z"][0]) / 2 # circle formation at the middle of the z boundaries
             positions[drone] = (x, y, z)
         return positions
-    
+
+    # ---------------------------
+    # VOLUMETRIC FORMATIONS
+    # ---------------------------
+    # They fill the boundaries minus boundary_margins. A swarm smaller than what the volume holds
+    # gets the largest spacing it fits at, so it spreads over the whole volume instead of a corner.
+    def _volume(self):
+        """(low, high) corners of the volume the drones are placed in."""
+        low = np.array([self.boundaries[axis][0] for axis in "xyz"], dtype=float) + boundary_margins
+        high = np.array([self.boundaries[axis][1] for axis in "xyz"], dtype=float) - boundary_margins
+        return low, high
+
+    @staticmethod
+    def _centered(points, low, high):
+        """points shifted so their bounding box is centered in the volume."""
+        if len(points) == 0:
+            return points
+        return points + (low + high - points.min(axis=0) - points.max(axis=0)) / 2
+
+    def _cube_points(self, spacing):
+        """Every point of a cubic lattice of the given spacing that fits in the volume."""
+        low, high = self._volume()
+        axes = [spacing * np.arange(int((high[i] - low[i]) / spacing + 1e-9) + 1) for i in range(3)]
+        points = np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1).reshape(-1, 3)
+        points = points[(points <= high - low + 1e-9).all(axis=1)]
+        return self._centered(points, low, high)
+
+    def _hcp_points(self, spacing):
+        """Every point of a hexagonal close-packed lattice (ABAB layers) of the given spacing that fits in the volume."""
+        low, high = self._volume()
+        extent = high - low
+        row = spacing * math.sqrt(3) / 2  # between two rows of a layer
+        layer = spacing * math.sqrt(2 / 3)  # between two layers
+        i, j, k = np.meshgrid(np.arange(int(extent[0] / spacing + 1e-9) + 1),
+                              np.arange(int(extent[1] / row + 1e-9) + 1),
+                              np.arange(int(extent[2] / layer + 1e-9) + 1), indexing="ij")
+        # Odd rows shift by half a spacing, B layers sit over the centers of the A triangles
+        x = spacing * (i + (j % 2) / 2 + (k % 2) / 2)
+        y = row * (j + (k % 2) / 3)
+        points = np.stack([x, y, layer * k], axis=-1).reshape(-1, 3)
+        points = points[(points <= extent + 1e-9).all(axis=1)]
+        return self._centered(points, low, high)
+
+    def _ring_slots(self, spacing):
+        """(z, radius, capacity) arrays of the rings of a stack: one layer every spacing in z, concentric
+        rings every spacing inwards, in fill order (outer rings first, then the layers closest to mid-height)."""
+        low, high = self._volume()
+        outer = min(high[0] - low[0], high[1] - low[1]) / 2
+        if outer < 0 or high[2] < low[2]:
+            return np.empty(0), np.empty(0), np.empty(0, dtype=int)
+        zs = np.arange(int((high[2] - low[2]) / spacing + 1e-9) + 1) * spacing
+        zs += (low[2] + high[2] - zs[-1]) / 2
+        radii = outer - spacing * np.arange(int(outer / spacing + 1e-9) + 1)
+        radii[radii < spacing / 2] = 0.0  # what is left in the middle holds one drone
+        radii = np.unique(radii)[::-1]
+        with np.errstate(divide="ignore"):
+            capacity = np.where(radii > 0, np.floor(math.pi / np.arcsin(np.minimum(spacing / (2 * radii), 1.0)) + 1e-9), 1)
+        ring, level = np.meshgrid(np.arange(len(radii)), np.arange(len(zs)), indexing="ij")
+        ring, level = ring.ravel(), level.ravel()
+        order = np.lexsort((level, np.abs(zs[level] - (low[2] + high[2]) / 2), ring))
+        return zs[level[order]], radii[ring[order]], capacity[ring[order]].astype(int)
+
+    def _sphere_points(self, n_drones):
+        """n_drones on a Fibonacci sphere as large as the volume allows."""
+        low, high = self._volume()
+        i = np.arange(n_drones) + 0.5
+        z = 1 - 2 * i / n_drones
+        r = np.sqrt(1 - z * z)
+        theta = math.pi * (1 + math.sqrt(5)) * i
+        unit = np.stack([r * np.cos(theta), r * np.sin(theta), z], axis=-1)
+        return (low + high) / 2 + max(np.min(high - low), 0.0) / 2 * unit
+
+    @staticmethod
+    def _min_distance(points):
+        if len(points) < 2:
+            return math.inf
+        d = points[:, None, :] - points[None, :, :]
+        d2 = np.einsum("ijk,ijk->ij", d, d)
+        np.fill_diagonal(d2, np.inf)
+        return math.sqrt(d2.min())
+
+    def _sphere_capacity(self):
+        low, high = self._volume()
+        radius = np.min(high - low) / 2
+        if radius < 0:
+            return 0
+        # Start from a hexagonal packing of the surface, then correct with the measured spacing of the points
+        n = max(int(4 * math.pi * radius ** 2 / (self.min_spacing ** 2 * math.sqrt(3) / 2)), 1)
+        while n > 1:
+            distance = self._min_distance(self._sphere_points(n))
+            if distance >= self.min_spacing:
+                return n
+            n = min(n - 1, int(n * (distance / self.min_spacing) ** 2))
+        return n
+
+    def _capacity(self, formation, spacing):
+        if formation == "cube_lattice":
+            return len(self._cube_points(spacing))
+        if formation == "hcp_lattice":
+            return len(self._hcp_points(spacing))
+        if formation == "stacked_rings":
+            return int(self._ring_slots(spacing)[2].sum())
+        raise ValueError(f"Unknown volumetric formation: {formation}")
+
+    def max_drones(self, formation):
+        """Largest number of drones a volumetric formation holds in these boundaries at min_spacing."""
+        if formation == "sphere_shell":
+            return self._sphere_capacity()
+        return self._capacity(formation, self.min_spacing)
+
+    def _fit_spacing(self, formation, n_drones):
+        """Largest spacing (at least min_spacing) at which the formation holds n_drones. Raises ValueError if it does not at min_spacing."""
+        capacity = self._capacity(formation, self.min_spacing)
+        if capacity < n_drones:
+            raise ValueError(f"Not enough space for {n_drones} drones in {formation}: the boundaries hold {capacity} "
+                             f"at {self.min_spacing} m spacing.")
+        low, high = self._volume()
+        fit, too_wide = self.min_spacing, max(float(np.linalg.norm(high - low)), self.min_spacing) * 2
+        for _ in range(40):  # the capacity only goes down when the spacing goes up
+            spacing = (fit + too_wide) / 2
+            if self._capacity(formation, spacing) >= n_drones:
+                fit = spacing
+            else:
+                too_wide = spacing
+        return fit
+
+    def _assign(self, available, points):
+        """{uri: (x, y, z)}, the points sorted bottom to top so the assignment does not depend on how they were generated."""
+        points = points[np.lexsort((points[:, 0], points[:, 1], points[:, 2]))]
+        return {uri: tuple(float(c) for c in point) for uri, point in zip(available, points)}
+
+    def _lattice(self, drones, formation, points_at):
+        available = self.available_drones(drones)
+        points = points_at(self._fit_spacing(formation, len(available)))
+        low, high = self._volume()
+        # The drones closest to the center when the lattice has a few points to spare
+        nearest = np.argsort(((points - (low + high) / 2) ** 2).sum(axis=1), kind="stable")[:len(available)]
+        return self._assign(available, points[nearest])
+
+    def cube_lattice(self, drones: dict[str, bool]):
+        return self._lattice(drones, "cube_lattice", self._cube_points)
+
+    def hcp_lattice(self, drones: dict[str, bool]):
+        return self._lattice(drones, "hcp_lattice", self._hcp_points)
+
+    def stacked_rings(self, drones: dict[str, bool]):
+        """Horizontal rings stacked in z, concentric rings inside them once the outer ones are full."""
+        available = self.available_drones(drones)
+        n_drones = len(available)
+        zs, radii, capacity = self._ring_slots(self._fit_spacing("stacked_rings", n_drones))
+        # Fewest rings that hold the swarm, the drones shared between them in proportion to their size
+        used = int(np.searchsorted(np.cumsum(capacity), n_drones)) + 1
+        zs, radii, capacity = zs[:used], radii[:used], capacity[:used]
+        share = n_drones * capacity / capacity.sum()
+        counts = np.floor(share).astype(int)
+        counts[np.argsort(counts - share, kind="stable")[:n_drones - counts.sum()]] += 1  # largest remainders
+        ring = np.repeat(np.arange(used), counts)
+        slot = np.arange(n_drones) - np.repeat(np.cumsum(counts) - counts, counts)
+        angle = 2 * math.pi * (slot + 0.5 * (np.arange(used) % 2)[ring]) / counts[ring]  # alternate rings are staggered
+        low, high = self._volume()
+        center = (low + high) / 2
+        points = np.stack([center[0] + radii[ring] * np.cos(angle), center[1] + radii[ring] * np.sin(angle), zs[ring]], axis=-1)
+        return self._assign(available, points)
+
+    def sphere_shell(self, drones: dict[str, bool]):
+        """Drones spread evenly over the largest sphere that fits (Fibonacci lattice)."""
+        available = self.available_drones(drones)
+        points = self._sphere_points(len(available))
+        if self._min_distance(points) < self.min_spacing:
+            raise ValueError(f"Not enough space for {len(available)} drones in sphere_shell: the boundaries hold "
+                             f"{self._sphere_capacity()} at {self.min_spacing} m spacing.")
+        return self._assign(available, points)
+
+    def shape(self, drones: dict[str, bool], shape):
+        """Drones spread evenly in a custom shape (shapes.py: Polygon, Implicit, PointCloud, Mesh)."""
+        available = self.available_drones(drones)
+        points = fill_shape(shape, len(available), spacing=self.min_spacing)
+        low, high = self._volume()
+        if (points < low - 1e-9).any() or (points > high + 1e-9).any():
+            raise ValueError("The shape does not fit in the boundaries minus boundary_margins.")
+        return self._assign(available, points)
+
     def moving_circle(self, drones: dict[str, bool],  
                       period: float = circle_rotation_period):
         """Generate circular trajectory segments for each drone.
@@ -345,6 +530,7 @@ class FormationManager:
         self.connected_to_formation = {uri : False for uri in uris}
         self.n_connected_drones = 0
         self.current_formation = None
+        self.shapes = {}  # {name: shape} custom shapes added with add_shape()
 
     def connect_to_formation(self, uri):
         if uri in self.uris:
@@ -371,9 +557,23 @@ class FormationManager:
             positions = FormationCalculator().tilted_plane(self.connected_to_formation)
         elif formation_type == "circle":
             positions = FormationCalculator().circle(self.connected_to_formation)
+        elif formation_type in VOLUMETRIC_FORMATIONS:
+            positions = getattr(FormationCalculator(), formation_type)(self.connected_to_formation)
+        elif formation_type in self.shapes:
+            positions = FormationCalculator().shape(self.connected_to_formation, self.shapes[formation_type])
         else:
             raise ValueError("Unknown formation type.")
         return positions
+
+    def add_shape(self, name, shape):
+        '''Make a custom shape (shapes.py) available as a static formation called name.'''
+        if name in VOLUMETRIC_FORMATIONS or name in ("flat_square", "circle", "tilted_plane", "moving_circle", "sin_wave"):
+            raise ValueError(f"{name} is already a formation.")
+        self.shapes[name] = shape
+
+    def max_drones(self, formation_type):
+        '''Largest number of drones a volumetric formation holds in the arena of config.py.'''
+        return FormationCalculator().max_drones(formation_type)
     
     def get_dynamic_formation_positions(self, formation_type, period=10.0):
         '''
@@ -3,6 +3,9 @@ import tkinter
 import tkinter.ttk as ttk
 import threading
 
+from tracing import tracer
+from config import absolute_boundaries, boundary_margins, gui_update_interval, position_view_refresh_interval, position_view_size
+
 class Crazyflie_report(ttk.Frame):
     def __init__(self, parent, uri, swarm, ident=None):
         ttk.Frame.__init__(self, parent)
@@ -56,15 +59,13 @@ class Crazyflie_report(ttk.Frame):
         """Callback for individual takeoff button"""
         scf = self.swarm.scfs.get(self.uri)
         if scf is not None:
-            import threading
-            threading.Thread(target=self.swarm.takeoff_one, args=(self.uri, scf, 0.8, 1.0)).start()
+            threading.Thread(target=self.swarm.operator_command, args=("takeoff_one", self.uri)).start()
 
     def _on_land(self):
         """Callback for individual land button"""
         scf = self.swarm.scfs.get(self.uri)
         if scf is not None:
-            import threading
-            threading.Thread(target=self.swarm.land_one, args=(self.uri, scf, 3.0)).start()
+            threading.Thread(target=self.swarm.operator_command, args=("land_one", self.uri)).start()
 
     
     def set_state(self, state):
@@ -88,10 +89,13 @@ class Crazyflie_report(ttk.Frame):
             self._status.config(text="ERROR", fg="purple")
             print("Error, state", state, "not handled")
 
-    def set_battery(self, voltage):
+    def set_battery(self, voltage, remaining=None):
         if voltage is None:
             voltage = 3.0
         self._battery_voltage['text'] = "{:.2f}V".format(voltage)
+        if remaining is not None and remaining != float("inf"):
+            # Predicted flight time left (battery_model.py)
+            self._battery_voltage['text'] += " {}:{:02}".format(int(remaining) // 60, int(remaining) % 60)
 
         percent = (voltage - 3.0)*100.0/1.1
 
@@ -119,6 +123,94 @@ class Crazyflie_report(ttk.Frame):
         pass
 
 
+class PositionView(ttk.Frame):
+    '''Live top view (x, y) and side view (x, z) of the swarm.
+    Every drone owns a fixed set of canvas items that are created once and moved with
+    Canvas.move(), so a refresh never deletes or redraws anything.'''
+    def __init__(self, parent, swarm, size=position_view_size):
+        ttk.Frame.__init__(self, parent)
+        self['padding'] = 10
+
+        self.swarm = swarm
+        self.uris = list(swarm.uris)
+        self.size = size
+        self.pad = 10  # pixels between the arena border and the canvas border
+
+        # Each view is (canvas, horizontal axis, vertical axis)
+        self._views = []
+        for column, (title, h_axis, v_axis) in enumerate((("Top view (x, y)", "x", "y"), ("Side view (x, z)", "x", "z"))):
+            Label(self, text=title).grid(row=0, column=column)
+            canvas = tkinter.Canvas(self, width=size, height=size, bg="white", highlightthickness=0)
+            canvas.grid(row=1, column=column, padx=5)
+            self._views.append((canvas, h_axis, v_axis))
+
+        # Last drawn pixel position and visibility of every item group: {(view, tag): (px, py) or None}
+        self._drawn = {}
+        self._draw_arena()
+        self._create_drone_items()
+
+    def _to_pixels(self, h_axis, v_axis, h, v):
+        '''Map world coordinates to canvas pixels, same scale on both axes, vertical axis pointing up.'''
+        h_min, h_max = absolute_boundaries[h_axis]
+        v_min, v_max = absolute_boundaries[v_axis]
+        scale = (self.size - 2 * self.pad) / max(h_max - h_min, v_max - v_min)
+        return self.pad + (h - h_min) * scale, self.size - self.pad - (v - v_min) * scale
+
+    def _draw_arena(self):
+        '''Static items: arena boundaries and the margin drones should keep from them.'''
+        for canvas, h_axis, v_axis in self._views:
+            (h_min, h_max), (v_min, v_max) = absolute_boundaries[h_axis], absolute_boundaries[v_axis]
+            canvas.create_rectangle(*self._to_pixels(h_axis, v_axis, h_min, v_min),
+                                    *self._to_pixels(h_axis, v_axis, h_max, v_max), outline="black")
+            canvas.create_rectangle(*self._to_pixels(h_axis, v_axis, h_min + boundary_margins, v_min + boundary_margins),
+                                    *self._to_pixels(h_axis, v_axis, h_max - boundary_margins, v_max - boundary_margins),
+                                    outline="grey", dash=(3, 3))
+
+    def _create_drone_items(self):
+        '''Create the items of every drone around the pixel origin, hidden until data arrives.'''
+        r = 5  # marker radius in pixels
+        for canvas, _, _ in self._views:
+            for i, uri in enumerate(self.uris):
+                target_tag, position_tag = f"tgt{i}", f"pos{i}"
+                canvas.create_line(-r, -r, r, r, fill="orange", tags=target_tag, state="hidden")
+                canvas.create_line(-r, r, r, -r, fill="orange", tags=target_tag, state="hidden")
+                canvas.create_oval(-r, -r, r, r, fill="green", outline="", tags=position_tag, state="hidden")
+                canvas.create_text(r + 2, -r - 2, text=uri[-2:], anchor="w", font=("ubuntu", 7),
+                                   tags=position_tag, state="hidden")
+                self._drawn[(canvas, target_tag)] = None
+                self._drawn[(canvas, position_tag)] = None
+
+    def _place(self, tag, position):
+        '''Move a group of items to a position in all views, only touching the canvas when it changes.'''
+        for canvas, h_axis, v_axis in self._views:
+            key = (canvas, tag)
+            drawn = self._drawn[key]
+            if position is None:
+                if drawn is not None:
+                    canvas.itemconfigure(tag, state="hidden")
+                    canvas.move(tag, -drawn[0], -drawn[1])
+                    self._drawn[key] = None
+                continue
+            px, py = self._to_pixels(h_axis, v_axis, position["xyz".index(h_axis)], position["xyz".index(v_axis)])
+            px, py = round(px), round(py)
+            if drawn is None:
+                canvas.move(tag, px, py)
+                canvas.itemconfigure(tag, state="normal")
+            elif (px, py) != drawn:
+                canvas.move(tag, px - drawn[0], py - drawn[1])
+            else:
+                continue
+            self._drawn[key] = (px, py)
+
+    def refresh(self):
+        '''Move every drone marker to its latest position and formation slot.'''
+        positions = self.swarm.current_positions
+        targets = self.swarm.target_positions
+        for i, uri in enumerate(self.uris):
+            self._place(f"tgt{i}", targets.get(uri))
+            self._place(f"pos{i}", positions.get(uri))
+
+
 class ControlTowerGUI:
     def __init__(self, swarm):
         self.swarm = swarm
@@ -136,9 +228,11 @@ class ControlTowerGUI:
         self.cfs = dict()
         self._create_cf_grid()
         self._create_controls()
+        self._create_position_view()
         self._configure_close_action()
 
         self.update_gui_loop()
+        self.update_position_view_loop()
 
     # ------------------------------------------------------
     # GUI creation methods
@@ -174,45 +268,68 @@ class ControlTowerGUI:
         pady = 10
 
         btn_takeoff = tkinter.Button(self.content, text="Take off", bg="green", fg="white",
-                                     command=self.swarm.takeoff, width=btn_width)
+                                     command=lambda: self.swarm.operator_command("takeoff"), width=btn_width)
         btn_takeoff.grid(column=0, row=rows_used, sticky="ew", padx=padx, pady=pady)
         btn_land = tkinter.Button(self.content, text="Land", bg="blue", fg="white",
-                                  command=self.swarm.land, width=btn_width)
+                                  command=lambda: self.swarm.operator_command("land"), width=btn_width)
         btn_land.grid(column=1, row=rows_used, sticky="ew", padx=padx, pady=pady)
         btn_emergency = tkinter.Button(self.content, text="Emergency land", bg="red", fg="white",
-                                       command=self.swarm.emergency_land, width=btn_width)
+                                       command=lambda: self.swarm.operator_command("emergency_land"), width=btn_width)
         btn_emergency.grid(column=2, row=rows_used, sticky="ew", padx=padx, pady=pady)
         ## Formations buttons
         btn_flat_square = tkinter.Button(self.content, text="Flat Square", bg="orange", fg="white",
-                                       command=self.swarm.flat_square, width=btn_width)
+                                       command=lambda: self.swarm.operator_command("flat_square"), width=btn_width)
         btn_flat_square.grid(column=0, row=rows_used+1, sticky="ew", padx=padx, pady=pady)
         btn_circle = tkinter.Button(self.content, text="Circle", bg="orange", fg="white",
-                                       command=self.swarm.circle, width=btn_width)  
+                                       command=lambda: self.swarm.operator_command("circle"), width=btn_width)  
         btn_circle.grid(column=1, row=rows_used+1, sticky="ew", padx=padx, pady=pady)
         btn_tilted_plane = tkinter.Button(self.content, text="Tilted Plane", bg="orange", fg="white",
-                                       command=self.swarm.tilted_plane, width=btn_width)
+                                       command=lambda: self.swarm.operator_command("tilted_plane"), width=btn_width)
         btn_tilted_plane.grid(column=2, row=rows_used+1, sticky="ew", padx=padx, pady=pady)
 
         btn_moving_circle = tkinter.Button(self.content, text="Moving Circle", bg="purple", fg="white",
-                           command=self.swarm.moving_circle, width=btn_width)
+                           command=lambda: self.swarm.operator_command("moving_circle"), width=btn_width)
         btn_moving_circle.grid(column=0, row=rows_used+2, sticky="ew", padx=padx, pady=pady)
         btn_sin_wave = tkinter.Button(self.content, text="Sine Wave", bg="purple", fg="white",
-                           command=self.swarm.sin_wave, width=btn_width)
+                           command=lambda: self.swarm.operator_command("sin_wave"), width=btn_width)
         btn_sin_wave.grid(column=1, row=rows_used+2, sticky="ew", padx=padx, pady=pady)
 
+        btn_cube_lattice = tkinter.Button(self.content, text="Cube Lattice", bg="teal", fg="white",
+                           command=lambda: self.swarm.operator_command("cube_lattice"), width=btn_width)
+        btn_cube_lattice.grid(column=0, row=rows_used+3, sticky="ew", padx=padx, pady=pady)
+        btn_hcp_lattice = tkinter.Button(self.content, text="HCP Lattice", bg="teal", fg="white",
+                           command=lambda: self.swarm.operator_command("hcp_lattice"), width=btn_width)
+        btn_hcp_lattice.grid(column=1, row=rows_used+3, sticky="ew", padx=padx, pady=pady)
+        btn_stacked_rings = tkinter.Button(self.content, text="Stacked Rings", bg="teal", fg="white",
+                           command=lambda: self.swarm.operator_command("stacked_rings"), width=btn_width)
+        btn_stacked_rings.grid(column=2, row=rows_used+3, sticky="ew", padx=padx, pady=pady)
+        btn_sphere_shell = tkinter.Button(self.content, text="Sphere Shell", bg="teal", fg="white",
+                           command=lambda: self.swarm.operator_command("sphere_shell"), width=btn_width)
+        btn_sphere_shell.grid(column=2, row=rows_used+2, sticky="ew", padx=padx, pady=pady)
+        ## Custom shapes added to the swarm (add_shape), one button each
+        for k, name in enumerate(self.swarm.formations.shapes):
+            btn_shape = tkinter.Button(self.content, text=name, bg="brown", fg="white",
+                           command=lambda name=name: self.swarm.operator_command(name), width=btn_width)
+            btn_shape.grid(column=k % 3, row=rows_used+4+k//3, sticky="ew", padx=padx, pady=pady)
+
+    def _create_position_view(self):
+        """Create the live position panel to the right of the drone grid."""
+        self.position_view = PositionView(self.root, self.swarm)
+        self.position_view.grid(column=1, row=0, sticky="n")
+
     ## Safe shutdown on window close
     def _configure_close_action(self):
         """Ensure safe shutdown of threads, drones, etc."""
         def fail_safe():
-           
-            # After GUI destroyed, stop swarm background threads but keep links open
+            # Land whatever still flies, motor kill for the drones that do not land. It needs the
+            # telemetry, so it runs before the background threads and the logging are stopped
             try:
-                self.swarm.stop_background(timeout=5.0)
-            except Exception:
-                pass
-            # Add motor kill or landing
+                self.swarm.forced_stop_flying()
+            except Exception as e:
+                print(f"[ERROR] Forced stop failed: {e}")
+            # Stop swarm background threads but keep links open
             try:
-                self.swarm.force_stop_flying()
+                self.swarm.stop_background(timeout=5.0)
             except Exception:
                 pass
             # Close links and clean up remaining resources
@@ -232,16 +349,22 @@ class ControlTowerGUI:
     # ------------------------------------------------------
     # More work needed to update the loop correctly
     def update_gui_loop(self):
-        for uri, cf_widget in self.cfs.items():
-            # If we are succesfully connected to the drone
-            if self.swarm.scfs.get(uri, False):
-                cf_widget.set_state(self.swarm.get_drone_state(uri))
-                cf_widget.set_battery(self.swarm.get_drone_battery(uri))
-            else:
-                # If not connected, try to connect every 10 seconds
-                cf_widget.set_state("disconnected")
-
-        self.root.after(200, self.update_gui_loop)
+        with tracer.span("gui_update"):
+            for uri, cf_widget in self.cfs.items():
+                # If we are succesfully connected to the drone
+                if self.swarm.scfs.get(uri, False):
+                    cf_widget.set_state(self.swarm.get_drone_state(uri))
+                    cf_widget.set_battery(self.swarm.get_drone_battery(uri), self.swarm.remaining_flight_time(uri))
+                else:
+                    # If not connected, try to connect every 10 seconds
+                    cf_widget.set_state("disconnected")
+
+        self.root.after(int(gui_update_interval * 1000), self.update_gui_loop)
+
+    def update_position_view_loop(self):
+        with tracer.span("position_view_update"):
+            self.position_view.refresh()
+        self.root.after(int(position_view_refresh_interval * 1000), self.update_position_view_loop)
 
     def run(self):
         self.root.mainloop()
\ No newline at end of file
@@ -1,13 +1,21 @@
 from gui import ControlTowerGUI
 from drone_commands import CrazyflieSwarm
+from multiprocess_swarm import MultiProcessSwarm
 
 import cflib.crtp
 cflib.crtp.init_drivers(enable_debug_driver=False)
 
-from config import uris, absolute_boundaries, drone_spacing
+from config import uris, absolute_boundaries, drone_spacing, metrics_http_port, metrics_dump_path, metrics_dump_interval, multiprocess_radios, export_rate
 
 if __name__ == "__main__":
-    swarm = CrazyflieSwarm(uris)
+    # With multiprocess_radios every Crazyradio is served by its own process
+    swarm = MultiProcessSwarm(uris) if multiprocess_radios else CrazyflieSwarm(uris)
+    if metrics_http_port:
+        swarm.metrics.serve(metrics_http_port)
+    if metrics_dump_path:
+        swarm.metrics.start_dump(metrics_dump_path, metrics_dump_interval)
+    if export_rate:
+        swarm.start_export()
     app = ControlTowerGUI(swarm)
     swarm.connect_all()
     swarm.run()
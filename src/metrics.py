@@ -0,0 +1,137 @@
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Bucket upper bounds in seconds
+CALLBACK_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+INTERVAL_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0)
+LOOP_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+SECONDS_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 30.0)
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    '''Histogram with fixed bucket upper bounds. observe() is a bisect and two additions,
+    cheap enough for the log callbacks. Updates are not locked: under heavy contention a sample
+    can be lost, which is acceptable for metrics.'''
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    '''Named counters and histograms, with optional labels, rendered in the Prometheus text format.
+    Everything stays local: the text is served on 127.0.0.1 and/or dumped to a file.'''
+    def __init__(self):
+        self._metrics = {}  # {(name, labels): Counter | Histogram}
+        self._help = {}  # {name: (type, help)}
+        self._lock = threading.Lock()  # only for creating metrics, never taken when recording
+        self._server = None
+
+    def _get(self, name, labels, factory, kind, help_text):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, factory())
+                self._help.setdefault(name, (kind, help_text))
+        return metric
+
+    def counter(self, name, help_text="", **labels):
+        """Get or create a counter. Look it up once and keep the reference on hot paths."""
+        return self._get(name, labels, Counter, "counter", help_text)
+
+    def histogram(self, name, buckets, help_text="", **labels):
+        """Get or create a histogram. Look it up once and keep the reference on hot paths."""
+        return self._get(name, labels, lambda: Histogram(buckets), "histogram", help_text)
+
+    def total(self, name):
+        """Sum of the counters called name, over all their labels."""
+        return sum(metric.value for (metric_name, _), metric in list(self._metrics.items())
+                   if metric_name == name and isinstance(metric, Counter))
+
+    def render(self):
+        lines = []
+        # Snapshots: the link and safety threads can create metrics while this runs
+        metrics = sorted(list(self._metrics.items()), key=lambda item: item[0])
+        for name, (kind, help_text) in sorted(list(self._help.items())):
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric_name, labels), metric in metrics:
+                if metric_name != name:
+                    continue
+                if kind == "counter":
+                    lines.append(f"{name}{_label_text(labels)} {metric.value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ("+Inf",), metric.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_label_text(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{_label_text(labels)} {metric.sum}")
+                lines.append(f"{name}_count{_label_text(labels)} {metric.count}")
+        return "\n".join(lines) + "\n"
+
+    # ---------------------------
+    # OUTPUTS
+    # ---------------------------
+    def serve(self, port, host="127.0.0.1"):
+        """Serve the metrics on http://host:port/metrics from a daemon thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass  # keep the console for the swarm
+
+        try:
+            self._server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            # Another swarm (a second show, main.py next to show.py) already serves there, fly without the endpoint
+            print(f"[WARNING] Metrics endpoint not started on {host}:{port}: {e}")
+            return
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        print(f"[INFO] Metrics available at http://{host}:{port}/metrics")
+
+    def start_dump(self, path, interval):
+        """Rewrite the metrics to a text file every interval seconds from a daemon thread."""
+        def dump_loop():
+            while True:
+                time.sleep(interval)
+                with open(path, "w") as f:
+                    f.write(self.render())
+        threading.Thread(target=dump_loop, daemon=True).start()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
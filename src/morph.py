@@ -0,0 +1,194 @@
+'''
+Morphing from a running dynamic formation into the next one (dynamic_morph_duration in config.py).
+
+The setpoint streams of a dynamic formation read their waypoints from a Stream. A morph does not
+stop them: it chains a new Stream that takes over at a step a little ahead of the running one
+(switch_step), so no stop or notify setpoint is sent and no drone ever stops streaming.
+
+From switch_step on, every drone follows a blend of where the old formation would have taken it
+and of one trajectory of the new formation, started at the same instant:
+    p(k) = old(k) + s(k) * (new(k) - old(k)),   s = smoothstep from 0 to 1 over the blend
+The new trajectories are matched to the drones in time: for dynamic_morph_phases phase offsets of
+the new formation, the cost of giving trajectory j to drone i is the sum over the blend of
+|old_i(k) - new_j(k)|^2, the assignment minimizing it is solved exactly (Hungarian method), and
+the cheapest phase wins. The blend is lengthened until it is no faster than dynamic_max_speed;
+the caller sweeps it with the TrajectoryValidator before using it.
+'''
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from config import dynamic_morph_phases, dynamic_max_speed
+
+# prefixes: {uri: [blend waypoints]} streamed from switch_step on, then the cyclic trajectories {uri: [waypoints]}
+# steps: [{uri: (x, y, z)}] the blend at every waypoint, from switch_step to the start of the trajectories
+# duration: seconds of the blend, phase: waypoint of the new formation the blend starts from
+Morph = namedtuple("Morph", ["switch_step", "prefixes", "trajectories", "steps", "duration", "phase", "cost"])
+
+
+class Stream:
+    '''Waypoints of one drone: prefix from step first on, then sequence in a loop. Steps before first are those of the stream it followed.'''
+    __slots__ = ("first", "prefix", "sequence", "previous")
+
+    def __init__(self, sequence, first=0, prefix=(), previous=None):
+        self.first = first
+        self.prefix = prefix
+        self.sequence = sequence
+        self.previous = previous
+
+    def waypoint(self, step):
+        stream = self
+        while step < stream.first and stream.previous is not None:
+            stream = stream.previous
+        k = step - stream.first
+        if k < len(stream.prefix):
+            return stream.prefix[k]
+        return stream.sequence[(k - len(stream.prefix)) % len(stream.sequence)]
+
+    def then(self, first, prefix, sequence):
+        """Stream switching to prefix then sequence at step first. Only this stream is kept behind it, the streams
+        before it are past."""
+        return Stream(sequence, first, prefix, Stream(self.sequence, self.first, self.prefix))
+
+    def layout(self):
+        """(first, prefix length, sequence length) of this stream and of the ones before it."""
+        stream, layout = self, []
+        while stream is not None:
+            layout.append((stream.first, len(stream.prefix), len(stream.sequence)))
+            stream = stream.previous
+        return tuple(layout)
+
+
+class StreamTable:
+    '''Streams of several drones as arrays, to read the waypoints of all of them at once. Streams with the same
+    layout (switch steps, prefix and sequence lengths, the same for all drones of a formation) share one block.'''
+    def __init__(self, streams, uris=None):
+        '''
+        Args:
+            streams (dict): {uri: Stream}, the table is only valid as long as they are not swapped
+            uris (list): drones in the order of the rows of waypoints(), NaN rows for those without a stream.
+                The drones of streams if None
+        '''
+        self.streams = streams
+        self.uris = list(streams) if uris is None else list(uris)
+        self.width = len(next(iter(streams.values())).sequence[0]) if streams else 3
+        groups = {}
+        for row, uri in enumerate(self.uris):
+            if uri in streams:
+                groups.setdefault(streams[uri].layout(), []).append(row)
+        self._blocks = []  # [(rows, [(first, prefixes (m, P, width), sequences (m, L, width))], newest stream first)]
+        for layout, rows in groups.items():
+            members = [streams[self.uris[row]] for row in rows]
+            layers = []
+            for first, prefix_length, _ in layout:
+                prefixes = np.array([stream.prefix for stream in members], dtype=float).reshape(len(rows), prefix_length, self.width)
+                sequences = np.array([stream.sequence for stream in members], dtype=float)
+                layers.append((first, prefixes, sequences))
+                members = [stream.previous for stream in members]
+            self._blocks.append((np.array(rows), layers))
+
+    def waypoints(self, steps):
+        """(len(uris), len(steps), width) waypoints of every stream at the integer steps, as Stream.waypoint()."""
+        steps = np.asarray(steps)
+        result = np.full((len(self.uris), len(steps), self.width), np.nan)
+        for rows, layers in self._blocks:
+            values = np.empty((len(rows), len(steps), self.width))
+            left = np.ones(len(steps), dtype=bool)
+            for index, (first, prefixes, sequences) in enumerate(layers):
+                here = left if index == len(layers) - 1 else left & (steps >= first)
+                k = steps[here] - first
+                prefix_length = prefixes.shape[1]
+                looped = sequences[:, (k - prefix_length) % sequences.shape[1]]
+                if prefix_length:
+                    values[:, here] = np.where((k < prefix_length)[None, :, None],
+                                               prefixes[:, np.minimum(k, prefix_length - 1)], looped)
+                else:
+                    values[:, here] = looped
+                left &= ~here
+            result[rows] = values
+        return result
+
+
+def assign(cost):
+    """Column given to each row of a square cost matrix, minimizing the total (Hungarian method with potentials, O(n^3))."""
+    n = len(cost)
+    u, v = np.zeros(n + 1), np.zeros(n + 1)
+    p = np.zeros(n + 1, dtype=int)  # p[j]: row given column j, 1-based, 0 if none
+    way = np.zeros(n + 1, dtype=int)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(n + 1, np.inf)
+        used = np.zeros(n + 1, dtype=bool)
+        # Shortest augmenting path from row i, one column at a time
+        while p[j0] != 0:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used
+            free[0] = False
+            reduced = np.full(n + 1, np.inf)
+            reduced[1:] = cost[i0 - 1] - u[i0] - v[1:]
+            better = free & (reduced < minv)
+            minv[better] = reduced[better]
+            way[better] = j0
+            j1 = int(np.argmin(np.where(free, minv, np.inf)))
+            delta = minv[j1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[free] -= delta
+            j0 = j1
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    columns = np.empty(n, dtype=int)
+    columns[p[1:] - 1] = np.arange(n)
+    return columns
+
+
+def plan_morph(current, trajectories, switch_step, waypoint_dt, duration, max_speed=dynamic_max_speed, phases=dynamic_morph_phases):
+    '''
+    Args:
+        current (callable): (uri, step) -> waypoint of the running formation
+        trajectories (dict): {uri: [waypoints]} of the new formation, waypoints are (x, y, z, yaw)
+        switch_step (int): first step of the running streams that follows the blend
+        waypoint_dt (float): time between two waypoints, the same for both formations
+        duration (float): seconds of the blend, lengthened if it would be faster than max_speed
+    Returns:
+        Morph
+    '''
+    uris = list(trajectories)
+    new = np.array([trajectories[uri] for uri in uris], dtype=float)  # (n, K, 4)
+    period = new.shape[1]
+    offsets = np.unique(np.linspace(0, period, max(1, phases), endpoint=False).astype(int))
+    blend = max(1, math.ceil(duration / waypoint_dt))
+    for _ in range(4):
+        old = np.array([[current(uri, switch_step + k) for k in range(blend + 1)] for uri in uris], dtype=float)  # (n, B+1, 4)
+        best = None
+        for offset in offsets:
+            target = new[:, (offset + np.arange(blend + 1)) % period]
+            # cost[i, j] = sum over the blend of |old_i(k) - new_j(k)|^2
+            cost = ((old[:, None, :, :3] - target[None, :, :, :3]) ** 2).sum(axis=(2, 3))
+            columns = assign(cost)
+            total = cost[np.arange(len(uris)), columns].sum()
+            if best is None or total < best[0]:
+                best = (total, offset, columns, target[columns])
+        total, offset, columns, target = best
+        x = np.arange(blend + 1) / blend
+        s = (x * x * (3 - 2 * x))[None, :, None]
+        blended = old.copy()
+        blended[..., :3] += s * (target[..., :3] - old[..., :3])
+        turn = (target[..., 3] - old[..., 3] + math.pi) % (2 * math.pi) - math.pi
+        blended[..., 3] += s[..., 0] * turn
+        speed = np.linalg.norm(np.diff(blended[..., :3], axis=1), axis=2).max() / waypoint_dt
+        if speed <= max_speed:
+            break
+        blend = math.ceil(blend * speed / max_speed)
+    start = (offset + blend) % period
+    prefixes, cyclic = {}, {}
+    for i, uri in enumerate(uris):
+        prefixes[uri] = [tuple(waypoint) for waypoint in blended[i, :blend].tolist()]
+        cyclic[uri] = [tuple(waypoint) for waypoint in np.roll(new[columns[i]], -start, axis=0).tolist()]
+    steps = [{uri: tuple(blended[i, k, :3].tolist()) for i, uri in enumerate(uris)} for k in range(blend + 1)]
+    return Morph(switch_step, prefixes, cyclic, steps, blend * waypoint_dt, int(offset), float(total))
@@ -0,0 +1,177 @@
+'''
+CrazyflieSwarm with the radios in worker processes (multiprocess_radios in config.py).
+
+One RadioWorker process per Crazyradio owns the links of its drones (radio_worker.py). This
+process keeps FormationManager, the update loop and the GUI. Like the replay, only the link
+boundary is overridden: the links are proxies that put commands into the worker's CommandRing, and
+a poller thread reads the shared TelemetryTable and calls the swarm's own log callbacks.
+'''
+import multiprocessing
+import threading
+
+import numpy as np
+
+from drone_commands import CrazyflieSwarm
+from radio_worker import (TelemetryTable, CommandRing, EmergencyFlags, run_worker, LINK_CONNECTED, CONNECT, TAKEOFF, LAND, GO_TO,
+                          SETPOINT, STOP, NOTIFY_STOP, LOG_PERIOD, SHUTDOWN)
+from telemetry_rates import radio_of
+from config import worker_poll_interval, worker_connect_timeout
+
+
+# ---------------------------
+# LINK PROXIES
+# ---------------------------
+class _WorkerHighLevelCommander:
+    def __init__(self, send):
+        self._send = send
+
+    def takeoff(self, height, duration):
+        self._send(TAKEOFF, height, duration)
+
+    def land(self, height, duration):
+        self._send(LAND, height, duration)
+
+    def go_to(self, x, y, z, yaw, duration, relative=False):
+        self._send(GO_TO, x, y, z, yaw, duration)
+
+
+class _WorkerCommander:
+    def __init__(self, send):
+        self._send = send
+
+    def send_position_setpoint(self, x, y, z, yaw):
+        self._send(SETPOINT, x, y, z, yaw)
+
+    def send_stop_setpoint(self):
+        self._send(STOP)
+
+    def send_notify_setpoint_stop(self):
+        self._send(NOTIFY_STOP)
+
+
+class _WorkerCrazyflie:
+    def __init__(self, send):
+        self.high_level_commander = _WorkerHighLevelCommander(send)
+        self.commander = _WorkerCommander(send)
+
+
+class _WorkerLink:
+    '''Takes the place of a SyncCrazyflie in the main process, the real one lives in the worker.'''
+    def __init__(self, uri, send):
+        self.uri = uri
+        self.cf = _WorkerCrazyflie(send)
+
+    def close_link(self):
+        pass  # the worker closes its links when it shuts down
+
+
+# ---------------------------
+# SWARM
+# ---------------------------
+class MultiProcessSwarm(CrazyflieSwarm):
+    def __init__(self, uris, **kwargs):
+        super().__init__(uris, **kwargs)
+        self._slot = {uri: i for i, uri in enumerate(uris)}
+        self._table = TelemetryTable(len(uris))
+        self._emergency = EmergencyFlags(len(uris))
+        self._rings = {}  # {dongle: CommandRing}
+        self._ring_locks = {}  # {dongle: Lock}, the rings take one producer at a time
+        self._workers = {}  # {dongle: Process}
+        self.callbacks = {}  # {uri: (low freq callback, high freq callback)}
+        context = multiprocessing.get_context("spawn")  # workers start clean, without Tk or the threads of this process
+        radios = {}
+        for uri in uris:
+            radios.setdefault(radio_of(uri), {})[uri] = self._slot[uri]
+        for dongle, slots in radios.items():
+            ring = CommandRing()
+            self._rings[dongle] = ring
+            self._ring_locks[dongle] = threading.Lock()
+            worker = context.Process(target=run_worker, args=(dongle, slots, self._table.name, ring.name, self._emergency.name, len(uris)),
+                                     name=f"radio{dongle}", daemon=True)
+            worker.start()
+            self._workers[dongle] = worker
+            print(f"[INFO] Radio worker {dongle} started for {len(slots)} drones (pid {worker.pid})")
+        self._polling = True
+        self._poller = self.clock.start_thread(self._poll_telemetry, daemon=True)
+
+    def _send(self, uri, kind, *args):
+        dongle = radio_of(uri)
+        with self._ring_locks[dongle]:
+            self._rings[dongle].put(kind, self._slot[uri], *args)
+
+    # ---------------------------
+    # LINK BOUNDARY
+    # ---------------------------
+    def _open_link(self, uri):
+        i = self._slot[uri]
+        events = int(self._table.slots["link_events"][i])
+        self._send(uri, CONNECT, self.rates.periods[uri])
+        deadline = self.clock.time() + worker_connect_timeout
+        while self.clock.time() < deadline:
+            if int(self._table.slots["link_events"][i]) != events:
+                if int(self._table.slots["link"][i]) == LINK_CONNECTED:
+                    return _WorkerLink(uri, lambda kind, *args: self._send(uri, kind, *args))
+                break
+            self.clock.sleep(worker_poll_interval)
+        raise ConnectionError(f"Radio worker {radio_of(uri)} could not connect to {uri}")
+
+    def _setup_logging(self, uri, scf):
+        # The worker started the log blocks when it connected, only the callbacks live here
+        self.callbacks[uri] = self._log_callbacks(uri)
+        print(f"[OK] Logging started for {uri}")
+
+    def _set_position_period(self, uri, period_in_ms):
+        self._send(uri, LOG_PERIOD, period_in_ms)
+
+    def _send_emergency_stop(self, uri, scf):
+        # Not through the ring: it may be full of setpoints, and its lock held by a sender waiting for room
+        self._emergency.request(self._slot[uri], self._rings[radio_of(uri)].head)
+
+    def _poll_telemetry(self):
+        """Hand the new samples of the shared table to the log callbacks."""
+        status_seen = np.zeros(len(self.uris), dtype=np.uint32)
+        position_seen = np.zeros(len(self.uris), dtype=np.uint32)
+        while self._polling:
+            data, valid = self._table.read()
+            # Slots written during the copy are skipped, they are picked up at the next poll
+            new_status = np.flatnonzero(valid & (data["status_count"] != status_seen))
+            new_position = np.flatnonzero(valid & (data["position_count"] != position_seen))
+            status_seen[new_status] = data["status_count"][new_status]
+            position_seen[new_position] = data["position_count"][new_position]
+            for i in new_status.tolist():
+                callbacks = self.callbacks.get(self.uris[i])
+                if callbacks is None:
+                    continue
+                sample = {'pm.vbat': float(data["vbat"][i])}
+                if data["info"][i] == data["info"][i]:  # NaN if not received
+                    sample['supervisor.info'] = int(data["info"][i])
+                callbacks[0](int(data["status_ts"][i]), sample, None)
+            for i in new_position.tolist():
+                callbacks = self.callbacks.get(self.uris[i])
+                if callbacks is None:
+                    continue
+                x, y, z = data["position"][i].tolist()
+                sample = {'kalman.stateX': x, 'kalman.stateY': y, 'kalman.stateZ': z}
+                vx, vy, vz = data["velocity"][i].tolist()
+                if vx == vx:
+                    sample.update({'stateEstimate.vx': vx, 'stateEstimate.vy': vy, 'stateEstimate.vz': vz})
+                callbacks[1](int(data["position_ts"][i]), sample, None)
+            self.clock.sleep(worker_poll_interval)
+
+    def close_links(self):
+        super().close_links()
+        self._polling = False
+        self.clock.join(self._poller, 1.0)
+        for dongle, ring in self._rings.items():
+            with self._ring_locks[dongle]:
+                ring.put(SHUTDOWN, 0)
+        for dongle, worker in self._workers.items():
+            worker.join(timeout=5.0)
+            if worker.is_alive():
+                print(f"[WARNING] Radio worker {dongle} did not stop, terminating it")
+                worker.terminate()
+        for ring in self._rings.values():
+            ring.close(unlink=True)
+        self._emergency.close(unlink=True)
+        self._table.close(unlink=True)
+        print("[INFO] Radio workers stopped")
@@ -0,0 +1,47 @@
+'''
+Compact position telemetry: position (and optionally velocity) as int16 millimetres.
+
+The firmware's stateEstimateZ log group holds the state estimate as int16 in mm and mm/s. Three
+int16 take 6 bytes instead of the 12 of kalman.stateX/Y/Z, so a log packet has room for the
+velocity too, or more drones fit on a radio at a higher rate. The range is +-32.767 m and the
+quantization error is at most half a millimetre per axis.
+'''
+from telemetry_rates import POSITION_VARIABLES
+from config import compact_position_logging, log_velocity
+
+POSITION_SCALE = 0.001  # meters per unit
+VELOCITY_SCALE = 0.001  # meters per second per unit
+MAX_QUANTIZATION_ERROR = POSITION_SCALE / 2 * 3 ** 0.5  # meters, 3D
+
+COMPACT_POSITION_VARIABLES = (('stateEstimateZ.x', 'int16_t'), ('stateEstimateZ.y', 'int16_t'), ('stateEstimateZ.z', 'int16_t'))
+COMPACT_VELOCITY_VARIABLES = (('stateEstimateZ.vx', 'int16_t'), ('stateEstimateZ.vy', 'int16_t'), ('stateEstimateZ.vz', 'int16_t'))
+
+
+def position_variables(compact=compact_position_logging, velocity=log_velocity):
+    """Variables of the position log block."""
+    if not compact:
+        return POSITION_VARIABLES
+    return COMPACT_POSITION_VARIABLES + (COMPACT_VELOCITY_VARIABLES if velocity else ())
+
+
+def read_sample(data):
+    """Position and velocity from one log packet, in either format: ((x, y, z) or None, (vx, vy, vz) or None).
+    Float packets carry kalman.stateX/Y/Z and, when present, stateEstimate.vx/vy/vz.
+
+    cflib already unpacks one packet into a dict, so a single sample is scaled in plain Python,
+    which is cheaper than going through NumPy for three values."""
+    x = data.get('kalman.stateX')
+    if x is not None:
+        y, z = data.get('kalman.stateY'), data.get('kalman.stateZ')
+        vx, vy, vz = data.get('stateEstimate.vx'), data.get('stateEstimate.vy'), data.get('stateEstimate.vz')
+        velocity = (vx, vy, vz) if vx is not None and vy is not None and vz is not None else None
+        return ((x, y, z) if y is not None and z is not None else None), velocity
+    x, y, z = data.get('stateEstimateZ.x'), data.get('stateEstimateZ.y'), data.get('stateEstimateZ.z')
+    if x is None or y is None or z is None:
+        return None, None
+    position = (x * POSITION_SCALE, y * POSITION_SCALE, z * POSITION_SCALE)
+    vx, vy, vz = data.get('stateEstimateZ.vx'), data.get('stateEstimateZ.vy'), data.get('stateEstimateZ.vz')
+    if vx is None or vy is None or vz is None:
+        return position, None
+    return position, (vx * VELOCITY_SCALE, vy * VELOCITY_SCALE, vz * VELOCITY_SCALE)
+
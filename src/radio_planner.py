@@ -0,0 +1,203 @@
+'''
+Plans which Crazyradio and channel every drone uses.
+
+The load of a drone's link is estimated from its log blocks (size and rate) and from the setpoint
+stream of dynamic formations. Drones are spread over the dongles so that every dongle stays under
+radio_max_utilization of radio_packet_budget, each dongle on its own channel; plans that cannot
+are refused. Everything runs offline: the plan can be checked against a simulated link before
+touching the hardware.
+
+Usage: python radio_planner.py --dongles 2 [--phase dynamic] [--simulate]
+'''
+import argparse
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from telemetry_rates import STATUS_VARIABLES, LOG_PACKET_DATA, block_bytes, period_ms
+from position_codec import position_variables as logged_position_variables
+from config import (uris, radio_channels, radio_packet_budget, radio_max_utilization, low_frequency_update_interval,
+                    position_rate_by_phase, dynamic_waypoint_dt)
+
+LOG_HEADER_BYTES = 5  # CRTP header, block id and 3 byte timestamp
+SETPOINT_BYTES = 18  # CRTP header, setpoint type, x, y, z and yaw
+
+# One periodic packet stream of a link: name, period in seconds, bytes per packet
+Stream = namedtuple("Stream", ["name", "period", "size"])
+# packets_per_second: served within the simulated duration, backlog: packets still queued at its end
+SimulatedLink = namedtuple("SimulatedLink", ["packets_per_second", "utilization", "max_delay", "mean_delay", "backlog"])
+
+
+def split_uri(uri):
+    """radio://<dongle>/<channel>/<datarate>/<address> -> (dongle, channel, datarate, address)"""
+    dongle, channel, datarate, address = uri.split("://", 1)[1].split("/")
+    return int(dongle), int(channel), datarate, address
+
+
+def link_streams(phase="dynamic", position_variables=None):
+    """Packet streams of one drone in a flight phase. Blocks larger than a packet take several packets."""
+    streams = []
+    position_variables = position_variables or logged_position_variables()
+    blocks = (("status", STATUS_VARIABLES, low_frequency_update_interval),
+              ("position", position_variables, period_ms(position_rate_by_phase[phase]) / 1000.0))
+    for name, variables, period in blocks:
+        size = block_bytes(variables)
+        for k in range(math.ceil(size / LOG_PACKET_DATA)):
+            streams.append(Stream(name, period, min(LOG_PACKET_DATA, size - k * LOG_PACKET_DATA) + LOG_HEADER_BYTES))
+    if phase == "dynamic":
+        streams.append(Stream("setpoint", dynamic_waypoint_dt, SETPOINT_BYTES))
+    return streams
+
+
+def link_load(streams):
+    """(packets per second, bytes per second) of a list of streams."""
+    return (sum(1.0 / s.period for s in streams),
+            sum(s.size / s.period for s in streams))
+
+
+class RadioPlan:
+    '''Result of plan_radios(): the dongle and channel of every drone and the predicted loads.'''
+    def __init__(self, drone_uris, assignment, streams, channels, capacity, max_utilization):
+        self.assignment = assignment  # {uri: dongle}
+        self.streams = streams  # {uri: [Stream]}
+        self.channels = channels  # {dongle: channel}
+        self.capacity = capacity
+        self.max_utilization = max_utilization
+        self.uris = []  # new uris, in the order of drone_uris
+        for uri in drone_uris:
+            _, _, datarate, address = split_uri(uri)
+            dongle = assignment[uri]
+            self.uris.append(f"radio://{dongle}/{channels[dongle]}/{datarate}/{address}")
+
+    def by_dongle(self):
+        """{dongle: [old uri]}"""
+        groups = {dongle: [] for dongle in self.channels}
+        for uri, dongle in self.assignment.items():
+            groups[dongle].append(uri)
+        return groups
+
+    def loads(self):
+        """{dongle: (packets per second, bytes per second)}"""
+        return {dongle: link_load([s for uri in members for s in self.streams[uri]])
+                for dongle, members in self.by_dongle().items()}
+
+    @property
+    def feasible(self):
+        return all(packets <= self.capacity * self.max_utilization for packets, _ in self.loads().values())
+
+    def config_text(self):
+        """The uris variable of config.py for this plan."""
+        return "uris = [" + ", \n        ".join(f"'{uri}'" for uri in self.uris) + "]"
+
+    def summary(self):
+        lines = []
+        for dongle, (packets, size) in self.loads().items():
+            n = len(self.by_dongle()[dongle])
+            lines.append(f"[PLAN] radio {dongle} channel {self.channels[dongle]}: {n} drones, "
+                         f"{packets:.0f} packets/s ({100 * packets / self.capacity:.0f}% of {self.capacity}), {size / 1000:.1f} kB/s")
+        if not self.feasible:
+            lines.append(f"[WARNING] Some radios are above {100 * self.max_utilization:.0f}% of their capacity, add dongles or lower the rates")
+        return "\n".join(lines)
+
+
+def plan_radios(drone_uris, dongles, phase="dynamic", capacity=radio_packet_budget,
+                max_utilization=radio_max_utilization, channels=radio_channels, position_variables=None):
+    '''
+    Spread the drones over the dongles, balancing the predicted link load.
+
+    Args:
+        drone_uris (list): current uris, only the datarate and address are kept
+        dongles (int): number of Crazyradios
+        phase (str): flight phase to plan for, "dynamic" is the busiest
+        capacity (float): packets per second one Crazyradio can handle
+        max_utilization (float): fraction of the capacity a radio may be planned to use
+        channels (tuple): channels to use, one per dongle
+        position_variables (tuple): position log block, the one configured in config.py if None
+    Returns:
+        RadioPlan
+    Raises ValueError when a radio would be above max_utilization of its capacity.
+    '''
+    if dongles < 1:
+        raise ValueError("At least one dongle is needed")
+    if dongles > len(channels):
+        raise ValueError(f"Only {len(channels)} channels configured for {dongles} dongles")
+    streams = {uri: link_streams(phase, position_variables) for uri in drone_uris}
+    load = {uri: link_load(streams[uri])[0] for uri in drone_uris}
+    # Longest processing time first: the heaviest drone goes to the least loaded dongle
+    totals = [0.0] * dongles
+    assignment = {}
+    for uri in sorted(drone_uris, key=lambda uri: -load[uri]):
+        dongle = min(range(dongles), key=lambda d: totals[d])
+        assignment[uri] = dongle
+        totals[dongle] += load[uri]
+    plan = RadioPlan(drone_uris, assignment, streams, {d: channels[d] for d in range(dongles)}, capacity, max_utilization)
+    if not plan.feasible:
+        needed = math.ceil(sum(load.values()) / (capacity * max_utilization))
+        raise ValueError(f"{len(drone_uris)} drones need {max(totals):.0f} packets/s on one of {dongles} radio(s), above "
+                         f"{100 * max_utilization:.0f}% of {capacity}: use at least {needed} dongles or lower the rates")
+    return plan
+
+
+def simulate_links(plan, duration=10.0, seed=0):
+    '''
+    Simulate every dongle of a plan as a queue serving plan.capacity packets per second, fed by the
+    planned streams with random phases. Returns {dongle: SimulatedLink}.
+    '''
+    rng = np.random.default_rng(seed)
+    service = 1.0 / plan.capacity
+    links = {}
+    for dongle, members in plan.by_dongle().items():
+        arrivals = [np.arange(rng.uniform(0, s.period), duration, s.period)
+                    for uri in members for s in plan.streams[uri]]
+        arrivals = np.sort(np.concatenate(arrivals)) if arrivals else np.empty(0)
+        if len(arrivals) == 0:
+            links[dongle] = SimulatedLink(0.0, 0.0, 0.0, 0.0, 0)
+            continue
+        # First come first served: packet i is done at (i + 1) * service + max over j <= i of (arrival_j - j * service)
+        index = np.arange(len(arrivals))
+        done = (index + 1) * service + np.maximum.accumulate(arrivals - index * service)
+        delay = done - arrivals
+        # What the link got through, not what was offered: an overloaded radio serves its capacity and queues the rest
+        served = np.count_nonzero(done <= duration)
+        packets = served / duration
+        links[dongle] = SimulatedLink(packets, packets / plan.capacity, float(delay.max()), float(delay.mean()), len(arrivals) - served)
+    return links
+
+
+def check_plan(plan, duration=10.0):
+    """Simulate the plan and check every radio: within max_utilization of its capacity, serving the predicted load,
+    and a queue that does not grow (at the end no more packets waiting than one per stream)."""
+    ok = True
+    predicted = plan.loads()
+    for dongle, link in simulate_links(plan, duration).items():
+        expected = predicted[dongle][0]
+        n_streams = len([s for uri in plan.by_dongle()[dongle] for s in plan.streams[uri]])
+        problems = []
+        if expected > plan.capacity * plan.max_utilization:
+            problems.append(f"above {100 * plan.max_utilization:.0f}% of {plan.capacity}")
+        if abs(link.packets_per_second - expected) > n_streams / duration:  # one packet per stream
+            problems.append("load not served")
+        if link.backlog > n_streams:
+            problems.append(f"queue growing ({link.backlog} packets waiting)")
+        ok &= not problems
+        print(f"[{'ERROR' if problems else 'OK'}] radio {dongle}: predicted {expected:.0f} packets/s, served {link.packets_per_second:.0f} packets/s, "
+              f"queue delay mean {1000 * link.mean_delay:.1f} ms max {1000 * link.max_delay:.1f} ms" + "".join(f", {p}" for p in problems))
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Assign the drones of config.py to Crazyradios and channels.")
+    parser.add_argument("--dongles", type=int, default=1, help="number of Crazyradios")
+    parser.add_argument("--phase", default="dynamic", choices=sorted(position_rate_by_phase), help="flight phase to plan for")
+    parser.add_argument("--simulate", action="store_true", help="check the predicted load on a simulated link")
+    args = parser.parse_args()
+
+    try:
+        plan = plan_radios(uris, args.dongles, phase=args.phase)
+    except ValueError as e:
+        parser.exit(1, f"[ERROR] {e}\n")
+    print(plan.summary())
+    if args.simulate:
+        check_plan(plan)
+    print(plan.config_text())
@@ -0,0 +1,328 @@
+'''
+Radio worker process: owns the SyncCrazyflie links of the drones of one Crazyradio.
+
+The workers and the main process only share memory, never a lock:
+- Telemetry goes into a TelemetryTable, one slot per drone. Each slot is a seqlock: the worker
+  makes its sequence number odd while it writes the slot, the reader keeps a copy only if the
+  number was even and unchanged around the copy.
+- Commands come from a CommandRing, a single-producer single-consumer ring where the producer
+  only moves the head and the worker only moves the tail.
+- Emergency stops skip the rings: the main process bumps the slot of the drone in EmergencyFlags,
+  the worker looks at the flags of its drones before every command and sends the stop at once,
+  then drops the movement commands that were queued before it.
+A stalled link therefore only stalls the worker of its own radio.
+'''
+import logging
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from telemetry_rates import STATUS_VARIABLES
+from position_codec import position_variables, read_sample
+from config import low_frequency_update_interval, worker_command_capacity, worker_idle_sleep
+
+# Link state of a drone, written by its worker
+LINK_DISCONNECTED, LINK_CONNECTING, LINK_CONNECTED, LINK_FAILED = range(4)
+
+TELEMETRY_DTYPE = np.dtype([
+    ("seq", "<u4"),             # odd while the worker writes the slot
+    ("link", "<u4"),            # LINK_*
+    ("link_events", "<u4"),     # incremented when a connection attempt ends (connected or failed)
+    ("status_count", "<u4"),    # incremented with every status packet
+    ("position_count", "<u4"),  # incremented with every position packet
+    ("status_ts", "<u4"),       # log timestamps (ms)
+    ("position_ts", "<u4"),
+    ("pad", "<u4"),
+    ("vbat", "<f8"),
+    ("info", "<f8"),            # supervisor.info, NaN if not received
+    ("position", "<f8", (3,)),
+    ("velocity", "<f8", (3,)),  # NaN if not logged
+])
+
+# Commands: kind, drone slot, up to 5 arguments
+CONNECT, TAKEOFF, LAND, GO_TO, SETPOINT, STOP, NOTIFY_STOP, LOG_PERIOD, SHUTDOWN = range(9)
+COMMAND_DTYPE = np.dtype([("kind", "u1"), ("drone", "<u2"), ("args", "<f8", (5,))])
+# Queued commands that could move a drone again, dropped when an emergency stop overtakes them
+MOVES = (TAKEOFF, LAND, GO_TO, SETPOINT, NOTIFY_STOP)
+
+EMERGENCY_DTYPE = np.dtype([
+    ("seq", "<u4"),   # bumped by the main process for every stop request
+    ("pad", "<u4"),
+    ("head", "<u8"),  # head of the drone's command ring when the stop was requested
+])
+
+
+def _shared_memory(name, size):
+    """Create a block (name None) or attach to an existing one."""
+    if name is None:
+        return shared_memory.SharedMemory(create=True, size=size)
+    return shared_memory.SharedMemory(name=name)
+
+
+class TelemetryTable:
+    '''Telemetry of the whole swarm in shared memory. Each worker only writes the slots of its own drones.'''
+    def __init__(self, n_drones, name=None):
+        self.shm = _shared_memory(name, max(1, n_drones) * TELEMETRY_DTYPE.itemsize)
+        self.slots = np.ndarray(n_drones, dtype=TELEMETRY_DTYPE, buffer=self.shm.buf)
+        if name is None:
+            self.slots[:] = np.zeros(n_drones, dtype=TELEMETRY_DTYPE)
+            self.slots["info"] = np.nan
+            self.slots["velocity"] = np.nan
+        # Only serialises the writers of one slot inside a worker (link thread and command thread), never seen by the reader
+        self._write_locks = [threading.Lock() for _ in range(n_drones)]
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def _write(self, i, counter=None, **fields):
+        slots = self.slots
+        with self._write_locks[i]:
+            slots["seq"][i] += 1
+            for field, value in fields.items():
+                slots[field][i] = value
+            if counter:
+                slots[counter][i] += 1
+            slots["seq"][i] += 1
+
+    def write_status(self, i, ts, vbat, info):
+        self._write(i, "status_count", status_ts=ts, vbat=vbat, info=info)
+
+    def write_position(self, i, ts, position, velocity):
+        self._write(i, "position_count", position_ts=ts, position=position, velocity=velocity)
+
+    def write_link(self, i, link, event=False):
+        self._write(i, "link_events" if event else None, link=link)
+
+    def read(self):
+        """(copy of all slots, mask of the slots that were copied consistently)"""
+        before = self.slots["seq"].copy()
+        data = self.slots.copy()
+        after = self.slots["seq"]
+        return data, (before == after) & (before % 2 == 0) & (data["seq"] == before)
+
+    def close(self, unlink=False):
+        self.slots = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class EmergencyFlags:
+    '''Stop requests of the whole swarm in shared memory, one slot per drone. Only the main process
+    writes them (head first, seq last), each worker only reads the slots of its own drones.'''
+    def __init__(self, n_drones, name=None):
+        self.shm = _shared_memory(name, max(1, n_drones) * EMERGENCY_DTYPE.itemsize)
+        self.slots = np.ndarray(n_drones, dtype=EMERGENCY_DTYPE, buffer=self.shm.buf)
+        if name is None:
+            self.slots[:] = np.zeros(n_drones, dtype=EMERGENCY_DTYPE)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def request(self, i, head):
+        self.slots["head"][i] = head
+        self.slots["seq"][i] += 1  # published only once head is written
+
+    def close(self, unlink=False):
+        self.slots = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class CommandRing:
+    '''Commands for one worker in shared memory. put() must only be called from one thread at a time
+    (the main process serialises its senders), get() only from the worker.'''
+    def __init__(self, capacity=worker_command_capacity, name=None):
+        self.shm = _shared_memory(name, 16 + capacity * COMMAND_DTYPE.itemsize)
+        self._index = np.ndarray(2, dtype="<u8", buffer=self.shm.buf)  # head (next write), tail (next read)
+        self._slots = np.ndarray(capacity, dtype=COMMAND_DTYPE, buffer=self.shm.buf, offset=16)
+        self.capacity = capacity
+        if name is None:
+            self._index[:] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def head(self):
+        """Index of the next command put, read without taking the producer's lock."""
+        return int(self._index[0])
+
+    @property
+    def tail(self):
+        """Index of the next command get() returns."""
+        return int(self._index[1])
+
+    def put(self, kind, drone, *args):
+        head = int(self._index[0])
+        while head - int(self._index[1]) >= self.capacity:
+            time.sleep(worker_idle_sleep)  # full, the worker is behind
+        i = head % self.capacity
+        self._slots["kind"][i] = kind
+        self._slots["drone"][i] = drone
+        self._slots["args"][i] = tuple(args) + (0.0,) * (5 - len(args))
+        self._index[0] = head + 1  # published only once the command is written
+
+    def get(self):
+        """Next command as (kind, drone, args), None if there is none."""
+        tail = int(self._index[1])
+        if tail == int(self._index[0]):
+            return None
+        i = tail % self.capacity
+        command = (int(self._slots["kind"][i]), int(self._slots["drone"][i]), self._slots["args"][i].tolist())
+        self._index[1] = tail + 1
+        return command
+
+    def close(self, unlink=False):
+        self._index = self._slots = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class RadioWorker:
+    '''Runs in the worker process: opens the links, writes their telemetry and executes the commands.'''
+    def __init__(self, dongle, slots, table_name, ring_name, emergency_name, n_drones):
+        from cflib.crazyflie import Crazyflie
+        from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
+        from cflib.crazyflie.log import LogConfig
+        self._Crazyflie, self._SyncCrazyflie, self._LogConfig = Crazyflie, SyncCrazyflie, LogConfig
+        self.dongle = dongle
+        self.slots = slots  # {uri: slot in the table}
+        self.uris = {i: uri for uri, i in slots.items()}
+        self.table = TelemetryTable(n_drones, name=table_name)
+        self.commands = CommandRing(name=ring_name)
+        self.emergency = EmergencyFlags(n_drones, name=emergency_name)
+        self._mine = np.array(sorted(slots.values()), dtype=int)  # slots of the drones of this radio
+        self._stops_seen = self.emergency.slots["seq"][self._mine].copy()
+        self._drop_before = {}  # {slot: ring index}, movement commands queued before an emergency stop
+        self.scfs = {}  # {uri: SyncCrazyflie}
+        self.position_logs = {}  # {uri: LogConfig}
+
+    def _callbacks(self, i):
+        table = self.table
+
+        def _status(ts, data, logconf):
+            table.write_status(i, ts, data.get('pm.vbat', np.nan), data.get('supervisor.info', np.nan))
+
+        def _position(ts, data, logconf):
+            position, velocity = read_sample(data)
+            if position is not None:
+                table.write_position(i, ts, position, velocity or (np.nan, np.nan, np.nan))
+        return _status, _position
+
+    def connect(self, uri, period_in_ms):
+        i = self.slots[uri]
+        self.table.write_link(i, LINK_CONNECTING)
+        self.close(uri)
+        try:
+            scf = self._SyncCrazyflie(uri, cf=self._Crazyflie(rw_cache='./cache'))
+            scf.open_link()
+            status_log = self._LogConfig(name=f'bat_{uri}', period_in_ms=low_frequency_update_interval*1000)
+            for name, kind in STATUS_VARIABLES:
+                status_log.add_variable(name, kind)
+            position_log = self._LogConfig(name=f'pos_{uri}', period_in_ms=period_in_ms)
+            for name, kind in position_variables():
+                position_log.add_variable(name, kind)
+            _status, _position = self._callbacks(i)
+            for log, callback in ((status_log, _status), (position_log, _position)):
+                scf.cf.log.add_config(log)
+                log.data_received_cb.add_callback(callback)
+                log.start()
+            self.scfs[uri] = scf
+            self.position_logs[uri] = position_log
+            self.table.write_link(i, LINK_CONNECTED, event=True)
+        except Exception as e:
+            print(f"[ERROR] Radio {self.dongle} could not connect to {uri}: {e}")
+            self.table.write_link(i, LINK_FAILED, event=True)
+
+    def close(self, uri):
+        scf = self.scfs.pop(uri, None)
+        self.position_logs.pop(uri, None)
+        if scf is not None:
+            try:
+                scf.close_link()
+            except Exception:
+                pass
+
+    def execute(self, kind, uri, args):
+        if kind == CONNECT:
+            # Opening a link can take seconds, the other drones keep receiving their commands meanwhile
+            threading.Thread(target=self.connect, args=(uri, int(args[0])), daemon=True).start()
+            return
+        if kind == LOG_PERIOD:
+            log = self.position_logs.get(uri)
+            if log is not None:
+                # start() sends period (10 ms units), which cflib only derives from period_in_ms in the constructor
+                log.period_in_ms = int(args[0])
+                log.period = int(log.period_in_ms / 10)
+                log.start()
+            return
+        scf = self.scfs.get(uri)
+        if scf is None:
+            return
+        if kind == TAKEOFF:
+            scf.cf.high_level_commander.takeoff(args[0], args[1])
+        elif kind == LAND:
+            scf.cf.high_level_commander.land(args[0], args[1])
+        elif kind == GO_TO:
+            scf.cf.high_level_commander.go_to(*args[:5])
+        elif kind == SETPOINT:
+            scf.cf.commander.send_position_setpoint(*args[:4])
+        elif kind == STOP:
+            scf.cf.commander.send_stop_setpoint()
+        elif kind == NOTIFY_STOP:
+            scf.cf.commander.send_notify_setpoint_stop()
+
+    def _check_emergency(self):
+        """Send the stop requested for any drone of this radio, before anything else."""
+        seq = self.emergency.slots["seq"][self._mine]
+        changed = np.flatnonzero(seq != self._stops_seen)
+        for k in changed.tolist():
+            i = int(self._mine[k])
+            self._stops_seen[k] = seq[k]
+            self._drop_before[i] = int(self.emergency.slots["head"][i])
+            scf = self.scfs.get(self.uris[i])
+            if scf is None:
+                continue
+            try:
+                scf.cf.commander.send_stop_setpoint()
+            except Exception as e:
+                print(f"[ERROR] Radio {self.dongle} emergency stop failed for {self.uris[i]}: {e}")
+
+    def run(self):
+        while True:
+            self._check_emergency()
+            index = self.commands.tail
+            command = self.commands.get()
+            if command is None:
+                time.sleep(worker_idle_sleep)
+                continue
+            kind, drone, args = command
+            if kind == SHUTDOWN:
+                break
+            if kind in MOVES and index < self._drop_before.get(drone, 0):
+                continue  # overtaken by an emergency stop
+            try:
+                self.execute(kind, self.uris.get(drone), args)
+            except Exception as e:
+                print(f"[ERROR] Radio {self.dongle} command {kind} failed for {self.uris.get(drone)}: {e}")
+        for uri in list(self.scfs):
+            self.close(uri)
+        self.commands.close()
+        self.emergency.close()
+        self.table.close()
+
+
+def run_worker(dongle, slots, table_name, ring_name, emergency_name, n_drones):
+    """Entry point of a worker process."""
+    logging.getLogger('cflib').setLevel(logging.ERROR)
+    import cflib.crtp
+    cflib.crtp.init_drivers(enable_debug_driver=False)
+    RadioWorker(dongle, slots, table_name, ring_name, emergency_name, n_drones).run()
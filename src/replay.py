@@ -0,0 +1,278 @@
+'''
+Replays a recorded flight through CrazyflieSwarm without flying.
+
+The recorded telemetry is fed into the swarm's own log callbacks and the recorded operator
+actions are issued again, on a virtual clock. The swarm logic (update loop, convergence gating,
+formation recompute) runs unmodified, and the commands it produces are compared against the
+commands recorded in flight.
+
+The custom shapes (shapes.py) added during the flight are recorded by name only: they are given to
+ReplayEngine(shapes=...), an action on a shape the replay was not given is reported as a divergence.
+
+Usage: python replay.py flights/<session>.rec [--speed N] [--verbose]
+'''
+import argparse
+import contextlib
+import io
+import sys
+
+import numpy as np
+
+from clock import ReplayClock
+from drone_commands import CrazyflieSwarm
+from flight_recorder import (load_session, NAN, KINDS, STATES, OPERATOR_ACTIONS, SWARM, COMMAND_KINDS,
+                             LOG_POSITION, LOG_STATUS, OPERATOR, STATE)
+from config import replay_time_tolerance, replay_value_tolerance
+
+
+# ---------------------------
+# RADIO STAND-INS
+# ---------------------------
+class _ReplayHighLevelCommander:
+    def takeoff(self, *args, **kwargs):
+        pass
+
+    def land(self, *args, **kwargs):
+        pass
+
+    def go_to(self, *args, **kwargs):
+        pass
+
+
+class _ReplayCommander:
+    def send_position_setpoint(self, *args, **kwargs):
+        pass
+
+    def send_stop_setpoint(self, *args, **kwargs):
+        pass
+
+    def send_notify_setpoint_stop(self, *args, **kwargs):
+        pass
+
+
+class _ReplayCrazyflie:
+    def __init__(self):
+        self.high_level_commander = _ReplayHighLevelCommander()
+        self.commander = _ReplayCommander()
+
+
+class _ReplayLink:
+    '''Takes the place of a SyncCrazyflie. Commands go nowhere, CommandCapture sees them through the recorder hooks.'''
+    def __init__(self, uri):
+        self.uri = uri
+        self.cf = _ReplayCrazyflie()
+
+    def close_link(self):
+        pass
+
+
+class CommandCapture:
+    '''Takes the place of the FlightRecorder of a replayed swarm and keeps everything it produces, in virtual time.'''
+    def __init__(self, uris, clock):
+        self.clock = clock
+        self._index = {uri: i for i, uri in enumerate(uris)}
+        self.records = []  # [(t, kind, drone, (a, b, c, d))]
+
+    def record(self, kind, uri, a=NAN, b=NAN, c=NAN, d=NAN, ts=0):
+        self.records.append((self.clock.time(), kind, self._index[uri], (a, b, c, d)))
+
+    def state_change(self, uri, state):
+        self.record(STATE, uri, STATES.index(state) if state in STATES else NAN)
+
+    def operator(self, action, uri=None):
+        pass  # operator actions are inputs of the replay, not outputs
+
+    def add_action(self, name):
+        pass
+
+    def close(self):
+        pass
+
+
+class ReplaySwarm(CrazyflieSwarm):
+    '''CrazyflieSwarm whose radio links are replaced by a recording. Only the link boundary is
+    overridden, everything else is the flight code.'''
+    def __init__(self, session, clock):
+        super().__init__(session.uris, clock=clock, record=False)
+        self.recorder = CommandCapture(session.uris, clock)
+        self.callbacks = {}  # {uri: (low freq callback, high freq callback)}
+        # A drone can be (re)connected as long as the recording still has telemetry for it
+        records = session.records
+        telemetry = records[np.isin(records["kind"], (LOG_POSITION, LOG_STATUS))]
+        self._last_telemetry = {}
+        for i, uri in enumerate(session.uris):
+            times = telemetry["t"][telemetry["drone"] == i]
+            if len(times):
+                self._last_telemetry[uri] = float(times.max())
+
+    def _open_link(self, uri):
+        if self.clock.time() > self._last_telemetry.get(uri, float("-inf")):
+            raise ConnectionError(f"No more telemetry recorded for {uri}")
+        return _ReplayLink(uri)
+
+    def _setup_logging(self, uri, scf):
+        self.callbacks[uri] = self._log_callbacks(uri)
+
+
+# ---------------------------
+# REPLAY
+# ---------------------------
+class ReplayEngine:
+    def __init__(self, path, speed=None, quiet=True, shapes=None):
+        '''
+        Args:
+            path (str): flight recording (.rec)
+            speed (float): replay at speed x real time, None to replay as fast as possible
+            quiet (bool): hide the swarm's prints during the replay
+            shapes (dict): {name: shape} custom shapes added to the swarm during the flight
+        '''
+        self.session = load_session(path)
+        self.clock = ReplayClock(self.session.header["start_time"], speed=speed)
+        self.swarm = ReplaySwarm(self.session, self.clock)
+        for name, shape in (shapes or {}).items():
+            self.swarm.add_shape(name, shape)
+        self.actions = self.session.header.get("operator_actions", OPERATOR_ACTIONS)
+        self.quiet = quiet
+        self.errors = []  # operator actions that raised: [(t, action, uri, error)]
+
+    def _start_swarm(self):
+        # Same start up as main.py
+        self.swarm.connect_all()
+        self.swarm.run()
+
+    def _operator(self, action, uri):
+        # A replayed action that raises is a divergence: the flight went on, the replay cannot say where it would go
+        if action not in OPERATOR_ACTIONS and action not in self.swarm.formations.shapes:
+            self.errors.append((self.clock.time(), action, uri, "custom shape not given to the replay"))
+            return
+        try:
+            self.swarm.operator_command(action, uri)
+        except Exception as e:
+            self.errors.append((self.clock.time(), action, uri, f"{type(e).__name__}: {e}"))
+
+    def _deliver(self, kind, drone, ts, v):
+        uri = self.session.uris[drone]
+        callbacks = self.swarm.callbacks.get(uri)
+        if callbacks is None:
+            return  # the replayed swarm is not connected to this drone
+        if kind == LOG_POSITION:
+            names = ('kalman.stateX', 'kalman.stateY', 'kalman.stateZ')
+            data = {name: value for name, value in zip(names, v) if value == value}  # skip NaN
+            callbacks[1](ts, data, None)
+        else:
+            data = {}
+            if v[0] == v[0]:
+                data['pm.vbat'] = v[0]
+            if v[1] == v[1]:
+                data['supervisor.info'] = int(v[1])
+            callbacks[0](ts, data, None)
+
+    def run(self):
+        """Replay the whole session and return a ReplayReport."""
+        records = self.session.records
+        start_time = self.clock.time()
+        end_time = float(records["t"].max()) if len(records) else start_time
+        inputs = records[np.isin(records["kind"], (LOG_POSITION, LOG_STATUS, OPERATOR))]
+        inputs = inputs[np.argsort(inputs["t"], kind="stable")]
+
+        output = io.StringIO() if self.quiet else sys.stdout
+        with contextlib.redirect_stdout(output):
+            self.clock.start_thread(self._start_swarm)
+            columns = (inputs["t"].tolist(), inputs["ts"].tolist(), inputs["kind"].tolist(),
+                       inputs["drone"].tolist(), inputs["v"].tolist())
+            for t, ts, kind, drone, v in zip(*columns):
+                self.clock.advance_to(t, before=True)  # inputs at t came in before the swarm's own work at t
+                if kind == OPERATOR:
+                    uri = None if drone == SWARM else self.session.uris[drone]
+                    self.clock.start_thread(self._operator, (self.actions[int(v[0])], uri))
+                else:
+                    self._deliver(kind, drone, ts, v)
+            self.clock.advance_to(end_time)
+            # Let every thread of the swarm run to its end
+            self.swarm.running = False
+            self.swarm.watchdog.stop()
+            self.swarm._dynamic_formation_running = {uri: False for uri in self.swarm.uris}
+            deadline = self.clock.next_deadline()
+            while deadline is not None:
+                self.clock.advance_to(deadline)
+                deadline = self.clock.next_deadline()
+
+        produced = [r for r in self.swarm.recorder.records if r[0] <= end_time]
+        return ReplayReport(self.session, produced, errors=self.errors)
+
+
+class ReplayReport:
+    '''Commands and state changes produced by the replay, matched against the recorded ones.
+    Two records match when they have the same kind and drone, are less than time_tolerance apart and
+    their values agree within value_tolerance. Operator actions that raised during the replay are divergences too.'''
+    def __init__(self, session, produced, time_tolerance=replay_time_tolerance, value_tolerance=replay_value_tolerance, errors=()):
+        self.uris = session.uris
+        self.start_time = session.header["start_time"]
+        self.matched = {}  # {kind name: count}
+        self.missing = []  # recorded in flight, not produced by the replay: [(t, kind name, uri, values)]
+        self.unexpected = []  # produced by the replay, not recorded in flight
+        self.errors = sorted(errors, key=lambda r: r[0])  # operator actions that raised: [(t, action, uri, error)]
+        kinds = COMMAND_KINDS + (STATE,)
+
+        recorded = session.records[np.isin(session.records["kind"], kinds)]
+        groups = {}
+        for t, kind, drone, v in zip(recorded["t"].tolist(), recorded["kind"].tolist(), recorded["drone"].tolist(), recorded["v"].tolist()):
+            groups.setdefault((kind, drone), ([], []))[0].append((t, v))
+        for t, kind, drone, v in produced:
+            if kind in kinds:
+                groups.setdefault((kind, drone), ([], []))[1].append((t, v))
+
+        for (kind, drone), (flight, replay) in groups.items():
+            flight.sort(key=lambda r: r[0])
+            replay.sort(key=lambda r: r[0])
+            name, uri = KINDS[kind], self.uris[drone]
+            i = j = 0
+            while i < len(flight) or j < len(replay):
+                if i < len(flight) and j < len(replay):
+                    (ta, va), (tb, vb) = flight[i], replay[j]
+                    if abs(ta - tb) <= time_tolerance and np.allclose(va, vb, atol=value_tolerance, equal_nan=True):
+                        self.matched[name] = self.matched.get(name, 0) + 1
+                        i += 1
+                        j += 1
+                        continue
+                    take_flight = ta <= tb
+                else:
+                    take_flight = i < len(flight)
+                if take_flight:
+                    self.missing.append((flight[i][0], name, uri, flight[i][1]))
+                    i += 1
+                else:
+                    self.unexpected.append((replay[j][0], name, uri, replay[j][1]))
+                    j += 1
+        self.missing.sort(key=lambda r: r[0])
+        self.unexpected.sort(key=lambda r: r[0])
+
+    @property
+    def identical(self):
+        return not self.missing and not self.unexpected and not self.errors
+
+    def summary(self, max_lines=20):
+        lines = []
+        for name in sorted(set(self.matched) | {r[1] for r in self.missing} | {r[1] for r in self.unexpected}):
+            n_missing = sum(1 for r in self.missing if r[1] == name)
+            n_unexpected = sum(1 for r in self.unexpected if r[1] == name)
+            lines.append(f"[REPLAY] {name}: {self.matched.get(name, 0)} matched, {n_missing} missing, {n_unexpected} unexpected")
+        if self.errors:
+            lines.append(f"[REPLAY] operator: {len(self.errors)} action(s) raised")
+        for t, action, uri, error in self.errors[:max_lines]:
+            lines.append(f"[ERROR] t={t - self.start_time:.3f}s {action} {uri or 'swarm'}: {error}")
+        for label, entries in (("MISSING", self.missing), ("UNEXPECTED", self.unexpected)):
+            for t, name, uri, values in entries[:max_lines]:
+                lines.append(f"[{label}] t={t - self.start_time:.3f}s {name} {uri} {tuple(round(x, 3) for x in values)}")
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded flight through CrazyflieSwarm.")
+    parser.add_argument("path", help="flight recording (.rec)")
+    parser.add_argument("--speed", type=float, default=None, help="replay speed (1 = real time), as fast as possible if omitted")
+    parser.add_argument("--verbose", action="store_true", help="show the swarm's output during the replay")
+    args = parser.parse_args()
+
+    report = ReplayEngine(args.path, speed=args.speed, quiet=not args.verbose).run()
+    print(report.summary())
@@ -0,0 +1,138 @@
+'''
+Predictive geofence and separation checks on the whole swarm at once.
+
+Every drone is extrapolated along its current velocity over safety_horizon seconds. A drone is
+flagged when it is predicted to leave absolute_boundaries (the floor excepted, drones reach it when
+they land), and a pair when its closest approach within the horizon is below collision_threshold.
+Both are solved in closed form for straight-line motion, over all drones at once in a few NumPy
+operations. A pair can only come within collision_threshold if it is closer now than the threshold
+plus how far both drones go over the horizon: the closest approach is only solved for those pairs.
+
+Drones following a planned trajectory (go_to, streamed setpoints) slow down and turn where a
+straight line does not. They are predicted over the shorter safety_guided_horizon instead, at
+safety_guided_samples instants: along their streamed setpoints, offset by how far they are from
+them and by how fast that deviation grows (beyond safety_plan_tolerance, the error of the estimates), or in a straight line that stops at the target of their
+go_to and does not move away from it.
+'''
+from collections import namedtuple
+
+import numpy as np
+
+from config import (absolute_boundaries, collision_threshold, safety_horizon, safety_guided_horizon, safety_guided_samples,
+                    safety_plan_tolerance)
+
+# boundary: [(drone index, seconds until it leaves the arena, 0 if already outside)]
+# collisions: [(drone index, drone index, seconds until the closest approach, predicted distance)]
+SafetyReport = namedtuple("SafetyReport", ["boundary", "collisions"])
+
+
+class SafetyMonitor:
+    def __init__(self, n_drones, boundaries=absolute_boundaries, threshold=collision_threshold, horizon=safety_horizon,
+                 guided_horizon=safety_guided_horizon, guided_samples=safety_guided_samples, plan_tolerance=safety_plan_tolerance):
+        self.low = np.array([boundaries[axis][0] for axis in "xyz"])
+        self.low_fence = self.low.copy()
+        self.low_fence[2] = -np.inf  # the floor is not a wall: landing drones and noisy positions on takeoff meet it
+        self.high = np.array([boundaries[axis][1] for axis in "xyz"])
+        self.threshold = threshold
+        self.horizon = horizon
+        self.guided_horizon = guided_horizon
+        self.sample_times = np.linspace(0.0, guided_horizon, guided_samples)  # seconds from now, where guided drones are predicted
+        self.plan_tolerance = plan_tolerance
+        self._upper = np.triu(np.ones((n_drones, n_drones), dtype=bool), k=1)  # every pair once
+
+    def check(self, positions, velocities, active, guided=None, planned=None, targets=None):
+        '''
+        Args:
+            positions (ndarray): (n, 3) positions, NaN rows for drones without position
+            velocities (ndarray): (n, 3) velocities, NaN rows where unknown (taken as not moving)
+            active (ndarray): (n,) bool, drones that are flying. Grounded drones still count as obstacles
+            guided (ndarray): (n,) bool, drones following a planned trajectory (high level command to a position inside
+                the boundaries, validated setpoints). They slow down and turn where a straight line does not, so they
+                are only predicted over guided_horizon, at sample_times, and a pair of them too
+            planned (ndarray): (n, len(sample_times), 3) positions of the plan of each drone at sample_times (the
+                setpoints it is streamed), NaN rows for drones without one. A drone with a plan is predicted along
+                it, keeping its deviation from the plan and the rate at which the deviation grows: a drone lagging
+                behind its setpoints is caught, the turns of the plan itself are not taken for a conflict. The first
+                plan_tolerance of the deviation is the error of the estimate, not counted
+            targets (ndarray): (n, 3) where the go_to of each drone ends, NaN rows for none. A drone without a plan is
+                not predicted past its target in the direction of the target, it brakes there, nor further from it
+        Returns:
+            SafetyReport
+        '''
+        known = ~np.isnan(positions).any(axis=1)
+        p = np.where(known[:, None], positions, 0.0)
+        v = np.where(np.isnan(velocities), 0.0, velocities)
+        guided = np.zeros(len(p), dtype=bool) if guided is None else guided & known
+        times = self.sample_times
+
+        # Guided drones: predicted positions at the sample times, along their plan or in a straight line
+        predicted = p[:, None] + v[:, None] * times[None, :, None]
+        has_plan = np.zeros(len(p), dtype=bool) if planned is None else guided & ~np.isnan(planned).any(axis=(1, 2))
+        if has_plan.any():
+            plan = planned[has_plan]
+            drift = v[has_plan] - (plan[:, 1] - plan[:, 0]) / times[1]
+            deviation = (p[has_plan] - plan[:, 0])[:, None] + drift[:, None] * times[None, :, None]
+            size = np.linalg.norm(deviation, axis=2, keepdims=True)
+            predicted[has_plan] = plan + deviation * np.maximum(0.0, 1.0 - self.plan_tolerance / np.maximum(size, 1e-9))
+        braking = np.zeros(len(p), dtype=bool) if targets is None else guided & ~has_plan & ~np.isnan(targets).any(axis=1)
+        if braking.any():
+            to_target = targets[braking] - p[braking]
+            length = np.linalg.norm(to_target, axis=1)
+            direction = to_target / np.maximum(length, 1e-9)[:, None]
+            along = np.einsum("nkd,nd->nk", predicted[braking] - p[braking][:, None], direction)
+            ahead = predicted[braking] - np.maximum(along - length[:, None], 0.0)[..., None] * direction[:, None]
+            # Nor further from its target than it is now: it is on its way there, or settling on it
+            offset = ahead - targets[braking][:, None]
+            distance = np.linalg.norm(offset, axis=2, keepdims=True)
+            predicted[braking] = targets[braking][:, None] + offset * np.minimum(1.0, length[:, None, None] / np.maximum(distance, 1e-9))
+
+        # Geofence: time until each axis reaches its limit in the direction of travel
+        with np.errstate(divide="ignore", invalid="ignore"):
+            exit_times = np.where(v > 0, (self.high - p) / v, np.where(v < 0, (self.low_fence - p) / v, np.inf))
+        exit_time = np.maximum(exit_times.min(axis=1), 0.0)
+        out = ((predicted < self.low_fence) | (predicted > self.high)).any(axis=2)
+        exit_time[guided] = np.where(out[guided].any(axis=1), times[np.argmax(out[guided], axis=1)], np.inf)
+        outside = ((p < self.low_fence) | (p > self.high)).any(axis=1)
+        exit_time[outside] = 0.0
+        leaving = np.flatnonzero(active & known & (exit_time <= np.where(guided, self.guided_horizon, self.horizon)))
+
+        # Separation: a pair can only get under the threshold if it is closer now than the threshold plus how far both
+        # drones go over the horizon, the closest approach is only solved for those pairs (upper triangle of (n, n) masks)
+        square = np.einsum("nd,nd->n", p, p)
+        gap = np.sqrt(np.maximum(square[:, None] + square[None, :] - 2.0 * (p @ p.T), 0.0))
+        both = guided[:, None] & guided[None, :]
+        pairs, approaches = [], []
+        # Pairs moving in straight lines: closest approach within the horizon
+        reach = self.horizon * np.sqrt(np.einsum("nd,nd->n", v, v))
+        i, j = np.divmod(np.flatnonzero(self._upper & ~both & (gap < self.threshold + reach[:, None] + reach[None, :])), len(p))
+        if len(i):
+            dp = p[i] - p[j]
+            dv = v[i] - v[j]
+            speed2 = np.einsum("ij,ij->i", dv, dv)
+            t = np.clip(-np.einsum("ij,ij->i", dp, dv) / np.maximum(speed2, 1e-12), 0.0, self.horizon)
+            closest = dp + dv * t[:, None]
+            pairs.append((i, j))
+            approaches.append((t, np.sqrt(np.einsum("ij,ij->i", closest, closest))))
+        # Pairs of guided drones: closest of their predicted positions
+        offset = predicted - p[:, None]
+        reach = np.sqrt(np.einsum("nkd,nkd->nk", offset, offset).max(axis=1))
+        i, j = np.divmod(np.flatnonzero(self._upper & both & (gap < self.threshold + reach[:, None] + reach[None, :])), len(p))
+        if len(i):
+            gaps = predicted[i] - predicted[j]
+            gaps = np.sqrt(np.einsum("nkd,nkd->nk", gaps, gaps))
+            k = np.argmin(gaps, axis=1)
+            pairs.append((i, j))
+            approaches.append((times[k], gaps[np.arange(len(i)), k]))
+        collisions = []
+        for (i, j), (t, distance) in zip(pairs, approaches):
+            conflict = np.flatnonzero((distance < self.threshold) & known[i] & known[j] & (active[i] | active[j]))
+            collisions.extend((int(i[k]), int(j[k]), float(t[k]), float(distance[k])) for k in conflict)
+
+        return SafetyReport(
+            [(int(k), float(exit_time[k])) for k in leaving],
+            sorted(collisions),
+        )
+
+    def inside(self, position, margin):
+        """position moved inside the boundaries, at least margin from every wall."""
+        return tuple(np.clip(position, self.low + margin, self.high - margin).tolist())
@@ -0,0 +1,216 @@
+'''
+Formations of any shape: fill a 2D or 3D shape with N evenly spaced slots.
+
+A shape is either given by what is inside it (Polygon, Implicit), or by dense samples of it
+(PointCloud, Mesh). fill_shape() places the drones in three vectorized steps:
+- candidates: shape_candidates_per_slot random points of the shape per drone (rejection sampling
+  in the bounding box, or the samples themselves)
+- blue noise: farthest-point sampling picks N of the candidates, each one the candidate furthest
+  from the ones already picked, so the count is exact and no spacing has to be guessed
+- relaxation: shape_relaxation_iterations rounds in which every pair closer than
+  shape_relaxation_target x the spacing farthest-point sampling ended with (and never less than
+  drone_spacing) is pushed apart, each slot by half the missing distance. Pairs are found with a uniform grid instead of all pairs. A
+  slot pushed out of the shape goes part of the way or stays (PointCloud and Mesh: it has to stay
+  within the typical spacing of their samples from one of them)
+
+The result is refused with ValueError if two slots are closer than the spacing (drone_spacing).
+For a few hundred drones it takes milliseconds, so shapes can be made during a flight.
+'''
+import itertools
+import math
+
+import numpy as np
+
+from config import (absolute_boundaries, drone_spacing, shape_candidates_per_slot, shape_relaxation_iterations,
+                    shape_relaxation_target)
+
+_OFFSETS = np.array(list(itertools.product((-1, 0, 1), repeat=3)))
+
+
+class Shape:
+    '''Base of the shapes given by what is inside them: low and high are the corners of their bounding box.'''
+    def __init__(self, low, high):
+        self.low = np.asarray(low, dtype=float)
+        self.high = np.asarray(high, dtype=float)
+
+    def contains(self, points):
+        """Boolean array, True for the points ((n, 3) array) inside the shape."""
+        raise NotImplementedError
+
+    def candidates(self, count, rng):
+        """About count random points of the shape, (k, 3) array."""
+        found, total = [], 0
+        batch = count
+        for _ in range(20):
+            points = rng.uniform(self.low, self.high, size=(batch, 3))
+            points = points[self.contains(points)]
+            found.append(points)
+            total += len(points)
+            if total >= count:
+                break
+            # Draw more at once when few land inside
+            batch = min(int(batch * 4), 50 * count)
+        return np.concatenate(found)[:count]
+
+
+class Polygon(Shape):
+    '''Flat shape in the horizontal plane at height z (mid-height of the arena by default): the inside of a polygon, [(x, y), ...].'''
+    def __init__(self, vertices, z=None):
+        self.vertices = np.asarray(vertices, dtype=float)
+        self.z = sum(absolute_boundaries["z"]) / 2 if z is None else z
+        super().__init__(list(self.vertices.min(axis=0)) + [self.z], list(self.vertices.max(axis=0)) + [self.z])
+
+    def contains(self, points):
+        # Even-odd rule, one pass per edge over all the points
+        x, y = points[:, 0], points[:, 1]
+        inside = np.zeros(len(points), dtype=bool)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for (x1, y1), (x2, y2) in zip(self.vertices, np.roll(self.vertices, -1, axis=0)):
+                crosses = (y1 > y) != (y2 > y)
+                inside ^= crosses & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+        return inside & (np.abs(points[:, 2] - self.z) < 1e-9)
+
+
+class Implicit(Shape):
+    '''Shape where function(points) <= 0, within the box low-high. function takes an (n, 3) array and returns n values.
+    A box with low z == high z makes it a flat shape.'''
+    def __init__(self, function, low, high):
+        super().__init__(low, high)
+        self.function = function
+
+    def contains(self, points):
+        return (np.asarray(self.function(points)) <= 0) & np.all((points >= self.low) & (points <= self.high), axis=1)
+
+
+class PointCloud:
+    '''Shape given by dense samples of it, [(x, y, z), ...] (a scanned object, a drawing). The slots are picked among the samples.'''
+    contains = None
+
+    def __init__(self, points):
+        self.points = np.asarray(points, dtype=float)
+        self.low = self.points.min(axis=0)
+        self.high = self.points.max(axis=0)
+
+    def candidates(self, count, rng):
+        if len(self.points) <= count:
+            return self.points
+        return self.points[rng.choice(len(self.points), count, replace=False)]
+
+
+class Mesh(PointCloud):
+    '''Surface of a triangle mesh: vertices [(x, y, z), ...], faces [(i, j, k), ...] indices of the vertices.'''
+    def __init__(self, vertices, faces):
+        self.triangles = np.asarray(vertices, dtype=float)[np.asarray(faces)]  # (m, 3 corners, 3)
+        self.low = self.triangles.reshape(-1, 3).min(axis=0)
+        self.high = self.triangles.reshape(-1, 3).max(axis=0)
+        edges = self.triangles[:, 1:] - self.triangles[:, :1]
+        area = np.linalg.norm(np.cross(edges[:, 0], edges[:, 1]), axis=1)
+        self.weights = area / area.sum()
+
+    def candidates(self, count, rng):
+        # Uniform over the surface: triangles picked by area, uniform barycentric coordinates in them
+        triangles = self.triangles[rng.choice(len(self.triangles), count, p=self.weights)]
+        u, v = rng.random((2, count, 1))
+        flip = (u + v) > 1
+        u, v = np.where(flip, 1 - u, u), np.where(flip, 1 - v, v)
+        return triangles[:, 0] + u * (triangles[:, 1] - triangles[:, 0]) + v * (triangles[:, 2] - triangles[:, 0])
+
+
+def neighbours(points, others, radius):
+    """(i, j, distance) of every pair points[i], others[j] closer than radius, found with a grid of radius cells."""
+    origin = np.minimum(points.min(axis=0), others.min(axis=0))
+    cells = np.floor((others - origin) / radius).astype(np.int64) + 1
+    dims = np.maximum(cells.max(axis=0), np.floor((points.max(axis=0) - origin) / radius).astype(np.int64) + 1) + 2
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    own = np.floor((points - origin) / radius).astype(np.int64) + 1
+    own_keys = (own[:, 0] * dims[1] + own[:, 1]) * dims[2] + own[:, 2]
+    # All 27 neighbouring cells at once: the range of others in each, expanded into pairs
+    targets = (own_keys[:, None] + (_OFFSETS[:, 0] * dims[1] + _OFFSETS[:, 1]) * dims[2] + _OFFSETS[:, 2]).ravel()
+    start = np.searchsorted(sorted_keys, targets, side="left")
+    counts = np.searchsorted(sorted_keys, targets, side="right") - start
+    i = np.repeat(np.arange(len(points)).repeat(len(_OFFSETS)), counts)
+    j = order[np.repeat(start, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+    distance = np.linalg.norm(points[i] - others[j], axis=1)
+    close = distance < radius
+    return i[close], j[close], distance[close]
+
+
+def _farthest_points(candidates, n):
+    """Indices of n of the candidates, each the furthest from the ones before, starting next to the centroid, and the
+    distance of the candidate left furthest from them."""
+    candidates = candidates - candidates.mean(axis=0)
+    norms = (candidates ** 2).sum(axis=1)
+    chosen = np.empty(n, dtype=int)
+    chosen[0] = np.argmin(norms)
+    # Squared distances as |a|^2 - 2 a.b + |b|^2: one matrix-vector product per pick
+    distance = norms - 2 * candidates @ candidates[chosen[0]] + norms[chosen[0]]
+    for k in range(1, n):
+        chosen[k] = np.argmax(distance)
+        np.minimum(distance, norms - 2 * candidates @ candidates[chosen[k]] + norms[chosen[k]], out=distance)
+    return chosen, math.sqrt(max(distance.max(), 0.0))
+
+
+def _near(samples, reach):
+    """contains() of a shape given by samples: within the typical spacing of the samples from one of them."""
+    i, j, distance = neighbours(samples, samples, reach)
+    nearest = np.full(len(samples), reach)
+    np.minimum.at(nearest, i[i != j], distance[i != j])
+    tolerance = float(np.median(nearest))
+
+    def contains(points):
+        inside = np.zeros(len(points), dtype=bool)
+        inside[neighbours(points, samples, tolerance)[0]] = True
+        return inside
+    return contains
+
+
+def _relax(points, contains, target, iterations):
+    """Push apart the pairs closer than target, each point of a pair by half the missing distance, keeping the
+    points in the shape. Returns the spread with the largest closest pair found, and that distance (inf if none
+    are closer than target)."""
+    best, best_gap = points, -math.inf
+    for iteration in range(iterations + 1):
+        i, j, distance = neighbours(points, points, target)
+        pair = i != j
+        i, j, distance = i[pair], j[pair], distance[pair]
+        gap = distance.min() if len(distance) else math.inf
+        if gap > best_gap:
+            best, best_gap = points, gap
+        if iteration == iterations or not len(distance):
+            break
+        pair = distance > 0
+        i, j, distance = i[pair], j[pair], distance[pair]
+        push = (points[i] - points[j]) * ((target - distance) / (2 * distance))[:, None]
+        step = np.stack([np.bincount(i, push[:, axis], minlength=len(points)) for axis in range(3)], axis=1)
+        # A point pushed out of the shape only goes part of the way, or stays
+        moved = points + step
+        for fraction in (0.5, 0.25, 0.0):
+            outside = ~contains(moved)
+            if not outside.any():
+                break
+            moved[outside] = points[outside] + fraction * step[outside]
+        points = moved
+    return best, best_gap
+
+
+def fill_shape(shape, n_drones, spacing=drone_spacing, seed=0, iterations=shape_relaxation_iterations):
+    """(n_drones, 3) array of evenly spread slots in shape. Raises ValueError when two slots would be closer than spacing."""
+    rng = np.random.default_rng(seed)
+    candidates = shape.candidates(max(n_drones * shape_candidates_per_slot, 64), rng)
+    if len(candidates) < n_drones:
+        raise ValueError(f"Shape too small or too thin: {len(candidates)} samples found for {n_drones} drones.")
+    chosen, cover = _farthest_points(candidates, n_drones)
+    points = candidates[chosen]
+    if n_drones == 1:
+        return points
+    if cover == 0.0:
+        # Every distinct sample is a slot: nothing is left to tell the spacing of the shape from
+        raise ValueError(f"Shape too small or too thin: {len(candidates)} samples found for {n_drones} drones, more are needed to spread them.")
+    contains = shape.contains if shape.contains is not None else _near(candidates, cover)
+    # The target is at least the spacing, so that no pair closer than the spacing goes unmeasured
+    points, gap = _relax(points, contains, max(shape_relaxation_target * cover, spacing), iterations)
+    if gap < spacing:
+        raise ValueError(f"{n_drones} drones do not fit in the shape at {spacing} m spacing (closest slots {gap:.2f} m apart).")
+    return points
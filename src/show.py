@@ -0,0 +1,272 @@
+'''
+Headless show runner: flies a show script without the GUI.
+
+A show script lists timed cues, one per line:
+
+    <time> <action> [uri]     # comment
+
+time is in seconds from the start of the show, or +seconds after the previous cue. Actions are
+the operator actions of the GUI (takeoff, land, emergency_land, flat_square, circle, tilted_plane,
+moving_circle, sin_wave, cube_lattice, hcp_lattice, stacked_rings, sphere_shell, and takeoff_one /
+land_one with a uri) plus hold, which does nothing and
+keeps the current formation until its time (use it to end a show on a formation). The names of
+custom shapes added to the swarm (add_shape) are accepted when given to parse_show(). Cues go
+through swarm.operator_command, so shows are recorded and can be replayed like GUI sessions.
+
+Nothing here imports tkinter or matplotlib. With --simulate the show is flown by simulated drones
+(simulation.py) on a virtual clock, as fast as possible unless --speed is given.
+
+A show compiled by show_compiler.py can be given instead of a script: its formations are then
+flown as planned, including its fallback variants when a drone is lost, without planning anything.
+
+Usage: python show.py shows/demo.show [--simulate] [--speed N] [--drones N] [--loops N]
+       python show.py shows/demo.plan [--simulate] ...
+'''
+import argparse
+import math
+import sys
+import time
+from collections import namedtuple
+
+from clock import ReplayClock
+from drone_commands import CrazyflieSwarm
+from flight_recorder import OPERATOR_ACTIONS
+from config import (uris, metrics_http_port, metrics_dump_path, metrics_dump_interval, multiprocess_radios, export_rate,
+                    show_start_timeout, show_late_warning, landing_duration, plan_start_tolerance)
+
+SHOW_ACTIONS = OPERATOR_ACTIONS + ("hold",)
+PER_DRONE_ACTIONS = ("takeoff_one", "land_one")
+PLANNED_ACTIONS = ("flat_square", "circle", "tilted_plane", "moving_circle", "sin_wave",
+                   "cube_lattice", "hcp_lattice", "stacked_rings", "sphere_shell")
+FULL = -1  # variant of a compiled show with no drone lost
+
+# time: seconds from the start of the show, line: line number in the script
+Cue = namedtuple("Cue", ["time", "action", "uri", "line"])
+
+
+def parse_show(text, shapes=()):
+    """List of Cues of a show script, in time order. Raises ValueError on the first bad line.
+    shapes: names of the custom shapes the swarm flying the show has, they are actions too."""
+    cues = []
+    previous = 0.0
+    for number, raw in enumerate(text.splitlines(), 1):
+        fields = raw.split("#", 1)[0].split()
+        if not fields:
+            continue
+        if len(fields) < 2:
+            raise ValueError(f"line {number}: expected '<time> <action> [uri]'")
+        at, action, rest = fields[0], fields[1], fields[2:]
+        try:
+            t = previous + float(at[1:]) if at.startswith("+") else float(at)
+        except ValueError:
+            raise ValueError(f"line {number}: bad time '{at}'")
+        if t < previous:
+            raise ValueError(f"line {number}: cue at {t}s comes before the previous one ({previous}s)")
+        if action not in SHOW_ACTIONS and action not in shapes:
+            raise ValueError(f"line {number}: unknown action '{action}'")
+        if action in PER_DRONE_ACTIONS and len(rest) != 1:
+            raise ValueError(f"line {number}: {action} needs the uri of the drone")
+        if action not in PER_DRONE_ACTIONS and rest:
+            raise ValueError(f"line {number}: {action} takes no argument")
+        cues.append(Cue(t, action, rest[0] if rest else None, number))
+        previous = t
+    return cues
+
+
+def load_show(path, shapes=()):
+    with open(path) as f:
+        return parse_show(f.read(), shapes)
+
+
+class ShowRunner:
+    def __init__(self, swarm, cues, loops=1, plan=None):
+        '''
+        Args:
+            swarm (CrazyflieSwarm): any swarm, real, multi-process or simulated
+            cues (list): Cues of the show
+            loops (int): times the show is flown, 0 to repeat it until interrupted (soak tests)
+            plan (ShowPlan): compiled show (show_compiler.py), its formations are flown as planned
+        '''
+        self.swarm = swarm
+        self.cues = cues
+        self.loops = loops
+        self.plan = plan
+        self._variant = None  # drone lost in the variant of the plan flown by the last formation cue, FULL if none
+        self.lateness = []  # (loop, Cue, seconds late)
+        self.failed = []  # (loop, Cue, error)
+        self.completed = 0  # shows flown to the end
+        self.aborted = None  # reason the show stopped early
+
+    def wait_ready(self, timeout=show_start_timeout):
+        """Wait until every connected drone has a converged position. Returns the drones that are not ready."""
+        deadline = self.swarm.clock.time() + timeout
+        while True:
+            connected = [uri for uri, scf in self.swarm.scfs.items() if scf is not None]
+            waiting = [uri for uri in connected if not self.swarm.position_has_converged(uri)]
+            if not waiting or self.swarm.clock.time() >= deadline:
+                return waiting
+            self.swarm.clock.sleep(0.5)
+
+    def _check_plan(self):
+        """Use the plan only if the drones are where it was compiled for, otherwise plan live."""
+        positions = self.swarm.current_positions
+        for uri, planned in zip(self.plan.uris, self.plan.start_positions.tolist()):
+            position = positions.get(uri)
+            if position is None or math.dist(position[:2], planned[:2]) > plan_start_tolerance:
+                print(f"[SHOW] {uri} is not on its compiled start position, formations will be planned live")
+                self.plan = None
+                self.swarm.recalculate_formations = True
+                return
+
+    def _fly_planned(self, index, cue):
+        """Fly a formation cue from the plan. Returns False if the plan has no safe variant for the drones flying."""
+        flying = self.swarm.state_cache
+        missing = [i for i, uri in enumerate(self.plan.uris) if flying.get(uri) != "flying"]
+        if len(missing) > 1:
+            return False
+        variant = missing[0] if missing else FULL
+        segment = self.plan.segment(index, variant, entry=self._variant == FULL)
+        if segment is None:
+            return False
+        self._variant = variant
+        self.swarm.fly_planned(cue.action, *segment)
+        return True
+
+    def _fly(self, loop):
+        clock = self.swarm.clock
+        start = clock.time()
+        self._variant = FULL
+        for index, cue in enumerate(self.cues):
+            if not self.swarm.running:
+                self.aborted = "swarm stopped"
+                return
+            delay = start + cue.time - clock.time()
+            if delay > 0:
+                clock.sleep(delay, first=True)  # operator actions are inputs, see ReplayClock.sleep()
+            late = clock.time() - (start + cue.time)
+            if late > show_late_warning:
+                self.lateness.append((loop, cue, late))
+                print(f"[SHOW] Cue of line {cue.line} ({cue.action}) started {late:.2f}s late")
+            print(f"[SHOW] t={cue.time:.1f}s {cue.action}" + (f" {cue.uri}" if cue.uri else ""))
+            if cue.action == "hold":
+                continue
+            try:
+                if self.plan is not None and cue.action in PLANNED_ACTIONS:
+                    if self._fly_planned(index, cue):
+                        continue
+                    print(f"[SHOW] No compiled variant for the drones flying, planning {cue.action} live")
+                    self._variant = None
+                self.swarm.operator_command(cue.action, cue.uri)
+            except Exception as e:
+                # Same as a failed button in the GUI: the swarm keeps flying what it was flying
+                self.failed.append((loop, cue, str(e)))
+                print(f"[SHOW] Cue of line {cue.line} ({cue.action}) failed: {e}")
+        self.completed += 1
+
+    def execute(self):
+        """Connect, fly the show loops times, land whatever still flies and close the links."""
+        swarm = self.swarm
+        swarm.connect_all()
+        swarm.run()
+        try:
+            waiting = self.wait_ready()
+            if waiting:
+                print(f"[SHOW] No converged position for {', '.join(waiting)}, they will not take off")
+            if self.plan is not None:
+                self.swarm.recalculate_formations = False  # lost drones switch variant at the next cue
+                self._check_plan()
+            loop = 0
+            while self.loops == 0 or loop < self.loops:
+                print(f"[SHOW] Starting show {loop + 1}" + (f"/{self.loops}" if self.loops else ""))
+                self._fly(loop)
+                if self.aborted:
+                    break
+                loop += 1
+        except KeyboardInterrupt:
+            self.aborted = "interrupted"
+        finally:
+            if "flying" in swarm.state_cache.values():
+                print("[SHOW] Landing the drones that are still flying")
+                swarm.operator_command("land")
+                swarm.clock.sleep(landing_duration)
+            swarm.stop_background()
+            swarm.close_links()
+
+    def summary(self):
+        metrics = self.swarm.metrics
+        lines = [f"[SHOW] {self.completed} show(s) completed" + (f", aborted: {self.aborted}" if self.aborted else "")]
+        if self.lateness:
+            worst = max(late for _, _, late in self.lateness)
+            lines.append(f"[SHOW] {len(self.lateness)} late cue(s), worst {worst:.2f}s")
+        if self.failed:
+            lines.append(f"[SHOW] {len(self.failed)} failed cue(s): " + ", ".join(f"line {cue.line} ({error})" for _, cue, error in self.failed[:5]))
+        lines.append(f"[SHOW] connection losses: {metrics.total('connection_lost_total')}, "
+                     f"safety interventions: {metrics.total('safety_interventions_total')}")
+        return "\n".join(lines)
+
+
+def run_virtual(clock, runner):
+    """Execute the runner on a ReplayClock, driving virtual time until the show is over."""
+    thread = clock.start_thread(runner.execute)
+    while thread.is_alive():
+        deadline = clock.next_deadline()
+        if deadline is None:
+            break
+        clock.advance_to(deadline)
+    thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fly a show script without the GUI")
+    parser.add_argument("show", help="show script, or show compiled by show_compiler.py")
+    parser.add_argument("--simulate", action="store_true", help="fly simulated drones on a virtual clock")
+    parser.add_argument("--speed", type=float, default=None, help="with --simulate, pace the show at speed x real time")
+    parser.add_argument("--drones", type=int, default=None, help="with --simulate, number of drones instead of the uris of config.py")
+    parser.add_argument("--loops", type=int, default=1, help="times the show is flown, 0 to repeat until interrupted")
+    args = parser.parse_args()
+
+    plan = None
+    drones = uris if args.drones is None else [f"radio://0/80/2M/E7E7E7E7{i:02X}" for i in range(args.drones)]
+    try:
+        from show_compiler import ShowPlan, is_plan
+        if is_plan(args.show):
+            plan = ShowPlan(args.show)
+            cues = plan.cues()
+            drones = plan.uris  # a plan is made for its drones
+        else:
+            cues = load_show(args.show)
+    except (OSError, ValueError) as e:
+        print(f"[ERROR] Could not load {args.show}: {e}")
+        return 2
+
+    if args.simulate:
+        from simulation import SimulatedSwarm
+        clock = ReplayClock(time.time(), speed=args.speed)
+        swarm = SimulatedSwarm(drones, clock=clock)
+    else:
+        import cflib.crtp
+        cflib.crtp.init_drivers(enable_debug_driver=False)
+        if multiprocess_radios:
+            from multiprocess_swarm import MultiProcessSwarm
+            swarm = MultiProcessSwarm(drones)
+        else:
+            swarm = CrazyflieSwarm(drones)
+    if metrics_http_port:
+        swarm.metrics.serve(metrics_http_port)
+    if metrics_dump_path:
+        swarm.metrics.start_dump(metrics_dump_path, metrics_dump_interval)
+    if export_rate:
+        swarm.start_export()
+
+    runner = ShowRunner(swarm, cues, loops=args.loops, plan=plan)
+    if args.simulate:
+        run_virtual(clock, runner)
+    else:
+        runner.execute()
+    swarm.metrics.close()
+    print(runner.summary())
+    return 0 if runner.completed and not runner.aborted and not runner.failed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,310 @@
+'''
+Offline show compiler.
+
+Plans a whole show ahead of time for a given set of drones: every formation, its transition
+(the go_to steps of send_formation) and, for dynamic formations, one period of setpoints. Each
+formation cue is planned for the full swarm and for every swarm with one drone lost (N-1
+variants), both for a drone lost before the previous cue ("steady") and for one lost while the
+previous cue was flying ("entry": the transition starts from the full formation without it).
+Every segment is swept by the TrajectoryValidator. The result is written to one flat binary file
+that is memory-mapped at show time, so starting a show or switching variant is a table lookup.
+
+File layout (little endian, every block 8 byte aligned):
+    PLAN_HEADER_DTYPE
+    drones x "S64"              uris
+    cues x CUE_DTYPE
+    segments x SEGMENT_DTYPE
+    drones x 3 float32          start positions (layout on the floor)
+    steps x drones x 3 float32  go_to targets of the transitions, NaN for drones not in the segment
+    waypoints x drones x 4 float32  setpoints (x, y, z, yaw) of the dynamic formations, NaN likewise
+
+Usage: python show_compiler.py shows/demo.show -o shows/demo.plan [--drones N] [--layout file]
+'''
+import argparse
+import math
+import sys
+import time
+
+import numpy as np
+
+from formations import FormationCalculator, VOLUMETRIC_FORMATIONS
+from trajectory_validator import TrajectoryValidator
+from show import load_show, SHOW_ACTIONS, PER_DRONE_ACTIONS, FULL
+from config import (uris, takeoff_height, formation_transition_duration, dynamic_waypoint_dt, dynamic_max_speed,
+                    circle_rotation_period, sin_wave_period)
+
+PLAN_MAGIC = b"UWBS"
+PLAN_VERSION = 2
+PLAN_HEADER_DTYPE = np.dtype([("magic", "S4"), ("version", "<u2"), ("drones", "<u2"), ("cues", "<u4"), ("segments", "<u4"),
+                              ("steps", "<u4"), ("waypoints", "<u4"), ("waypoint_dt", "<f4"), ("step_duration", "<f4"),
+                              ("clearance", "<f4"), ("pad", "<u4")])
+CUE_DTYPE = np.dtype([("time", "<f8"), ("action", "u1"), ("pad", "u1", (7,))])  # action: index in SHOW_ACTIONS
+SEGMENT_DTYPE = np.dtype([
+    ("cue", "<u4"),
+    ("missing", "<i2"),        # drone lost in this variant, -1 for the full swarm
+    ("entry", "u1"),           # 1 if the drone was lost while the previous cue was flying
+    ("safe", "u1"),
+    ("step_offset", "<u4"), ("steps", "<u4"),
+    ("waypoint_offset", "<u4"), ("waypoints", "<u4"),
+    ("clearance", "<f4"), ("boundary_margin", "<f4"),
+])
+STATIC_FORMATIONS = ("flat_square", "circle", "tilted_plane") + VOLUMETRIC_FORMATIONS
+DYNAMIC_FORMATIONS = {"moving_circle": circle_rotation_period, "sin_wave": sin_wave_period}
+
+
+def _align(offset):
+    return (offset + 7) // 8 * 8
+
+
+def load_layout(path):
+    """{uri: (x, y, z)} from a text file with one 'uri x y z' line per drone."""
+    layout = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split("#", 1)[0].split()
+            if fields:
+                layout[fields[0]] = tuple(float(value) for value in fields[1:4])
+    return layout
+
+
+class _Segment:
+    __slots__ = ("cue", "missing", "entry", "steps", "trajectories", "report", "safe")
+
+
+class ShowCompiler:
+    def __init__(self, drones, layout=None):
+        '''
+        Args:
+            drones (list): uris of the show
+            layout (dict): {uri: (x, y, z)} positions the drones take off from, the simulated grid if None
+        '''
+        if layout is None:
+            from simulation import ground_positions  # same grid as the simulated drones
+            layout = ground_positions(drones)
+        self.uris = list(drones)
+        self.index = {uri: i for i, uri in enumerate(self.uris)}
+        self.layout = {uri: tuple(layout[uri]) for uri in self.uris}
+        self.calculator = FormationCalculator()
+        self.validator = TrajectoryValidator()
+        self.segments = []
+
+    # ---------------------------
+    # PLANNING
+    # ---------------------------
+    def _transition(self, current, target):
+        """Same plan as CrazyflieSwarm._transition_plan, from planned instead of measured positions."""
+        current = {uri: current[uri] for uri in target if uri in current}
+        if current and self.calculator.positions_intersect(current, target):
+            return current, self.calculator.transition_positions(current, target)
+        return current, [target]
+
+    def _formation(self, action, members):
+        """(start positions, trajectories or None) of a formation for the drones in members."""
+        drones = {uri: True for uri in members}
+        if action in STATIC_FORMATIONS:
+            return getattr(self.calculator, action)(drones), None
+        period = DYNAMIC_FORMATIONS[action]
+        start, trajectories = getattr(self.calculator, action)(drones, period=period)
+        waypoints = np.array([[waypoint[:3] for waypoint in trajectories[uri]] for uri in trajectories])
+        peak_speed = np.linalg.norm(np.roll(waypoints, -1, axis=1) - waypoints, axis=2).max() / dynamic_waypoint_dt
+        if peak_speed > dynamic_max_speed:
+            # Same stretch as CrazyflieSwarm.start_dynamic_formation
+            period = math.ceil(period * peak_speed / dynamic_max_speed / dynamic_waypoint_dt) * dynamic_waypoint_dt
+            start, trajectories = getattr(self.calculator, action)(drones, period=period)
+        return start, trajectories
+
+    def _plan(self, cue_index, missing, entry, action, current):
+        """Plan one segment from the planned positions current. None if no drone of current is left."""
+        members = [uri for uri in current if self.index[uri] != missing]
+        if not members:
+            return None
+        start, trajectories = self._formation(action, members)
+        current, steps = self._transition({uri: current[uri] for uri in members}, start)
+        hold = trajectories or {uri: [position + (0.0,)] for uri, position in start.items()}
+        segment = _Segment()
+        segment.cue, segment.missing, segment.entry = cue_index, missing, entry
+        segment.steps, segment.trajectories = steps, trajectories
+        segment.report = self.validator.validate(hold, dynamic_waypoint_dt, [current] + steps, formation_transition_duration)
+        segment.safe = self.validator.is_safe(segment.report)
+        self.segments.append(segment)
+        return segment
+
+    def _end_positions(self, segment, start, duration):
+        """Planned positions when the next cue comes, duration seconds after this one."""
+        if segment.trajectories is None:
+            return dict(start)
+        # Setpoint streamed when the next cue arrives, see send_dynamic_formation
+        streaming = max(duration - len(segment.steps) * formation_transition_duration, 0.0)
+        step = int(streaming / dynamic_waypoint_dt)
+        return {uri: tuple(sequence[step % len(sequence)][:3]) for uri, sequence in segment.trajectories.items()}
+
+    def compile(self, cues):
+        """Plan every variant of every cue. Raises ValueError for cues a compiled show cannot fly."""
+        n = len(self.uris)
+        # Planned positions of the flying drones, per variant (FULL or the index of the lost drone)
+        flying = {variant: {} for variant in [FULL] + list(range(n))}
+        for c, cue in enumerate(cues):
+            duration = cues[c + 1].time - cue.time if c + 1 < len(cues) else 0.0
+            if cue.action in PER_DRONE_ACTIONS:
+                raise ValueError(f"line {cue.line}: {cue.action} changes the formation live, it cannot be compiled")
+            if cue.action == "takeoff":
+                for variant, positions in flying.items():
+                    for uri in self.uris:
+                        if self.index[uri] != variant and uri not in positions:
+                            x, y, _ = self.layout[uri]
+                            positions[uri] = (x, y, takeoff_height)
+            elif cue.action in ("land", "emergency_land"):
+                for positions in flying.values():
+                    positions.clear()
+            elif cue.action in STATIC_FORMATIONS or cue.action in DYNAMIC_FORMATIONS:
+                if not flying[FULL]:
+                    raise ValueError(f"line {cue.line}: {cue.action} with no drone flying")
+                full_before = dict(flying[FULL])
+                for variant in flying:
+                    segment = self._plan(c, variant, False, cue.action, flying[variant])
+                    if segment is None:
+                        continue
+                    if variant != FULL:
+                        # Lost during the previous cue: the others are still where the full swarm was
+                        self._plan(c, variant, True, cue.action, full_before)
+                    start = {uri: step for uri, step in segment.steps[-1].items()}
+                    flying[variant] = self._end_positions(segment, start, duration)
+        return self.segments
+
+    # ---------------------------
+    # ARTIFACT
+    # ---------------------------
+    def write(self, path, cues):
+        n = len(self.uris)
+        steps_pool, waypoint_pool = [], []
+        table = np.zeros(len(self.segments), dtype=SEGMENT_DTYPE)
+        step_rows = waypoint_rows = 0
+        for k, segment in enumerate(self.segments):
+            steps = np.full((len(segment.steps), n, 3), np.nan, dtype=np.float32)
+            for s, step in enumerate(segment.steps):
+                for uri, position in step.items():
+                    steps[s, self.index[uri]] = position
+            waypoints = np.zeros((0, n, 4), dtype=np.float32)
+            if segment.trajectories:
+                length = len(next(iter(segment.trajectories.values())))
+                waypoints = np.full((length, n, 4), np.nan, dtype=np.float32)
+                for uri, sequence in segment.trajectories.items():
+                    waypoints[:, self.index[uri]] = sequence
+            table[k] = (segment.cue, segment.missing, segment.entry, segment.safe, step_rows, len(steps),
+                        waypoint_rows, len(waypoints), segment.report.clearance, segment.report.boundary_margin)
+            steps_pool.append(steps)
+            waypoint_pool.append(waypoints)
+            step_rows += len(steps)
+            waypoint_rows += len(waypoints)
+
+        header = np.zeros(1, dtype=PLAN_HEADER_DTYPE)
+        full = [segment.report.clearance for segment in self.segments if segment.missing == FULL]
+        header[0] = (PLAN_MAGIC, PLAN_VERSION, n, len(cues), len(self.segments), step_rows, waypoint_rows,
+                     dynamic_waypoint_dt, formation_transition_duration, min(full) if full else np.inf, 0)
+        cue_table = np.zeros(len(cues), dtype=CUE_DTYPE)
+        cue_table["time"] = [cue.time for cue in cues]
+        cue_table["action"] = [SHOW_ACTIONS.index(cue.action) for cue in cues]
+        blocks = [header, np.array(self.uris, dtype="S64"), cue_table, table,
+                  np.array([self.layout[uri] for uri in self.uris], dtype=np.float32).reshape(n, 3),
+                  np.concatenate(steps_pool) if steps_pool else np.zeros((0, n, 3), np.float32),
+                  np.concatenate(waypoint_pool) if waypoint_pool else np.zeros((0, n, 4), np.float32)]
+        with open(path, "wb") as f:
+            for block in blocks:
+                data = np.ascontiguousarray(block).tobytes()
+                f.write(data)
+                f.write(b"\0" * (_align(len(data)) - len(data)))
+        return sum(_align(np.ascontiguousarray(block).nbytes) for block in blocks)
+
+
+class ShowPlan:
+    '''A compiled show, memory-mapped. Nothing is planned or copied until a segment is asked for.'''
+    def __init__(self, path):
+        self._map = np.memmap(path, dtype=np.uint8, mode="r")
+        header = np.frombuffer(self._map, dtype=PLAN_HEADER_DTYPE, count=1)[0]
+        if header["magic"] != PLAN_MAGIC or header["version"] != PLAN_VERSION:
+            raise ValueError(f"{path} is not a compiled show")
+        n = int(header["drones"])
+        self.waypoint_dt = float(header["waypoint_dt"])
+        self.step_duration = float(header["step_duration"])
+        self.clearance = float(header["clearance"])
+        offset = _align(PLAN_HEADER_DTYPE.itemsize)
+
+        def block(dtype, count, shape=()):
+            nonlocal offset
+            array = np.frombuffer(self._map, dtype=dtype, count=count * int(np.prod(shape, dtype=int)), offset=offset)
+            offset += _align(array.nbytes)
+            return array.reshape((count,) + shape) if shape else array
+
+        self.uris = [uri.decode() for uri in block("S64", n)]
+        self.cue_table = block(CUE_DTYPE, int(header["cues"]))
+        self.segment_table = block(SEGMENT_DTYPE, int(header["segments"]))
+        self.start_positions = block(np.float32, n, (3,))
+        self._steps = block(np.float32, int(header["steps"]), (n, 3))
+        self._waypoints = block(np.float32, int(header["waypoints"]), (n, 4))
+        self._lookup = {(int(row["cue"]), int(row["missing"]), bool(row["entry"])): k for k, row in enumerate(self.segment_table)}
+
+    def cues(self):
+        """Cues of the show, as parsed from its script (without line numbers)."""
+        from show import Cue
+        return [Cue(float(row["time"]), SHOW_ACTIONS[row["action"]], None, k + 1) for k, row in enumerate(self.cue_table)]
+
+    def segment(self, cue, missing=FULL, entry=False):
+        """(transition, trajectories or None) of a cue as CrazyflieSwarm.fly_planned takes them, None if that
+        variant is not planned or not safe."""
+        k = self._lookup.get((cue, missing, bool(entry) and missing != FULL))
+        if k is None or not self.segment_table[k]["safe"]:
+            return None
+        row = self.segment_table[k]
+        steps = self._steps[row["step_offset"]:row["step_offset"] + row["steps"]]
+        members = np.flatnonzero(~np.isnan(steps[-1, :, 0]))
+        transition = [{self.uris[i]: tuple(step[i].tolist()) for i in members} for step in steps]
+        trajectories = None
+        if row["waypoints"]:
+            waypoints = self._waypoints[row["waypoint_offset"]:row["waypoint_offset"] + row["waypoints"]]
+            trajectories = {self.uris[i]: [tuple(waypoint) for waypoint in waypoints[:, i].tolist()] for i in members}
+        return transition, trajectories
+
+
+def is_plan(path):
+    with open(path, "rb") as f:
+        return f.read(len(PLAN_MAGIC)) == PLAN_MAGIC
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile a show script into a memory-mappable plan")
+    parser.add_argument("show", help="show script")
+    parser.add_argument("-o", "--output", required=True, help="compiled show file")
+    parser.add_argument("--drones", type=int, default=None, help="number of simulated drones instead of the uris of config.py")
+    parser.add_argument("--layout", default=None, help="file with one 'uri x y z' line per drone, their takeoff positions")
+    args = parser.parse_args()
+
+    drones = uris if args.drones is None else [f"radio://0/80/2M/E7E7E7E7{i:02X}" for i in range(args.drones)]
+    start = time.perf_counter()
+    try:
+        cues = load_show(args.show)
+        compiler = ShowCompiler(drones, load_layout(args.layout) if args.layout else None)
+        segments = compiler.compile(cues)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"[ERROR] Could not compile {args.show}: {e}")
+        return 2
+    elapsed = time.perf_counter() - start
+
+    unsafe = [segment for segment in segments if not segment.safe]
+    for segment in unsafe:
+        cue = cues[segment.cue]
+        variant = "full swarm" if segment.missing == FULL else f"without {drones[segment.missing]}" + (" (entry)" if segment.entry else "")
+        print(f"[SAFETY] line {cue.line} {cue.action}, {variant}: clearance {segment.report.clearance:.2f}m, "
+              f"boundary margin {segment.report.boundary_margin:.2f}m")
+    if any(segment.missing == FULL for segment in unsafe):
+        print("[ERROR] The full swarm is not safe, no plan written")
+        return 1
+    size = compiler.write(args.output, cues)
+    clearance = min((segment.report.clearance for segment in segments if segment.missing == FULL), default=math.inf)
+    print(f"[OK] {args.output}: {len(cues)} cues, {len(segments)} segments for {len(drones)} drones "
+          f"({len(unsafe)} unsafe fallback variants left to live planning), {size / 1024:.1f} KiB, "
+          f"clearance {clearance:.2f}m, compiled in {elapsed:.2f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
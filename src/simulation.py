@@ -0,0 +1,243 @@
+'''
+Simulated drones behind the link boundary of CrazyflieSwarm.
+
+Like the replay, SimulatedSwarm only replaces the links: the commands of the high level commander
+and of the commander move simple kinematic drones, and the telemetry of those drones is fed into
+the swarm's own log callbacks, at the log periods the swarm asks for. Everything runs on the
+swarm's clock, so a simulation runs in real time on a SystemClock or as fast as possible on a
+ReplayClock (see show.py).
+
+The model is only meant to exercise the swarm logic: high level commands move in a straight line
+with a smooth time profile, streamed setpoints are followed at simulation_setpoint_speed, a stop
+setpoint drops the drone to the floor unless the high level commander is notified right after it
+(it then holds the drone where it is), and the battery drains linearly.
+'''
+import math
+import threading
+
+import numpy as np
+
+from drone_commands import CrazyflieSwarm
+from config import (absolute_boundaries, drone_spacing, low_frequency_update_interval, simulation_step, simulation_position_noise,
+                    simulation_setpoint_speed, simulation_battery_full, simulation_battery_drain_flying, simulation_battery_drain_ground)
+
+# supervisor.info bits used by the swarm (see _supervisor_cb in drone_commands.py)
+CAN_FLY = 1 << 3
+IS_FLYING = 1 << 4
+FLOOR = absolute_boundaries["z"][0]
+
+
+def ground_positions(uris, spacing=2 * drone_spacing):
+    """Start positions on the floor, on a grid centered in the arena."""
+    n_side = math.ceil(math.sqrt(len(uris)))
+    center_x = (absolute_boundaries["x"][0] + absolute_boundaries["x"][1]) / 2
+    center_y = (absolute_boundaries["y"][0] + absolute_boundaries["y"][1]) / 2
+    offset = (n_side - 1) * spacing / 2
+    return {uri: (center_x - offset + (i % n_side) * spacing, center_y - offset + (i // n_side) * spacing, FLOOR)
+            for i, uri in enumerate(uris)}
+
+
+class SimulatedDrone:
+    '''Kinematic drone. Commands and steps are serialized by the lock of the simulation.'''
+    def __init__(self, uri, position, boot_time):
+        self.uri = uri
+        self.position = np.array(position, dtype=float)
+        self.flying = False
+        self.battery = simulation_battery_full
+        self.motion = None  # (start, end, start time, duration) of the running high level command
+        self.landing = False  # motors stop when the landing motion ends
+        self.setpoint = None  # streamed setpoint, None when the high level commander is in control
+        self.stop_time = None  # time of a stop setpoint, the motors stop unless the high level commander takes over
+        self.boot_time = boot_time
+        self.link_up = True
+
+    def move_to(self, end, now, duration):
+        self.setpoint = None
+        self.motion = (self.position.copy(), np.array(end, dtype=float), now, max(duration, 1e-3))
+
+    def stop(self):
+        """Motors off: the drone falls to the floor."""
+        self.flying = False
+        self.landing = False
+        self.motion = None
+        self.setpoint = None
+        self.stop_time = None
+        self.position[2] = FLOOR
+
+    def step(self, now, dt):
+        if self.stop_time is not None and now - self.stop_time >= simulation_step:
+            self.stop()
+        if self.flying and self.setpoint is not None:
+            error = self.setpoint - self.position
+            distance = math.sqrt(float(error @ error))
+            reach = simulation_setpoint_speed * dt
+            self.position = self.setpoint.copy() if distance <= reach else self.position + error * (reach / distance)
+        elif self.motion is not None:
+            start, end, t0, duration = self.motion
+            s = min(max((now - t0) / duration, 0.0), 1.0)
+            s = s * s * (3.0 - 2.0 * s)  # smooth start and stop, like the trajectories of the high level commander
+            self.position = start + (end - start) * s
+            if s >= 1.0:
+                self.motion = None
+                if self.landing:
+                    self.stop()
+        drain = simulation_battery_drain_flying if self.flying else simulation_battery_drain_ground
+        self.battery = max(self.battery - drain * dt, 0.0)
+
+    def supervisor_info(self):
+        if self.flying:
+            return IS_FLYING
+        return CAN_FLY if self.battery > 0.0 else 0
+
+
+# ---------------------------
+# RADIO STAND-INS
+# ---------------------------
+class _SimulatedHighLevelCommander:
+    def __init__(self, drone, lock, clock):
+        self._drone = drone
+        self._lock = lock  # commands and simulation steps are serialized
+        self._clock = clock
+
+    def takeoff(self, height, duration):
+        with self._lock:
+            drone = self._drone
+            if not drone.flying:
+                drone.flying = True
+                drone.landing = False
+                drone.move_to((drone.position[0], drone.position[1], height), self._clock.time(), duration)
+
+    def land(self, height, duration):
+        with self._lock:
+            drone = self._drone
+            if drone.flying:
+                drone.move_to((drone.position[0], drone.position[1], max(height, FLOOR)), self._clock.time(), duration)
+                drone.landing = True
+
+    def go_to(self, x, y, z, yaw, duration, relative=False):
+        with self._lock:
+            drone = self._drone
+            if drone.flying:
+                end = drone.position + (x, y, z) if relative else (x, y, z)
+                drone.move_to(end, self._clock.time(), duration)
+
+
+class _SimulatedCommander:
+    def __init__(self, drone, lock, clock):
+        self._drone = drone
+        self._lock = lock  # commands and simulation steps are serialized
+        self._clock = clock
+
+    def send_position_setpoint(self, x, y, z, yaw):
+        with self._lock:
+            drone = self._drone
+            drone.flying = True  # low level setpoints start the motors, as on the real drone
+            drone.landing = False
+            drone.motion = None
+            drone.stop_time = None
+            drone.setpoint = np.array((x, y, z), dtype=float)
+
+    def send_stop_setpoint(self):
+        with self._lock:
+            self._drone.setpoint = None
+            self._drone.stop_time = self._clock.time()
+
+    def send_notify_setpoint_stop(self):
+        with self._lock:
+            # The high level commander takes over and holds the drone where it is
+            self._drone.setpoint = None
+            self._drone.stop_time = None
+
+
+class _SimulatedCrazyflie:
+    def __init__(self, drone, lock, clock):
+        self.high_level_commander = _SimulatedHighLevelCommander(drone, lock, clock)
+        self.commander = _SimulatedCommander(drone, lock, clock)
+
+
+class _SimulatedLink:
+    '''Takes the place of a SyncCrazyflie.'''
+    def __init__(self, uri, drone, lock, clock):
+        self.uri = uri
+        self.cf = _SimulatedCrazyflie(drone, lock, clock)
+
+    def close_link(self):
+        pass
+
+
+# ---------------------------
+# SWARM
+# ---------------------------
+class SimulatedSwarm(CrazyflieSwarm):
+    '''CrazyflieSwarm flying simulated drones. Only the link boundary is overridden.'''
+    def __init__(self, uris, positions=None, seed=0, **kwargs):
+        '''
+        Args:
+            uris (list): drones to simulate
+            positions (dict): {uri: (x, y, z)} start positions, on a grid on the floor if None
+            seed (int): seed of the measurement noise
+            kwargs: passed to CrazyflieSwarm (clock, record)
+        '''
+        super().__init__(uris, **kwargs)
+        positions = positions or ground_positions(uris)
+        now = self.clock.time()
+        self.drones = {uri: SimulatedDrone(uri, positions[uri], now) for uri in uris}
+        self._simulation_lock = threading.Lock()
+        self.callbacks = {}  # {uri: (low freq callback, high freq callback)}
+        self._rng = np.random.default_rng(seed)
+        self._simulating = True
+        self._simulation_thread = self.clock.start_thread(self._simulate, daemon=True)
+
+    def cut_link(self, uri):
+        """Simulate a lost link: no more telemetry and no reconnection until restore_link()."""
+        with self._simulation_lock:
+            self.drones[uri].link_up = False
+
+    def restore_link(self, uri):
+        with self._simulation_lock:
+            self.drones[uri].link_up = True
+
+    # ---------------------------
+    # LINK BOUNDARY
+    # ---------------------------
+    def _open_link(self, uri):
+        drone = self.drones[uri]
+        if not drone.link_up:
+            raise ConnectionError(f"Simulated link to {uri} is down")
+        return _SimulatedLink(uri, drone, self._simulation_lock, self.clock)
+
+    def _setup_logging(self, uri, scf):
+        self.callbacks[uri] = self._log_callbacks(uri)
+        print(f"[OK] Logging started for {uri}")
+
+    def _simulate(self):
+        """Step the drones and deliver their telemetry at the log periods of the swarm."""
+        next_status = {uri: 0.0 for uri in self.uris}
+        next_position = {uri: 0.0 for uri in self.uris}
+        last = self.clock.time()
+        while self._simulating:
+            now = self.clock.time()
+            samples = []
+            with self._simulation_lock:
+                for uri, drone in self.drones.items():
+                    drone.step(now, now - last)
+                    if not drone.link_up or uri not in self.callbacks:
+                        continue
+                    ts = int((now - drone.boot_time) * 1000)
+                    if now >= next_status[uri]:
+                        next_status[uri] = now + low_frequency_update_interval
+                        samples.append((uri, 0, ts, {'pm.vbat': drone.battery, 'supervisor.info': drone.supervisor_info()}))
+                    if now >= next_position[uri]:
+                        next_position[uri] = now + self.rates.periods[uri] / 1000.0
+                        x, y, z = (drone.position + self._rng.normal(0.0, simulation_position_noise, 3)).tolist()
+                        samples.append((uri, 1, ts, {'kalman.stateX': x, 'kalman.stateY': y, 'kalman.stateZ': z}))
+            last = now
+            # The callbacks run outside the simulation lock, they may send commands
+            for uri, block, ts, data in samples:
+                self.callbacks[uri][block](ts, data, None)
+            self.clock.sleep(simulation_step, first=True)  # telemetry is an input, see ReplayClock.sleep()
+
+    def close_links(self):
+        super().close_links()
+        self._simulating = False
+        self.clock.join(self._simulation_thread, 1.0)
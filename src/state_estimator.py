@@ -0,0 +1,78 @@
+'''
+Online estimate of each drone's position and velocity.
+
+An alpha-beta filter per drone is stepped in the position callback with the log timestamp of the
+drone (ts), so the time between samples is the real time between measurements, whatever the radio
+did with the packets. The offset between the drone clock and the host clock is tracked from the
+least delayed packets, which gives the host time at which each sample was measured. Planning and
+safety checks then extrapolate the estimate to "now" instead of using a sample that is up to a
+log period plus the radio delay old.
+'''
+from collections import namedtuple
+
+import numpy as np
+
+from config import estimator_alpha, estimator_beta, estimator_reset_gap, estimator_offset_drift, estimator_max_prediction
+
+# position and velocity of a drone at host time `time`
+Estimate = namedtuple("Estimate", ["position", "velocity", "time"])
+
+
+class AlphaBetaEstimator:
+    '''Alpha-beta filter of one drone. update() is called from the drone's log callback only, in plain
+    Python: a few multiplications per sample.'''
+    __slots__ = ("alpha", "beta", "position", "velocity", "ts", "offset")
+
+    def __init__(self, alpha=estimator_alpha, beta=estimator_beta):
+        self.alpha = alpha
+        self.beta = beta
+        self.position = None
+        self.velocity = (0.0, 0.0, 0.0)
+        self.ts = None  # drone time of the last sample, seconds
+        self.offset = 0.0  # host time - drone time
+
+    def update(self, ts, position, arrival, velocity=None):
+        '''
+        Args:
+            ts (int): log timestamp of the sample, ms since the drone booted
+            position (tuple): measured position
+            arrival (float): host time the packet was received
+            velocity (tuple): logged velocity, if the drone sends it. Used instead of the filtered one
+        Returns:
+            Estimate at the time the sample was measured
+        '''
+        t = ts / 1000.0
+        if self.ts is None or t <= self.ts or t - self.ts > estimator_reset_gap:
+            # First sample, drone rebooted (ts went back) or link lost for a while: start over
+            self.position = position
+            self.velocity = velocity or (0.0, 0.0, 0.0)
+            self.offset = arrival - t
+        else:
+            dt = t - self.ts
+            px, py, pz = self.position
+            vx, vy, vz = self.velocity
+            px, py, pz = px + vx * dt, py + vy * dt, pz + vz * dt
+            rx, ry, rz = position[0] - px, position[1] - py, position[2] - pz
+            a = self.alpha
+            self.position = (px + a * rx, py + a * ry, pz + a * rz)
+            if velocity is None:
+                b = self.beta / dt
+                self.velocity = (vx + b * rx, vy + b * ry, vz + b * rz)
+            else:
+                self.velocity = velocity
+            # The least delayed packet bounds the clock offset best, it may only drift slowly upwards
+            self.offset = min(self.offset + estimator_offset_drift * dt, arrival - t)
+        self.ts = t
+        return Estimate(self.position, self.velocity, t + self.offset)
+
+
+def predict(estimate, now):
+    """Position of an estimate extrapolated to now (at most estimator_max_prediction ahead)."""
+    dt = min(max(now - estimate.time, 0.0), estimator_max_prediction)
+    return tuple(p + v * dt for p, v in zip(estimate.position, estimate.velocity))
+
+
+def predict_arrays(positions, velocities, times, now):
+    """Vectorized predict() for (n, 3) positions and velocities and (n,) estimate times."""
+    dt = np.clip(now - times, 0.0, estimator_max_prediction)
+    return positions + velocities * dt[:, None]
@@ -0,0 +1,109 @@
+import threading
+import time
+from collections import namedtuple
+
+from config import default_battery_voltage, position_cache_size
+
+# Immutable record of everything the swarm knows about one drone.
+# position_history holds the last position_cache_size positions, oldest first.
+# position_time is when the last position was received.
+# estimate is the filtered state_estimator.Estimate (position, velocity, measurement time), None before the first position.
+# velocity is the logged velocity if the drone sends it, otherwise the estimated one.
+DroneState = namedtuple("DroneState", ["state", "battery", "position", "position_history", "last_state_update", "velocity",
+                                       "position_time", "estimate"])
+
+
+class InstrumentedLock:
+    '''Drop-in replacement for threading.Lock that measures contention.
+    An acquire that can be served immediately costs one non-blocking attempt; only
+    contended acquires are timed.'''
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.total_wait = 0.0  # seconds
+        self.max_wait = 0.0  # seconds
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(blocking=False):
+            self.acquisitions += 1
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self._lock.acquire(timeout=timeout)
+        wait = time.perf_counter() - start
+        if acquired:
+            # Counters are only touched while holding the lock, so they need no lock of their own
+            self.acquisitions += 1
+            self.contended += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def stats(self):
+        return {
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+            "total_wait": self.total_wait,
+            "max_wait": self.max_wait,
+        }
+
+
+class SwarmState:
+    '''Publish/snapshot store for the telemetry of the swarm.
+
+    Every drone has one slot holding an immutable DroneState. A writer builds a new record
+    and swaps it into the slot with a single assignment, so a reader always gets a complete
+    record without taking any lock. Readers (GUI, planning, convergence checks) can never
+    block the cflib callback threads.
+
+    Writers of the same drone (its cflib link thread and the update loop) are serialised by a
+    per-drone lock that readers never touch.
+    '''
+    def __init__(self, uris, instrumented=False, now=None):
+        now = time.time() if now is None else now
+        self._slots = {uri: DroneState("disconnected", default_battery_voltage, None, (), now, None, None, None) for uri in uris}
+        if instrumented:
+            self._write_locks = {uri: InstrumentedLock(f"write_{uri}") for uri in uris}
+        else:
+            self._write_locks = {uri: threading.Lock() for uri in uris}
+
+    def get(self, uri):
+        '''Latest record of a drone, None for unknown uris.'''
+        return self._slots.get(uri)
+
+    def snapshot(self):
+        '''{uri: DroneState} for the whole swarm. The records are immutable, so the copy is safe to keep.'''
+        return dict(self._slots)
+
+    def publish(self, uri, **changes):
+        '''Replace some fields of a drone's record, e.g. publish(uri, state="flying").'''
+        with self._write_locks[uri]:
+            self._slots[uri] = self._slots[uri]._replace(**changes)
+
+    def publish_position(self, uri, position, velocity=None, now=None, estimate=None):
+        '''Publish a new position received at now, with its velocity and estimate, and append it to the bounded position history.'''
+        with self._write_locks[uri]:
+            record = self._slots[uri]
+            history = (record.position_history + (position,))[-position_cache_size:]
+            self._slots[uri] = record._replace(position=position, position_history=history, velocity=velocity,
+                                               position_time=now, estimate=estimate)
+
+    def lock_stats(self):
+        '''Contention of the per-drone write locks, only available in instrumented mode.'''
+        return {uri: lock.stats() for uri, lock in self._write_locks.items() if isinstance(lock, InstrumentedLock)}
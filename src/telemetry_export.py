@@ -0,0 +1,203 @@
+'''
+Telemetry export for external visualizers (projector view, Unity, ...).
+
+A TelemetryExporter thread publishes a compact binary frame of the whole swarm at a fixed rate,
+into a shared-memory ring buffer and/or to local UDP ports. It reads the lock-free telemetry
+snapshot, so the log callbacks never wait for it, and nothing it does can block: UDP sends are
+non-blocking and the ring buffer is simply overwritten.
+
+Frame: FRAME_HEADER_DTYPE followed by one FRAME_DRONE_DTYPE per drone, in the order of uris.
+Drone states are indexes into flight_recorder.STATES. Use decode_frame() or SharedFrameReader
+to read them (or the dtypes, from any language: all fields are little endian).
+'''
+import socket
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from flight_recorder import STATES
+from config import export_shared_memory_frames, export_udp_max_decimation
+
+FRAME_MAGIC = b"UWBF"
+FRAME_VERSION = 1
+FRAME_HEADER_DTYPE = np.dtype([("magic", "S4"), ("version", "<u2"), ("drones", "<u2"), ("seq", "<u4"), ("pad", "<u4"), ("time", "<f8")])
+FRAME_DRONE_DTYPE = np.dtype([
+    ("position", "<f4", (3,)),  # NaN until the first position
+    ("target", "<f4", (3,)),    # formation slot, NaN if none
+    ("battery", "<f4"),
+    ("state", "u1"),            # index in STATES
+    ("pad", "u1", (3,)),
+])
+_UNKNOWN_STATE = STATES.index("error")
+
+# Shared-memory ring: RING_HEADER_DTYPE, then the slots, each a uint64 sequence number followed by a frame.
+# The sequence number of a slot is odd while the exporter writes it.
+RING_HEADER_DTYPE = np.dtype([("magic", "S4"), ("frame_size", "<u4"), ("slots", "<u4"), ("pad", "<u4"), ("frames", "<u8")])
+
+
+def frame_size(n_drones):
+    return FRAME_HEADER_DTYPE.itemsize + n_drones * FRAME_DRONE_DTYPE.itemsize
+
+
+def decode_frame(buffer):
+    """(header record, drone array) of a frame."""
+    header = np.frombuffer(buffer, dtype=FRAME_HEADER_DTYPE, count=1)[0]
+    if header["magic"] != FRAME_MAGIC:
+        raise ValueError("Not a swarm telemetry frame")
+    drones = np.frombuffer(buffer, dtype=FRAME_DRONE_DTYPE, count=int(header["drones"]), offset=FRAME_HEADER_DTYPE.itemsize)
+    return header, drones
+
+
+class SharedFrameReader:
+    '''Reads the latest frame of the shared-memory ring from another process.
+    A reader that is too slow only misses frames, it never holds up the exporter.'''
+    def __init__(self, name):
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.header = np.ndarray(1, dtype=RING_HEADER_DTYPE, buffer=self.shm.buf)
+        self.frame_size = int(self.header["frame_size"][0])
+        self.slots = int(self.header["slots"][0])
+        self.last_seq = None
+
+    def latest(self):
+        """(header, drones) of the newest complete frame, None if there is none yet or it is being written."""
+        frames = int(self.header["frames"][0])
+        if frames == 0:
+            return None
+        offset = RING_HEADER_DTYPE.itemsize + ((frames - 1) % self.slots) * (8 + self.frame_size)
+        seq = np.ndarray(1, dtype="<u8", buffer=self.shm.buf, offset=offset)
+        before = int(seq[0])
+        data = bytes(self.shm.buf[offset + 8:offset + 8 + self.frame_size])
+        if before % 2 or int(seq[0]) != before:
+            return None
+        header, drones = decode_frame(data)
+        self.last_seq = int(header["seq"])
+        return header, drones
+
+    def close(self):
+        self.header = None
+        self.shm.close()
+
+
+class _UdpTarget:
+    '''A UDP destination. When sends fail (full socket buffer, nobody listening) the target is decimated:
+    it gets every 2nd, 4th, ... frame, up to export_udp_max_decimation, and recovers once sends succeed.'''
+    def __init__(self, address):
+        self.address = address
+        self.decimation = 1
+        self.dropped = 0
+
+
+class TelemetryExporter:
+    def __init__(self, swarm, rate, shared_memory_name=None, udp_targets=(), reclaim=False):
+        '''
+        Args:
+            swarm (CrazyflieSwarm): swarm to export
+            rate (float): frames per second
+            shared_memory_name (str): name of the shared-memory ring buffer, None for no ring
+            udp_targets (list): [(host, port)] to send every frame to
+            reclaim (bool): take over a shared memory of the same name that already exists (left over by a run
+                that crashed). Otherwise it may belong to another swarm or exporter: it is left alone and there is no ring
+        '''
+        self.swarm = swarm
+        self.uris = list(swarm.uris)
+        self.interval = 1.0 / rate
+        self.frames = 0
+        self._frame = np.zeros(1, dtype=FRAME_HEADER_DTYPE)
+        self._frame["magic"] = FRAME_MAGIC
+        self._frame["version"] = FRAME_VERSION
+        self._frame["drones"] = len(self.uris)
+        self._drones = np.zeros(len(self.uris), dtype=FRAME_DRONE_DTYPE)
+        self._state_index = {state: i for i, state in enumerate(STATES)}
+        self._running = False
+        self._thread = None
+
+        self._ring = None
+        if shared_memory_name:
+            size = RING_HEADER_DTYPE.itemsize + export_shared_memory_frames * (8 + frame_size(len(self.uris)))
+            try:
+                self._ring = shared_memory.SharedMemory(name=shared_memory_name, create=True, size=size)
+            except FileExistsError:
+                if reclaim:
+                    stale = shared_memory.SharedMemory(name=shared_memory_name)
+                    stale.close()
+                    stale.unlink()
+                    self._ring = shared_memory.SharedMemory(name=shared_memory_name, create=True, size=size)
+                else:
+                    print(f"[ERROR] Shared memory '{shared_memory_name}' already exists (another swarm, or a run that "
+                          f"crashed): not exporting to it. Set export_shared_memory_reclaim to take it over")
+            if self._ring is not None:
+                header = np.ndarray(1, dtype=RING_HEADER_DTYPE, buffer=self._ring.buf)
+                header[0] = (b"UWBR", frame_size(len(self.uris)), export_shared_memory_frames, 0, 0)
+                self._ring_header = header
+
+        self._udp = [_UdpTarget(tuple(address)) for address in udp_targets]
+        self._socket = None
+        if self._udp:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._socket.setblocking(False)
+
+    def build_frame(self):
+        """Pack the current telemetry snapshot into a frame (bytes)."""
+        telemetry = self.swarm.telemetry.snapshot()
+        targets = self.swarm.target_positions  # swapped whole or updated per key, never half written
+        nan3 = (np.nan, np.nan, np.nan)
+        drones = self._drones
+        drones["position"] = [telemetry[uri].position or nan3 for uri in self.uris]
+        drones["target"] = [targets.get(uri) or nan3 for uri in self.uris]
+        drones["battery"] = [telemetry[uri].battery for uri in self.uris]
+        drones["state"] = [self._state_index.get(telemetry[uri].state, _UNKNOWN_STATE) for uri in self.uris]
+        self._frame["seq"] = self.frames
+        self._frame["time"] = self.swarm.clock.time()
+        return self._frame.tobytes() + drones.tobytes()
+
+    def _publish(self, frame):
+        if self._ring is not None:
+            slots = export_shared_memory_frames
+            offset = RING_HEADER_DTYPE.itemsize + (self.frames % slots) * (8 + len(frame))
+            seq = np.ndarray(1, dtype="<u8", buffer=self._ring.buf, offset=offset)
+            seq[0] = 2 * self.frames + 1
+            self._ring.buf[offset + 8:offset + 8 + len(frame)] = frame
+            seq[0] = 2 * self.frames + 2
+            self._ring_header["frames"] = self.frames + 1
+        for target in self._udp:
+            if self.frames % target.decimation:
+                continue
+            try:
+                self._socket.sendto(frame, target.address)
+                if target.decimation > 1:
+                    target.decimation //= 2
+            except OSError:
+                # Full socket buffer or nobody listening: send this consumer fewer frames
+                target.dropped += 1
+                target.decimation = min(target.decimation * 2, export_udp_max_decimation)
+        self.frames += 1
+
+    def _loop(self):
+        next_frame = self.swarm.clock.time()
+        while self._running:
+            self._publish(self.build_frame())
+            next_frame += self.interval
+            delay = next_frame - self.swarm.clock.time()
+            if delay > 0:
+                self.swarm.clock.sleep(delay)
+            else:
+                next_frame = self.swarm.clock.time()  # fell behind, do not try to catch up with a burst
+
+    def start(self):
+        self._running = True
+        self._thread = self.swarm.clock.start_thread(self._loop, daemon=True)
+        outputs = ([f"shared memory '{self._ring.name}'"] if self._ring is not None else []) + \
+                  [f"udp {host}:{port}" for host, port in (target.address for target in self._udp)]
+        print(f"[INFO] Exporting telemetry at {1.0 / self.interval:.0f} Hz to {', '.join(outputs) or 'nowhere'}")
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self.swarm.clock.join(self._thread, 1.0)
+        if self._socket is not None:
+            self._socket.close()
+        if self._ring is not None:
+            self._ring_header = None
+            self._ring.close()
+            self._ring.unlink()
+            self._ring = None
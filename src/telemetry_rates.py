@@ -0,0 +1,88 @@
+import math
+
+from config import (position_rate_by_phase, low_frequency_update_interval, radio_packet_budget,
+                    dynamic_waypoint_dt, log_period_min_ms, log_period_max_ms)
+
+# Log blocks of every drone: (variable, type). A log packet carries at most LOG_PACKET_DATA bytes of data.
+STATUS_VARIABLES = (('pm.vbat', 'float'), ('supervisor.info', 'uint16_t'))
+POSITION_VARIABLES = (('kalman.stateX', 'float'), ('kalman.stateY', 'float'), ('kalman.stateZ', 'float'))
+LOG_TYPE_SIZES = {'uint8_t': 1, 'int8_t': 1, 'uint16_t': 2, 'int16_t': 2, 'uint32_t': 4, 'int32_t': 4, 'float': 4, 'FP16': 2}
+LOG_PACKET_DATA = 26
+
+
+def block_bytes(variables):
+    """Data bytes of one sample of a log block."""
+    return sum(LOG_TYPE_SIZES[kind] for _, kind in variables)
+
+
+def radio_of(uri):
+    '''Dongle index of a uri: radio://<dongle>/<channel>/<datarate>/<address>.'''
+    try:
+        return int(uri.split("://", 1)[1].split("/")[0])
+    except (IndexError, ValueError):
+        return 0
+
+
+def period_ms(rate):
+    '''Log period for a rate in Hz, on the 10 ms grid of the firmware and within its limits.'''
+    if rate <= 0:
+        return log_period_max_ms
+    period = math.ceil(100.0 / rate) * 10  # rounded up so the rate never exceeds the allocation
+    return max(log_period_min_ms, min(log_period_max_ms, period))
+
+
+class TelemetryRateController:
+    '''Chooses the position log period of every drone from its flight phase.
+
+    Phases: "ground", "takeoff", "hover", "transition" and "dynamic", with the rates of
+    position_rate_by_phase. All drones on the same Crazyradio share radio_packet_budget packets per
+    second. The status block and the setpoint stream of dynamic formations are counted first, since
+    they are fixed, and the rest is shared between the position blocks: every drone keeps at least
+    its ground rate, and what is left is split in proportion to how much faster each drone wants to go.
+    '''
+    def __init__(self, uris, budget=radio_packet_budget):
+        self.uris = list(uris)
+        self.budget = budget
+        self.phases = {uri: "ground" for uri in self.uris}
+        self.periods = {uri: period_ms(position_rate_by_phase["ground"]) for uri in self.uris}  # {uri: position period in ms}
+        self._radios = {}
+        for uri in self.uris:
+            self._radios.setdefault(radio_of(uri), []).append(uri)
+
+    def _allocate(self, uris):
+        '''Position rates (Hz) of the drones of one radio.'''
+        floor = position_rate_by_phase["ground"]
+        desired = {uri: position_rate_by_phase[self.phases[uri]] for uri in uris}
+        fixed = len(uris) / low_frequency_update_interval
+        fixed += sum(1.0 / dynamic_waypoint_dt for uri in uris if self.phases[uri] == "dynamic")
+        available = max(self.budget - fixed, 0.0)
+        if sum(desired.values()) <= available:
+            return desired
+        floors = {uri: min(floor, rate) for uri, rate in desired.items()}
+        spare = available - sum(floors.values())
+        if spare <= 0:
+            # Not even the ground rate fits, everybody slows down evenly
+            scale = available / sum(floors.values())
+            return {uri: rate * scale for uri, rate in floors.items()}
+        extra = {uri: desired[uri] - floors[uri] for uri in uris}
+        scale = spare / sum(extra.values())
+        return {uri: floors[uri] + extra[uri] * scale for uri in uris}
+
+    def update(self, phases):
+        """Take the current phase of every drone and return {uri: new position period in ms}
+        for the drones whose period has to change."""
+        self.phases.update(phases)
+        changes = {}
+        for uris in self._radios.values():
+            for uri, rate in self._allocate(uris).items():
+                period = period_ms(rate)
+                if period != self.periods[uri]:
+                    self.periods[uri] = period
+                    changes[uri] = period
+        return changes
+
+    def load(self, radio):
+        """Packets per second planned on one radio: status and position blocks plus setpoints."""
+        uris = self._radios.get(radio, [])
+        return sum(1000.0 / self.periods[uri] + 1.0 / low_frequency_update_interval
+                   + (1.0 / dynamic_waypoint_dt if self.phases[uri] == "dynamic" else 0.0) for uri in uris)
@@ -1,7 +1,654 @@
 '''
 This is the file for testing without using the hardware
 '''
+import numpy as np
+
 from formations import FormationCalculator
+from position_codec import read_sample, POSITION_SCALE, COMPACT_POSITION_VARIABLES, MAX_QUANTIZATION_ERROR
+from config import absolute_boundaries, collision_threshold, position_convergence_distance
+
+# Compact position logging: the int16 mm quantization must be negligible next to the distances the swarm decides on
+rng = np.random.default_rng(0)
+low = [absolute_boundaries[axis][0] for axis in "xyz"]
+high = [absolute_boundaries[axis][1] for axis in "xyz"]
+positions = rng.uniform(low, high, size=(20000, 3))
+# Rounded to mm by the firmware, decoded one packet at a time by the callbacks
+names = [name for name, _ in COMPACT_POSITION_VARIABLES]
+packets = np.rint(positions / POSITION_SCALE).astype(np.int16).tolist()
+decoded = np.array([read_sample(dict(zip(names, packet)))[0] for packet in packets])
+error = np.linalg.norm(decoded - positions, axis=1).max()
+assert error <= MAX_QUANTIZATION_ERROR + 1e-12, error
+assert error < collision_threshold / 100, error
+assert error < position_convergence_distance / 100, error
+print(f"[OK] Compact position logging: max quantization error {1000 * error:.2f} mm")
+
+# Show scripts: the demo parses, and bad lines are reported with their number
+from show import load_show, parse_show
+cues = load_show("shows/demo.show")
+assert cues[0].action == "takeoff" and all(a.time <= b.time for a, b in zip(cues, cues[1:]))
+for bad in ("0 fly", "5 takeoff\n2 land", "0 land_one"):
+    try:
+        parse_show(bad)
+        raise AssertionError(bad)
+    except ValueError:
+        pass
+print(f"[OK] Show script: {len(cues)} cues, {cues[-1].time:.0f}s")
+
+# Watchdog: deadlines fire exactly when due, a callback can push its own deadline back
+from clock import ReplayClock
+from watchdog import DeadlineWatchdog
+clock = ReplayClock(0.0)
+watchdog = DeadlineWatchdog(clock)
+fired = []
+watchdog.arm("a", 2.0, lambda key, now: fired.append((key, now)))
+watchdog.arm("b", 1.0, lambda key, now: fired.append((key, now)) or (3.5 if now < 3.0 else None))
+watchdog.arm("c", 1.5, lambda key, now: fired.append((key, now)))
+watchdog.cancel("c")
+watchdog.start()
+for t in (0.5, 1.0, 2.0, 3.5, 10.0):
+    clock.advance_to(t)
+watchdog.stop()
+clock.advance_to(11.0)
+assert fired == [("b", 1.0), ("a", 2.0), ("b", 3.5)], fired
+print("[OK] Watchdog: deadlines fired on time")
+
+# Swarm state: records cannot be changed in place, and a reader never sees a half-published record while two threads
+# write the same drone
+import sys, threading
+from swarm_state import SwarmState
+from config import position_cache_size
+state = SwarmState(["a", "b"], instrumented=True, now=0.0)
+kept = state.snapshot()
+try:
+    kept["a"].position = (1.0, 2.0, 3.0)
+    raise AssertionError("DroneState is mutable")
+except AttributeError:
+    pass
+state.publish("a", state="flying")
+assert kept["a"].state == "disconnected" and state.get("a").state == "flying" and state.get("c") is None
+writes = 20000
+torn = []
+def write_positions():
+    for k in range(1, writes + 1):
+        position = (float(k), float(k), float(k))
+        state.publish_position("a", position, velocity=position, now=float(k), estimate=k)
+def write_states():
+    for k in range(1, writes + 1):
+        state.publish("a", battery=float(k))
+def read():
+    while writer.is_alive():
+        record = state.snapshot()["a"]
+        if record.position is not None and not (record.position == record.velocity == record.position_history[-1]
+                                                and record.position_time == record.estimate == record.position[0]
+                                                and len(record.position_history) <= position_cache_size):
+            torn.append(record)
+interval = sys.getswitchinterval()
+sys.setswitchinterval(1e-5)
+writer = threading.Thread(target=write_positions)
+threads = [writer, threading.Thread(target=write_states), threading.Thread(target=read)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+sys.setswitchinterval(interval)
+final = state.get("a")
+assert not torn, torn[:3]
+assert final.position_time == final.battery == float(writes)  # no write lost, neither writer undid the other
+assert final.position_history == tuple((float(k),) * 3 for k in range(writes - position_cache_size + 1, writes + 1))
+assert state.lock_stats()["a"]["acquisitions"] == 2 * writes + 1 and kept["a"].position is None
+print(f"[OK] Swarm state: records immutable, snapshots consistent under {2 * writes} concurrent writes, "
+      f"{state.lock_stats()['a']['contended']} contended")
+
+# Tracing: the export is Chrome trace-event JSON, nested spans lie inside their parent on the same thread
+import contextlib, io, json, os, tempfile, time
+from tracing import Tracer
+off = Tracer()
+assert off.wrap(len) is len and off.span("a") is off.span("b")
+trace = Tracer(enabled=True)
+def work():
+    with trace.span("outer", "radio://0/80/2M/E7E7E7E700", step=1):
+        for _ in range(2):
+            with trace.span("inner"):
+                time.sleep(0.001)
+                trace.wrap(sum, "wrapped")([1, 2])
+work()
+worker = threading.Thread(target=work, name="worker")
+worker.start()
+worker.join()
+trace_path = os.path.join(tempfile.mkdtemp(), "trace.json")
+with contextlib.redirect_stdout(io.StringIO()):
+    trace.export(trace_path)
+with open(trace_path) as f:
+    exported = json.load(f)
+spans = [event for event in exported["traceEvents"] if event["ph"] == "X"]
+names = {event["tid"]: event["args"]["name"] for event in exported["traceEvents"] if event["ph"] == "M"}
+assert len(spans) == 2 * 5 and sorted(names.values()) == sorted([threading.current_thread().name, "worker"]), names
+def inside(child, parent):
+    return (child["tid"] == parent["tid"] and parent["ts"] <= child["ts"] + 1e-3
+            and child["ts"] + child["dur"] <= parent["ts"] + parent["dur"] + 1e-3)
+for tid in names:
+    mine = [event for event in spans if event["tid"] == tid]
+    outer, = [event for event in mine if event["name"] == "outer"]
+    inner = sorted((event for event in mine if event["name"] == "inner"), key=lambda event: event["ts"])
+    wrapped = [event for event in mine if event["name"] == "wrapped"]
+    assert outer["cat"] == outer["args"]["uri"] and outer["args"]["step"] == 1 and inner[0]["cat"] == "swarm"
+    assert len(inner) == len(wrapped) == 2 and all(inside(event, outer) for event in inner)
+    assert inner[0]["dur"] >= 1000 and inner[0]["ts"] + inner[0]["dur"] <= inner[1]["ts"] + 1e-3  # siblings in order
+    assert all(sum(inside(event, parent) for parent in inner) == 1 for event in wrapped)
+small = Tracer(enabled=True, max_events=3)
+for k in range(5):
+    with small.span(f"span{k}"):
+        pass
+assert [event[0] for event in small._events] == ["span2", "span3", "span4"]  # oldest dropped
+print(f"[OK] Tracing: {len(spans)} spans exported as Chrome trace JSON, nested on {len(names)} threads")
+
+# State estimator: the alpha-beta filter locks on a constant-velocity track at 50 Hz through lost packets and a hole
+# in the telemetry, and dates samples from the least delayed packet
+from state_estimator import AlphaBetaEstimator, predict, predict_arrays
+from config import estimator_reset_gap, estimator_max_prediction
+track_rng = np.random.default_rng(3)
+velocity = np.array([0.5, -0.3, 0.1])
+start = np.array([1.0, 2.0, 0.5])
+host_offset, min_delay = 1234.5, 0.004
+def track(noise, drop):
+    """Errors (position, velocity, time) of the estimates from 1 s on, and the estimate right after the hole."""
+    estimator = AlphaBetaEstimator()
+    errors = []
+    for k in range(500):
+        if (k not in (0, 240) and track_rng.random() < drop) or 200 <= k < 240:  # lost packets, 0.8 s without position
+            continue
+        t = 0.02 * k
+        true = start + velocity * t
+        arrival = host_offset + t + min_delay + track_rng.exponential(0.01)
+        estimate = estimator.update(round(1000 * t), tuple(true + track_rng.normal(0.0, noise, 3)), arrival)
+        if k >= 50:
+            errors.append((np.linalg.norm(np.subtract(estimate.position, true)), np.linalg.norm(np.subtract(estimate.velocity, velocity)),
+                           estimate.time - (host_offset + t)))
+        if k == 240:
+            after_hole = errors[-1]
+    return np.array(errors), after_hole, estimator, estimate
+for drop in (0.0, 0.3):
+    errors, after_hole, _, _ = track(0.0, drop)
+    assert errors[:, :2].max() < 1e-6 and max(after_hole[:2]) < 1e-6, (drop, errors[:, :2].max(), after_hole)
+    errors, after_hole, estimator, estimate = track(0.005, drop)
+    assert errors[:, 0].mean() < 0.01 and errors[:, 1].mean() < 0.15 and after_hole[0] < 0.1, (drop, errors.mean(axis=0), after_hole)
+    assert (min_delay <= errors[:, 2]).all() and (errors[:, 2] < min_delay + 0.002).all(), (errors[:, 2].min(), errors[:, 2].max())
+# Extrapolated to now, capped at estimator_max_prediction, the same one drone at a time or all at once
+ahead = predict(estimate, estimate.time + 0.2)
+assert np.allclose(ahead, np.add(estimate.position, np.multiply(estimate.velocity, 0.2)))
+assert np.allclose(predict(estimate, estimate.time + 10.0), predict(estimate, estimate.time + estimator_max_prediction))
+assert np.allclose(predict_arrays(np.array([estimate.position]), np.array([estimate.velocity]), np.array([estimate.time]),
+                                  estimate.time + 0.2), [ahead])
+# A longer hole, or a drone that rebooted (its clock went back), starts the filter over from the sample
+for ts in (round(1000 * (estimator.ts + estimator_reset_gap)) + 20, 100):
+    estimate = estimator.update(ts, (0.0, 0.0, 0.3), host_offset + ts / 1000.0 + min_delay)
+    assert estimate.position == (0.0, 0.0, 0.3) and estimate.velocity == (0.0, 0.0, 0.0), estimate
+print("[OK] State estimator: constant-velocity track followed through lost packets and a 0.8 s hole, reset after "
+      f"{estimator_reset_gap:.0f} s or a reboot")
+
+# Battery model: a noisy linear discharge in flight is predicted to within a few seconds, landing starts over
+from battery_model import DischargeModel
+from config import low_battery_in_flight
+model = DischargeModel(window=60.0, min_samples=10)
+for t in range(120):
+    model.update(float(t), 3.9 - 0.004 * t + rng.normal(0.0, 0.01), flying=True)
+left = model.remaining_flight_time(119.0)
+expected = (3.9 - 0.004 * 119 - low_battery_in_flight) / 0.004
+assert abs(left - expected) < 10.0, (left, expected)
+model.update(120.0, 3.7, flying=False)
+assert model.remaining_flight_time(120.0) is None and model.fit() is None
+print(f"[OK] Battery model: {left:.0f}s of flight predicted, {expected:.0f}s expected")
+
+# Compiled shows: the memory-mapped plan gives back the segments the compiler planned
+import os, tempfile
+from show_compiler import ShowCompiler, ShowPlan, is_plan
+show_uris = [f"radio://0/80/2M/E7E7E7E7{i:02X}" for i in range(4)]
+compiler = ShowCompiler(show_uris)
+path = os.path.join(tempfile.mkdtemp(), "demo.plan")
+compiler.compile(cues)
+compiler.write(path, cues)
+plan = ShowPlan(path)
+assert is_plan(path) and not is_plan("shows/demo.show")
+assert plan.uris == show_uris and [cue[:3] for cue in plan.cues()] == [cue[:3] for cue in cues]
+circle = next(i for i, cue in enumerate(cues) if cue.action == "moving_circle")
+transition, trajectories = plan.segment(circle)
+assert set(trajectories) == set(show_uris) and set(transition[-1]) == set(show_uris)
+transition, trajectories = plan.segment(circle, 1)
+assert show_uris[1] not in trajectories
+print(f"[OK] Compiled show: {os.path.getsize(path) / 1024:.0f} KiB for {len(show_uris)} drones")
+
+# Volumetric formations: a full arena keeps drone_spacing and boundary_margins, one more drone does not fit
+from formations import VOLUMETRIC_FORMATIONS
+from config import drone_spacing, boundary_margins
+volume = FormationCalculator()
+for name in VOLUMETRIC_FORMATIONS:
+    capacity = volume.max_drones(name)
+    points = np.array(list(getattr(volume, name)({str(i): True for i in range(capacity)}).values()))
+    assert len(points) == capacity and FormationCalculator._min_distance(points) >= drone_spacing - 1e-9, name
+    for axis, column in zip("xyz", points.T):
+        assert absolute_boundaries[axis][0] + boundary_margins - 1e-9 <= column.min(), name
+        assert column.max() <= absolute_boundaries[axis][1] - boundary_margins + 1e-9, name
+    try:
+        getattr(volume, name)({str(i): True for i in range(capacity + 1)})
+        raise AssertionError(f"{name} took {capacity + 1} drones")
+    except ValueError:
+        pass
+print("[OK] Volumetric formations: " + ", ".join(f"{name} holds {volume.max_drones(name)}" for name in VOLUMETRIC_FORMATIONS))
+
+# Custom shapes: every slot inside the shape, none closer than drone_spacing
+import math, time
+from shapes import Polygon, Implicit, fill_shape
+star = Polygon([(0.8 * math.cos(a) * (1.0 if k % 2 == 0 else 0.45), 0.8 * math.sin(a) * (1.0 if k % 2 == 0 else 0.45))
+                for k, a in enumerate(np.linspace(0.0, 2 * math.pi, 10, endpoint=False) + math.pi / 2)])
+ball = Implicit(lambda p: ((p - (0.0, 0.0, 1.0)) ** 2).sum(axis=1) - 0.8 ** 2, (-0.8, -0.8, 0.2), (0.8, 0.8, 1.8))
+for shape, n_drones in ((star, 20), (ball, 200)):
+    start = time.perf_counter()
+    points = fill_shape(shape, n_drones)
+    elapsed = time.perf_counter() - start
+    assert len(points) == n_drones and shape.contains(points).all()
+    assert FormationCalculator._min_distance(points) >= drone_spacing
+    print(f"[OK] Custom shape: {n_drones} drones in {1000 * elapsed:.0f} ms, closest {FormationCalculator._min_distance(points):.2f} m")
+# Too many drones for a small shape, and a cloud with no sample to spare, are refused
+from shapes import PointCloud
+line = PointCloud(np.c_[np.linspace(-0.25, 0.25, 500), np.zeros(500), np.ones(500)])
+square = Polygon([(-0.25, -0.25), (0.25, -0.25), (0.25, 0.25), (-0.25, 0.25)])
+for shape, n_drones in ((line, 17), (square, 10), (PointCloud(line.points[::100]), 5)):
+    try:
+        fill_shape(shape, n_drones)
+        raise AssertionError(f"{n_drones} drones accepted")
+    except ValueError:
+        pass
+assert FormationCalculator._min_distance(fill_shape(square, 4)) >= drone_spacing
+print("[OK] Custom shape: shapes too small for their drones are refused")
+
+# Morphing: optimal assignment, and a blend that starts where the running formation is and ends on the next one
+import itertools
+from morph import Stream, StreamTable, assign, plan_morph
+from config import dynamic_waypoint_dt, dynamic_max_speed, dynamic_morph_duration
+for n in range(1, 7):
+    cost = rng.random((n, n))
+    best = min(sum(cost[i, p[i]] for i in range(n)) for p in itertools.permutations(range(n)))
+    assert abs(cost[np.arange(n), assign(cost)].sum() - best) < 1e-9
+morph_drones = {str(i): True for i in range(6)}
+_, running = FormationCalculator().moving_circle(morph_drones, period=12.0)
+_, following = FormationCalculator().sin_wave(morph_drones, period=12.0)
+streams = {uri: Stream(sequence) for uri, sequence in running.items()}
+morph = plan_morph(lambda uri, step: streams[uri].waypoint(step), following, 40, dynamic_waypoint_dt, dynamic_morph_duration)
+streams = {uri: stream.then(morph.switch_step, morph.prefixes[uri], morph.trajectories[uri]) for uri, stream in streams.items()}
+for uri, stream in streams.items():
+    assert stream.waypoint(39) == running[uri][39 % len(running[uri])] and np.allclose(stream.waypoint(40), running[uri][40 % len(running[uri])])
+    assert stream.waypoint(40 + len(morph.prefixes[uri])) == morph.trajectories[uri][0]
+path = np.array([[stream.waypoint(step)[:3] for step in range(38, 40 + len(morph.steps) + 2)] for stream in streams.values()])
+assert np.linalg.norm(np.diff(path, axis=1), axis=2).max() <= dynamic_max_speed * dynamic_waypoint_dt + 1e-9
+# The safety monitor reads all the streams at once, the same waypoints
+steps = np.arange(0, 40 + len(morph.steps) + 3 * len(morph.trajectories["0"]))
+table = StreamTable(streams, list(streams) + ["no stream"]).waypoints(steps)
+assert np.array_equal(table[:-1], [[stream.waypoint(step) for step in steps.tolist()] for stream in streams.values()])
+assert np.isnan(table[-1]).all()
+print(f"[OK] Morph: moving_circle into sin_wave over {morph.duration:.1f}s, phase {morph.phase}")
+
+# Radio workers: shared memory between two processes, with stand-in links instead of radios
+import multiprocessing
+from radio_worker import TelemetryTable, CommandRing, EmergencyFlags, RadioWorker, GO_TO, LOG_PERIOD, SHUTDOWN
+fork = multiprocessing.get_context("fork")  # spawn would run this whole script again in the child
+table, ring, flags = TelemetryTable(2), CommandRing(capacity=8), EmergencyFlags(1)
+
+def write_positions(name, count):
+    writer = TelemetryTable(2, name=name)
+    for k in range(count):
+        writer.write_position(k % 2, k, (k, k, k), (k, k, k))
+    writer.close()
+
+def put_commands(name, count):
+    producer = CommandRing(capacity=8, name=name)
+    for k in range(count):
+        producer.put(GO_TO, 0, k)
+    producer.close()
+
+class _Recorded:
+    '''Stand-in link: reports the commands the worker sends instead of sending them.'''
+    def __init__(self, sent):
+        self.cf = self
+        self.commander = self.high_level_commander = self
+        self.sent = sent
+    def go_to(self, x, *args):
+        self.sent.put(int(x))
+    def send_stop_setpoint(self):
+        self.sent.put("stop")
+    def close_link(self):
+        pass
+
+class _RecordedLog:
+    '''Stand-in position log block: reports the period start() sends, which cflib computes once from period_in_ms.'''
+    def __init__(self, sent, period_in_ms):
+        self.sent = sent
+        self.period_in_ms = period_in_ms
+        self.period = int(period_in_ms / 10)
+    def start(self):
+        self.sent.put(f"period {self.period}")
+
+def run_stand_in_worker(table_name, ring_name, emergency_name, sent, ready, go):
+    worker = RadioWorker(0, {"stand-in": 0}, table_name, ring_name, emergency_name, 1)
+    worker.scfs["stand-in"] = _Recorded(sent)
+    worker.position_logs["stand-in"] = _RecordedLog(sent, 500)
+    ready.set()
+    go.wait()
+    worker.run()
+
+# Seqlock: a slot being written is masked, a slot read as consistent is never torn
+table.slots["seq"][1] += 1
+assert list(table.read()[1]) == [True, False]
+table.slots["seq"][1] += 1
+writer = fork.Process(target=write_positions, args=(table.name, 200000))
+writer.start()
+reads = torn = masked = 0
+while writer.is_alive():
+    data, consistent = table.read()
+    masked += np.count_nonzero(~consistent)
+    for slot in data[consistent & (data["position_count"] > 0)]:
+        reads += 1
+        torn += not (np.all(slot["position"] == slot["position_ts"]) and np.all(slot["velocity"] == slot["position_ts"]))
+writer.join()
+assert torn == 0 and reads > 0, (torn, reads)
+# Ring: a producer in another process wraps the ring many times, the commands come out complete and in order
+producer = fork.Process(target=put_commands, args=(ring.name, 100))
+producer.start()
+received = []
+while len(received) < 100:
+    command = ring.get()
+    if command is not None:
+        received.append(int(command[2][0]))
+producer.join()
+assert received == list(range(100)) and ring.get() is None
+# Emergency: the stop goes out first, the moves queued before it are dropped, the ones after it are sent, then a new log period
+commands = CommandRing()  # the worker attaches with the configured capacity
+sent, ready, go = fork.Queue(), fork.Event(), fork.Event()
+worker = fork.Process(target=run_stand_in_worker, args=(table.name, commands.name, flags.name, sent, ready, go))
+worker.start()
+assert ready.wait(10.0)
+for k in range(5):
+    commands.put(GO_TO, 0, k)
+flags.request(0, commands.head)
+for k in range(5, 8):
+    commands.put(GO_TO, 0, k)
+commands.put(LOG_PERIOD, 0, 100)
+commands.put(SHUTDOWN, 0)
+go.set()
+worker.join(10.0)
+sent = [sent.get(timeout=1.0) for _ in range(5)]
+assert sent == ["stop", 5, 6, 7, "period 10"], sent
+for shared in (table, ring, commands, flags):
+    shared.close(unlink=True)
+print(f"[OK] Radio workers: {reads} consistent reads, none torn, {masked} masked, ring wrapped in order, queued moves dropped by the stop, "
+      f"log period sent")
+
+# Radio planning: a plan over capacity is refused, and an overloaded link is caught by the simulation
+import contextlib, io
+from radio_planner import plan_radios, check_plan, simulate_links
+many = [f"radio://0/80/2M/E7E7E7E7{i:02X}" for i in range(100)]
+try:
+    plan_radios(many, 1)
+    raise AssertionError("100 drones planned on one radio")
+except ValueError:
+    pass
+overloaded = plan_radios(many, 1, max_utilization=10.0)
+link = simulate_links(overloaded)[0]
+assert link.packets_per_second <= overloaded.capacity and link.backlog > 0
+with contextlib.redirect_stdout(io.StringIO()):
+    assert not check_plan(overloaded) and check_plan(plan_radios(many, 5))
+print(f"[OK] Radio planning: {overloaded.loads()[0][0]:.0f} packets/s offered, {link.packets_per_second:.0f} served")
+
+# Adaptive telemetry: rates follow the flight phase within the radio budget, and the new period is the one sent to the drone
+from telemetry_rates import TelemetryRateController, period_ms
+from config import position_rate_by_phase, radio_packet_budget
+crowded = [f"radio://0/80/2M/E7E7E7E7{i:02X}" for i in range(40)]
+alone = "radio://1/60/2M/E7E7E7E7FF"
+rates = TelemetryRateController(crowded + [alone])
+assert set(rates.periods.values()) == {period_ms(position_rate_by_phase["ground"])}
+changes = rates.update({**{uri: "dynamic" for uri in crowded[1:]}, alone: "takeoff"})
+assert set(changes) == set(crowded[1:]) | {alone} and rates.update({}) == {}
+assert rates.load(0) <= radio_packet_budget and rates.periods[crowded[0]] == period_ms(position_rate_by_phase["ground"])
+assert all(period_ms(position_rate_by_phase["dynamic"]) < rates.periods[uri] < rates.periods[crowded[0]] for uri in crowded[1:])
+assert rates.periods[alone] == period_ms(position_rate_by_phase["takeoff"])  # other radio, not slowed down
+class SentPeriods:
+    '''Position log block recording the period start() sends, which cflib computes once from period_in_ms in its constructor.'''
+    def __init__(self, period_in_ms):
+        self.period_in_ms = period_in_ms
+        self.period = int(period_in_ms / 10)
+        self.sent = []
+
+    def start(self):
+        self.sent.append(self.period)
+from drone_commands import CrazyflieSwarm
+swarm = CrazyflieSwarm(show_uris, clock=ReplayClock(0.0), record=False)
+blocks = {uri: SentPeriods(swarm.rates.periods[uri]) for uri in show_uris}
+swarm._log_configs = {uri: (None, block) for uri, block in blocks.items()}
+swarm._adapt_telemetry_rates({uri: drone._replace(state="flying") for uri, drone in swarm.telemetry.snapshot().items()})
+assert all(block.sent == [period_ms(position_rate_by_phase["hover"]) // 10] for block in blocks.values()), [b.sent for b in blocks.values()]
+print(f"[OK] Adaptive telemetry: {len(crowded)} drones share {rates.load(0):.0f} packets/s, hover period sent to the drones")
+
+# Metrics: a second swarm on the same port flies without the endpoint
+from metrics import MetricsRegistry
+first, second = MetricsRegistry(), MetricsRegistry()
+first.serve(0)
+second.serve(first._server.server_address[1])
+second.counter("x_total").inc()
+assert second._server is None and "x_total 1" in second.render()
+first.close()
+print("[OK] Metrics: port in use reported, swarm goes on")
+
+# Replay: records are stamped with the swarm clock, and an operator action that raises is reported as a divergence
+from flight_recorder import FlightRecorder, FlightSession, OPERATOR
+from replay import ReplayEngine
+path = os.path.join(tempfile.mkdtemp(), "error.rec")
+recorder = FlightRecorder(show_uris[:2], path, clock=ReplayClock(50.0))
+recorder.operator("circle")  # no drone ever connects
+recorder.close()
+session = FlightSession(path)
+assert session.header["start_time"] == 50.0 and session.records["t"].tolist() == [50.0]
+report = ReplayEngine(path).run()
+assert not report.identical and [error[1] for error in report.errors] == ["circle"], report.errors
+print(f"[OK] Replay: {report.errors[0][3]} reported")
+
+# Safety monitor: two streamed drones lagging off their setpoints towards each other are frozen, and only them
+from drone_commands import CrazyflieSwarm
+stations = {show_uris[0]: ((-0.2, 0.0, 1.0), (1.0, 0.0, 0.0)), show_uris[1]: ((0.2, 0.0, 1.0), (-1.0, 0.0, 0.0)),
+            show_uris[2]: ((0.0, 0.6, 1.0), (0.0, 0.0, 0.0)), show_uris[3]: ((0.0, -0.6, 1.0), (0.0, 0.0, 0.0))}
+swarm = CrazyflieSwarm(list(stations), clock=ReplayClock(100.0), record=False)
+swarm._dynamic_streams = {uri: Stream([position + (0.0,)]) for uri, (position, _) in stations.items()}
+swarm._dynamic_start_time = swarm.clock.time()
+swarm._dynamic_formation_running = {uri: True for uri in stations}
+telemetry = {uri: drone._replace(state="flying", estimate=(stations[uri][0], stations[uri][1], swarm.clock.time()))
+             for uri, drone in swarm.telemetry.snapshot().items()}
+swarm._safety_check(telemetry)
+assert set(swarm._frozen) == set(show_uris[:2]), swarm._frozen
+print("[OK] Safety monitor: the two streamed drones closing in are frozen, the others fly on")
+
+# Reactive avoidance: two streamed drones heading at each other are pushed apart, within the cap and the boundaries
+from avoidance import ReciprocalAvoidance
+from config import avoidance_max_correction
+def corrected(setpoints, positions):
+    uris = list(positions)
+    trajectories = {uri: [setpoint + (0.0,)] for uri, setpoint in setpoints.items()}
+    estimates = lambda: (np.array([positions[uri] for uri in uris], dtype=float), np.full((len(uris), 3), np.nan))
+    avoidance = ReciprocalAvoidance(uris, trajectories, dynamic_waypoint_dt, estimates)
+    moved = {uri: avoidance.setpoint(uri, 0)[:3] for uri in setpoints}
+    assert all(math.dist(moved[uri], setpoints[uri]) <= avoidance_max_correction + 1e-9 for uri in setpoints)
+    assert all(avoidance.low[a] - 1e-9 <= value[a] <= avoidance.high[a] + 1e-9 for value in moved.values() for a in range(3))
+    return moved
+head_on = corrected({"a": (0.0, 0.02, 1.0), "b": (0.0, -0.02, 1.0)}, {"a": (-0.3, 0.0, 1.0), "b": (0.3, 0.0, 1.0)})
+assert math.dist(head_on["a"], head_on["b"]) >= collision_threshold
+# Two obstacles on the same side push further than the cap
+capped = corrected({"a": (0.0, 0.0, 1.0)}, {"a": (0.0, 0.0, 1.0), "b": (0.0, -0.05, 1.0), "c": (0.05, -0.05, 1.0)})
+assert abs(math.dist(capped["a"], (0.0, 0.0, 1.0)) - avoidance_max_correction) < 1e-9
+# Against the wall the push stops at the boundary margin
+walled = corrected({"a": (0.0, 0.8, 1.0), "b": (0.0, 0.76, 1.0)}, {"a": (-0.3, 0.78, 1.0), "b": (0.3, 0.78, 1.0)})
+assert walled["a"][1] == absolute_boundaries["y"][1] - boundary_margins
+print(f"[OK] Reactive avoidance: head-on setpoints {math.dist(head_on['a'], head_on['b']):.2f} m apart, corrections capped and inside")
+
+# Trajectory validation: crossing transitions and the jump closing the loop are swept, stretched periods are slow enough
+from trajectory_validator import TrajectoryValidator
+from config import formation_transition_duration
+validator = TrajectoryValidator()
+hover = {"a": [(0.5, 0.0, 1.0, 0.0)], "b": [(-0.5, 0.0, 1.0, 0.0)]}
+swap = validator.validate(hover, dynamic_waypoint_dt, [{"a": (-0.5, 0.0, 1.0), "b": (0.5, 0.0, 1.0)}, {"a": (0.5, 0.0, 1.0), "b": (-0.5, 0.0, 1.0)}],
+                          formation_transition_duration)
+assert not validator.is_safe(swap) and swap.clearance_time < swap.loop_start, swap
+# Around the hovering drone, then straight back through it from the last waypoint to the first
+loop = {"a": [(-0.5, 0.0, 1.0, 0.0), (-0.5, 0.5, 1.0, 0.0), (0.5, 0.5, 1.0, 0.0), (0.5, 0.0, 1.0, 0.0)], "b": [(0.0, 0.0, 1.0, 0.0)] * 4}
+wrap = validator.validate(loop, dynamic_waypoint_dt)
+assert not validator.is_safe(wrap) and wrap.clearance_time >= 3 * dynamic_waypoint_dt, wrap
+for uri in stations:
+    swarm.formations.connect_to_formation(uri)
+_, fast = swarm.formations.get_dynamic_formation_positions("moving_circle", 2.0)
+report = validator.validate(fast, dynamic_waypoint_dt)
+assert report.peak_speed > dynamic_max_speed
+period, _, slow = swarm._stretch_period("moving_circle", 2.0, report.peak_speed)
+stretched = validator.validate(slow, dynamic_waypoint_dt)
+assert stretched.peak_speed <= dynamic_max_speed + 1e-9 and validator.is_safe(stretched), stretched
+print(f"[OK] Trajectory validation: crossing and loop closing rejected, {report.peak_speed:.2f} m/s stretched to {stretched.peak_speed:.2f} m/s")
+
+# Emergency stop: simulated drones streaming a dynamic formation are killed, confirmed, and nothing moves them afterwards,
+# the drone left flying still follows the operator
+from simulation import SimulatedSwarm
+from show import ShowRunner, run_virtual
+from config import emergency_confirm_timeout, landing_duration, low_frequency_update_interval
+clock = ReplayClock(1000.0)
+killed = show_uris[1:]
+swarm = SimulatedSwarm(show_uris, clock=clock, record=False)
+sent = []  # (time, command, uri) from the start of the emergency stop on
+def spy(uri, target, name):
+    command = getattr(target, name)
+    setattr(target, name, lambda *args, **kwargs: sent.append((clock.time(), name, uri)) or command(*args, **kwargs))
+class EmergencyFlight(ShowRunner):
+    def execute(self):
+        swarm.connect_all()
+        swarm.run()
+        self.wait_ready()
+        swarm.operator_command("takeoff")
+        clock.sleep(6.0)
+        swarm.operator_command("moving_circle")
+        clock.sleep(8.0)
+        assert all(swarm._dynamic_formation_running.values())
+        swarm.cut_link(show_uris[3])  # its telemetry never confirms the stop
+        for uri, scf in swarm.scfs.items():
+            for name in ("go_to", "land"):
+                spy(uri, scf.cf.high_level_commander, name)
+            spy(uri, scf.cf.commander, "send_position_setpoint")
+        self.start = clock.time()
+        self.kill_times = swarm.emergency_stop(killed)
+        self.end = clock.time()
+        swarm.operator_command("flat_square")
+        swarm.operator_command("land")
+        clock.sleep(landing_duration)
+        swarm.stop_background()
+        swarm.close_links()
+flight = EmergencyFlight(swarm, [])
+run_virtual(clock, flight)
+kill_times = flight.kill_times
+assert set(kill_times) == set(killed) and set(swarm._killed) == set(killed), kill_times
+assert all(0.0 < kill_times[uri] < 2 * low_frequency_update_interval for uri in killed[:2]) and kill_times[show_uris[3]] is None, kill_times
+assert flight.end - flight.start >= emergency_confirm_timeout
+assert not [command for command in sent if command[2] in killed and (command[1] != "send_position_setpoint" or command[0] > flight.start)], sent
+assert {command[1] for command in sent if command[0] >= flight.end} == {"go_to", "land"}  # flat_square and land for the other one
+print(f"[OK] Emergency stop: {max(kill_times[uri] for uri in killed[:2]) * 1000:.0f} ms to confirm, unconfirmed drone reported, "
+      f"no command to the killed drones after the stop")
+
+# Replay of a simulated flight: the replayed swarm sends every recorded command again, the same way each time
+path = os.path.join(tempfile.mkdtemp(), "simulated.rec")
+clock = ReplayClock(2000.0)
+swarm = SimulatedSwarm(show_uris, clock=clock, record=False)
+swarm.recorder = FlightRecorder(show_uris, path, clock=clock)
+show = parse_show("0 takeoff\n+6 flat_square\n+8 moving_circle\n+12 sin_wave\n+12 circle\n+8 land\n+4 hold")
+with contextlib.redirect_stdout(io.StringIO()):
+    run_virtual(clock, ShowRunner(swarm, show))
+for attempt in range(2):
+    report = ReplayEngine(path).run()
+    assert report.identical and report.matched.get("setpoint"), report.summary()
+print(f"[OK] Replay: simulated flight replayed twice, {sum(report.matched.values())} commands and state changes matched both times")
+# A custom shape added during the flight is an operator action: recorded by name, replayed with the shape
+path = os.path.join(tempfile.mkdtemp(), "shape.rec")
+clock = ReplayClock(3000.0)
+swarm = SimulatedSwarm(show_uris, clock=clock, record=False)
+swarm.recorder = FlightRecorder(show_uris, path, clock=clock)
+swarm.add_shape("star", star)
+show = parse_show("0 takeoff\n+6 star\n+6 flat_square\n+6 land\n+4 hold", shapes=("star",))
+with contextlib.redirect_stdout(io.StringIO()):
+    run_virtual(clock, ShowRunner(swarm, show))
+session = FlightSession(path)
+assert session.header["operator_actions"][-1] == "star" and len(session.of_kind(OPERATOR)) == 4
+report = ReplayEngine(path, shapes={"star": star}).run()
+assert report.identical and report.matched.get("go_to"), report.summary()
+report = ReplayEngine(path).run()
+assert [error[1] for error in report.errors] == ["star"], report.errors
+print("[OK] Replay: custom shape recorded by name and replayed, missing shape reported")
+
+# Telemetry export: a simulated flight reaches a shared-memory reader and a UDP socket with the same frames. A ring
+# name already in use is left alone, a leftover one is only taken over when asked
+import socket
+from multiprocessing import shared_memory
+from telemetry_export import TelemetryExporter, SharedFrameReader, decode_frame
+from flight_recorder import STATES
+ring_name = f"uwb_swarm_test_{os.getpid()}"
+receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+receiver.bind(("127.0.0.1", 0))
+receiver.setblocking(False)
+clock = ReplayClock(4000.0)
+swarm = SimulatedSwarm(show_uris, clock=clock, record=False)
+class ExportedFlight(ShowRunner):
+    def execute(self):
+        swarm.connect_all()
+        swarm.run()
+        self.wait_ready()
+        swarm.operator_command("takeoff")
+        clock.sleep(6.0)
+        reader = SharedFrameReader(ring_name)
+        header, drones = reader.latest()
+        self.ring = (int(header["seq"]), float(header["time"]), drones.copy())
+        reader.close()
+        self.datagrams = []
+        while True:
+            try:
+                self.datagrams.append(receiver.recv(65536))
+            except BlockingIOError:
+                break
+        self.positions = {uri: swarm.telemetry.snapshot()[uri].position for uri in show_uris}
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.refused = TelemetryExporter(swarm, 10.0, ring_name)
+        self.refused_output = output.getvalue()
+        swarm.operator_command("land")
+        clock.sleep(landing_duration)
+        swarm.stop_background()
+        swarm.close_links()
+flight = ExportedFlight(swarm, [])
+with contextlib.redirect_stdout(io.StringIO()):
+    swarm.start_export(rate=10.0, shared_memory_name=ring_name, udp_targets=[receiver.getsockname()])
+    run_virtual(clock, flight)
+receiver.close()
+seq, at, drones = flight.ring
+assert seq >= 50 and at > 4006.0, (seq, at)
+assert (drones["state"] == STATES.index("flying")).all(), drones["state"]
+assert np.allclose(drones["position"], [flight.positions[uri] for uri in show_uris], atol=0.1)
+assert len(flight.datagrams) == seq + 1  # every frame, none decimated
+header, udp_drones = decode_frame(flight.datagrams[-1])
+assert int(header["seq"]) == seq and udp_drones.tobytes() == drones.tobytes()
+assert flight.refused._ring is None and "[ERROR]" in flight.refused_output, flight.refused_output
+try:
+    shared_memory.SharedMemory(name=ring_name).close()
+    raise AssertionError("the ring is still there after close_links()")
+except FileNotFoundError:
+    pass
+# A ring left over by a run that crashed
+leftover = shared_memory.SharedMemory(name=ring_name, create=True, size=64)
+leftover.close()
+with contextlib.redirect_stdout(io.StringIO()):
+    assert TelemetryExporter(swarm, 10.0, ring_name)._ring is None
+    exporter = TelemetryExporter(swarm, 10.0, ring_name, reclaim=True)
+reader = SharedFrameReader(ring_name)
+assert exporter._ring is not None and reader.slots == int(exporter._ring_header["slots"][0]) and reader.latest() is None
+reader.close()
+exporter.stop()
+print(f"[OK] Telemetry export: {seq + 1} frames to shared memory and UDP, a ring in use is refused, a leftover one reclaimed")
 
 drones = {
     "radio://0/80/2M/E7E7E7E701": "flying",
@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from config import tracing_enabled, tracing_max_events
+
+
+class _NullSpan:
+    '''Returned by span() when tracing is off: entering and leaving it does nothing.'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *args):
+        self.tracer._complete(self.name, self.start, time.perf_counter_ns(), self.args)
+        return False
+
+
+class Tracer:
+    '''Opt-in recorder of timed spans, exported in the Chrome trace-event format
+    (open the file in chrome://tracing or https://ui.perfetto.dev).
+
+    span() is a context manager for a block of code, wrap() decorates a function. When tracing
+    is off, span() returns a shared no-op object and wrap() returns the function unchanged, so
+    code that is wrapped while tracing is off runs exactly as without tracing.
+    '''
+    def __init__(self, enabled=False, max_events=tracing_max_events):
+        self.enabled = enabled
+        self._events = deque(maxlen=max_events)  # oldest spans are dropped when full
+        self._thread_names = {}  # {thread id: name}
+        self._origin = time.perf_counter_ns()
+
+    def enable(self):
+        self.enabled = True
+
+    def _complete(self, name, start, end, args):
+        tid = threading.get_ident()
+        if tid not in self._thread_names:
+            self._thread_names[tid] = threading.current_thread().name
+        self._events.append((name, start, end, tid, args))
+
+    def span(self, name, uri=None, **args):
+        """Time a block: with tracer.span("go_to", uri): ..."""
+        if not self.enabled:
+            return _NULL_SPAN
+        if uri is not None:
+            args["uri"] = uri
+        return _Span(self, name, args)
+
+    def wrap(self, function, name=None, uri=None):
+        """Return function traced as a span, or function itself when tracing is off."""
+        if not self.enabled:
+            return function
+        name = name or function.__name__
+        args = {"uri": uri} if uri is not None else {}
+
+        def traced(*a, **kw):
+            start = time.perf_counter_ns()
+            try:
+                return function(*a, **kw)
+            finally:
+                self._complete(name, start, time.perf_counter_ns(), args)
+        return traced
+
+    def export(self, path):
+        """Write the recorded spans as Chrome trace-event JSON."""
+        pid = os.getpid()
+        events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                  for tid, name in list(self._thread_names.items())]
+        for name, start, end, tid, args in list(self._events):
+            events.append({
+                "name": name,
+                "cat": args.get("uri", "swarm"),
+                "ph": "X",
+                "ts": (start - self._origin) / 1000,  # microseconds
+                "dur": (end - start) / 1000,
+                "pid": pid,
+                "tid": tid,
+                "args": args,
+            })
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        print(f"[INFO] Trace with {len(self._events)} spans saved to {path}")
+
+
+# Shared by the swarm, the GUI and the planners
+tracer = Tracer(enabled=tracing_enabled)
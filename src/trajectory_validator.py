@@ -0,0 +1,109 @@
+'''
+Pre-flight validation of dynamic formations.
+
+Before send_dynamic_formation streams a trajectory set, the whole of it is swept in time: the
+transition from the current positions into the start positions (the go_to steps send_formation
+will send) followed by one full period of the cyclic trajectories, including the jump from the
+last waypoint back to the first. Positions are interpolated between waypoints so that no drone
+moves more than validation_resolution between two samples, and at every sample the distance of all
+pairs and the distance of every drone to the walls are evaluated at once with NumPy.
+
+Drones that are flying but not part of the formation are obstacles standing where they are.
+'''
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from config import absolute_boundaries, collision_threshold, validation_resolution
+
+# clearance: smallest distance between two drones, at clearance_time (s from the start of the transition) between pair (uri, uri)
+# boundary_margin: smallest distance of a drone to the walls and the ceiling (negative if outside), at boundary_time for boundary_uri
+# loop_start: time the cyclic trajectories start, after the transition
+# peak_speed: fastest waypoint to waypoint speed of the trajectories (m/s)
+TrajectoryReport = namedtuple("TrajectoryReport", ["clearance", "clearance_time", "pair", "boundary_margin", "boundary_time",
+                                                   "boundary_uri", "loop_start", "peak_speed"])
+
+
+def _segments(start, end, t0, duration, resolution):
+    """Linear interpolation from start to end ((n, 3) arrays), end excluded: (times, positions)."""
+    samples = max(1, math.ceil(np.abs(end - start).max() / resolution)) if len(start) else 1
+    s = np.arange(samples) / samples
+    return t0 + s * duration, start[None] + s[:, None, None] * (end - start)[None]
+
+
+class TrajectoryValidator:
+    def __init__(self, boundaries=absolute_boundaries, threshold=collision_threshold, resolution=validation_resolution):
+        self.low = np.array([boundaries[axis][0] for axis in "xyz"])
+        self.low[2] = -np.inf  # the floor is not a wall, drones joining a formation take off from it
+        self.high = np.array([boundaries[axis][1] for axis in "xyz"])
+        self.threshold = threshold
+        self.resolution = resolution
+
+    def sample(self, trajectories, waypoint_dt, transition=(), transition_duration=0.0, obstacles=None):
+        '''
+        Args:
+            trajectories (dict): {uri: [waypoints]}, waypoints are (x, y, z, yaw), all of the same length
+            waypoint_dt (float): time between two waypoints
+            transition (list): [{uri: (x, y, z)}] current positions, then the positions of every go_to step that leads to the start positions
+            transition_duration (float): duration of each go_to step
+            obstacles (dict): {uri: (x, y, z)} drones that stay where they are
+        Returns:
+            (uris, times (T,), positions (T, n, 3), loop_start, peak_speed)
+        '''
+        obstacles = obstacles or {}
+        uris = list(trajectories) + [uri for uri in obstacles if uri not in trajectories]
+        waypoints = np.array([[waypoint[:3] for waypoint in trajectories[uri]] for uri in trajectories], dtype=float)
+        fixed = np.array([obstacles[uri] for uri in uris[len(trajectories):]], dtype=float).reshape(-1, 3)
+
+        times, positions = [], []
+        # Transition: all drones of a go_to step share the same duration and time profile, so sampling
+        # the straight lines at equal fractions gives their relative positions at the same instants
+        steps = [np.array([step.get(uri, waypoints[k, 0]) for k, uri in enumerate(trajectories)], dtype=float) for step in transition]
+        for k in range(len(steps) - 1):
+            t, p = _segments(steps[k], steps[k + 1], k * transition_duration, transition_duration, self.resolution)
+            times.append(t)
+            positions.append(p)
+        loop_start = max(len(steps) - 1, 0) * transition_duration
+
+        # One full period, closing the loop
+        following = np.roll(waypoints, -1, axis=1)
+        peak_speed = float(np.linalg.norm(following - waypoints, axis=2).max() / waypoint_dt) if waypoints.size else 0.0
+        for k in range(waypoints.shape[1]):
+            t, p = _segments(waypoints[:, k], following[:, k], loop_start + k * waypoint_dt, waypoint_dt, self.resolution)
+            times.append(t)
+            positions.append(p)
+
+        times = np.concatenate(times)
+        positions = np.concatenate(positions)
+        positions = np.concatenate([positions, np.broadcast_to(fixed, (len(times),) + fixed.shape)], axis=1)
+        return uris, times, positions, loop_start, peak_speed
+
+    def validate(self, trajectories, waypoint_dt, transition=(), transition_duration=0.0, obstacles=None):
+        """Sweep of the transition and one period of the trajectories (arguments of sample()). Returns a TrajectoryReport."""
+        uris, times, positions, loop_start, peak_speed = self.sample(trajectories, waypoint_dt, transition, transition_duration, obstacles)
+        moving = len(trajectories)
+
+        # Boundaries: distance to the nearest wall of every moving drone at every sample
+        margins = np.minimum(positions[:, :moving] - self.low, self.high - positions[:, :moving]).min(axis=2)
+        t, k = np.unravel_index(np.argmin(margins), margins.shape)
+        boundary = (float(margins[t, k]), float(times[t]), uris[k])
+
+        # Clearance: every pair with at least one moving drone, in chunks of samples to bound the memory
+        i, j = np.triu_indices(len(uris), k=1)
+        keep = i < moving
+        i, j = i[keep], j[keep]
+        clearance = (math.inf, 0.0, None)
+        if len(i):
+            chunk = max(1, (1 << 20) // len(i))
+            for start in range(0, len(times), chunk):
+                p = positions[start:start + chunk]
+                d = p[:, i] - p[:, j]
+                distances = np.einsum("tpk,tpk->tp", d, d)
+                t, k = np.unravel_index(np.argmin(distances), distances.shape)
+                if distances[t, k] < clearance[0] ** 2:
+                    clearance = (math.sqrt(distances[t, k]), float(times[start + t]), (uris[i[k]], uris[j[k]]))
+        return TrajectoryReport(*clearance, *boundary, loop_start, peak_speed)
+
+    def is_safe(self, report):
+        return report.clearance >= self.threshold and report.boundary_margin >= 0.0
@@ -0,0 +1,89 @@
+'''
+Deadline watchdog: runs callbacks exactly when their deadlines fall due.
+
+Every key (for the swarm: the link of a drone, or its next reconnection attempt) has at most
+one deadline. They are kept in a min-heap and one thread sleeps until the earliest of them, so
+the cost does not depend on the number of keys and nothing is polled. A callback returns None
+when it is done, or a later deadline to re-arm its key: this is how a deadline that keeps
+moving (the link deadline moves with every telemetry packet) is followed without touching the
+heap on every packet, it is only looked at again when its old deadline comes.
+'''
+import heapq
+import itertools
+import threading
+
+
+class DeadlineWatchdog:
+    def __init__(self, clock):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._heap = []  # (deadline, seq, key), entries whose deadline moved are skipped
+        self._deadlines = {}  # {key: (deadline, callback)}
+        self._seq = itertools.count()
+        self._wake = clock.event()  # set when the earliest deadline moves closer, or to stop
+        self._running = False
+        self._thread = None
+        self.fired = 0  # callbacks run so far
+
+    def arm(self, key, deadline, callback):
+        """Run callback(key, now) at deadline. Arming a key again replaces its deadline."""
+        with self._lock:
+            earliest = self._heap[0][0] if self._heap else None
+            self._deadlines[key] = (deadline, callback)
+            heapq.heappush(self._heap, (deadline, next(self._seq), key))
+        if earliest is None or deadline < earliest:
+            self._wake.set()
+
+    def cancel(self, key):
+        with self._lock:
+            self._deadlines.pop(key, None)
+
+    def deadline(self, key):
+        """Deadline of a key, None if it is not armed."""
+        entry = self._deadlines.get(key)
+        return entry[0] if entry else None
+
+    def _due(self, now):
+        """Pop the keys whose deadline has come: [(key, callback)], and the time until the next one."""
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, key = heapq.heappop(self._heap)
+                entry = self._deadlines.get(key)
+                if entry is None or entry[0] != deadline:
+                    continue  # cancelled or moved, its current deadline has its own entry
+                del self._deadlines[key]
+                due.append((key, entry[1]))
+            timeout = self._heap[0][0] - now if self._heap else None
+        return due, timeout
+
+    def _run(self):
+        while self._running:
+            self._wake.clear()
+            now = self.clock.time()
+            due, timeout = self._due(now)
+            for key, callback in due:
+                self.fired += 1
+                try:
+                    deadline = callback(key, now)
+                except Exception as e:
+                    print(f"[ERROR] Watchdog callback for {key} failed: {e}")
+                    continue
+                if deadline is not None and key not in self._deadlines:
+                    self.arm(key, deadline, callback)
+            if due:
+                continue  # callbacks may have armed deadlines that are already due
+            self._wake.wait(timeout)
+
+    def start(self):
+        self._running = True
+        self._thread = self.clock.start_thread(self._run, daemon=True)
+
+    def stop(self):
+        """Stop running callbacks, the thread ends as soon as it wakes up (see join())."""
+        self._running = False
+        self._wake.set()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self.clock.join(self._thread, timeout)